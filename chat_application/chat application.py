@@ -5,20 +5,993 @@ import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, scrolledtext
 import socket
 import threading
+import asyncio
+import subprocess
+import tempfile
+import sys
 import json
+import struct
 import hashlib
 import sqlite3
 import base64
 import os
 import time
+import queue
+import signal
+import multiprocessing
 from datetime import datetime
 from PIL import Image, ImageTk
 import io
+import itertools
+import secrets
+import hmac
+import random
+import bisect
+import re
+import zlib
+import functools
+import contextlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, quote
+import urllib.request
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+
+# Wire protocol: every message is a 4-byte big-endian length followed by a JSON payload.
+# Binary frames (version 3, used for attachment chunks) set the top bit of the length and
+# carry a 4-byte JSON length, the JSON header, then raw bytes. Compressed frames set the
+# next bit and carry the zlib-compressed payload of a JSON or binary frame.
+PROTOCOL_VERSION = 3
+SUPPORTED_VERSIONS = (2, 3)
+FRAME_HEADER = struct.Struct('!I')
+FLAG_BINARY = 0x80000000
+FLAG_COMPRESSED = 0x40000000
+SIZE_MASK = 0x3FFFFFFF
+MAX_FRAME_SIZE = 128 * 1024 * 1024
+MAX_OUTBOUND_BYTES = 16 * 1024 * 1024  # per-client send backlog before it counts as a slow consumer
+CONNECTION_IDS = itertools.count(1)
+
+# Attachments travel out of band in chunks and are stored by SHA-256
+BLOB_CHUNK_SIZE = 256 * 1024
+MAX_FETCH_WINDOW = 4 * 1024 * 1024  # bytes streamed per fetch_blob request
+MAX_BLOB_SIZE = 2 * 1024 * 1024 * 1024
+THUMBNAIL_SIZE = (150, 150)
+PHOTO_CACHE_SIZE = 200  # decoded images kept by the client
+
+# Authentication: salted PBKDF2 password hashes, computed off the message-handling path,
+# and resumable session tokens so a reconnect does not need the password again
+KDF_ITERATIONS = 200_000
+SESSION_TTL = 7 * 24 * 3600
+SESSION_CACHE_SIZE = 10_000
+
+# Rate limits: token buckets of (requests per second, burst) per user for each limited
+# request type, and per room for messages posted to it. A request over its limit gets a
+# 'throttled' reply saying when to retry instead of being served, and the connection
+# isn't read from again until then. Logins and registrations count against the username
+# and, more loosely since many users can share one, the client's IP address.
+RATE_LIMITS = {'chat_message': (5, 20), 'get_history': (10, 40), 'search': (2, 10), 'create_room': (0.1, 3),
+               'upload_start': (2, 10), 'register': (0.2, 3), 'login': (0.5, 5), 'typing': (2, 10),
+               'read': (5, 20), 'get_rooms': (5, 20), 'delete_room': (0.1, 3)}
+ROOM_RATE_LIMITS = {'chat_message': (50, 200)}
+PEER_RATE_LIMITS = {'register': (1, 20), 'login': (10, 100)}
+# Room activity (presence, typing, read cursors) is broadcast as one coalesced delta per
+# room every ACTIVITY_INTERVAL seconds (0: a delta per event); typing lapses unless the
+# client repeats it, and read cursors reach the database every READ_SAVE_INTERVAL
+ACTIVITY_INTERVAL = 0.5
+TYPING_TIMEOUT = 6.0
+READ_SAVE_INTERVAL = 5.0
+# Flow control: a connection with more than this queued for sending isn't read from
+# until half of it has drained, so a client that doesn't read can't keep writing
+INBOUND_PAUSE_BYTES = 1024 * 1024
+
+# Compression is negotiated at login (clients list the codecs they accept) and applied
+# to JSON frames of at least COMPRESS_THRESHOLD bytes. 'zlib-dict' primes zlib with a
+# dictionary of the protocol's recurring JSON, which lets mid-sized frames compress well.
+COMPRESSION_CODECS = ('zlib-dict', 'zlib')
+COMPRESS_THRESHOLD = 512
+COMPRESS_LEVEL = 1  # --bench-compression: level 6 saves a few % more for about 3x the CPU
+CHAT_ZDICT = (b'"type": "rooms_list", "rooms": [["type": "search_results", "results": [[ "has_more": true, '
+              b'"next": {"before_id": "after_id": null}, "offset": "order": "rank", "recent", '
+              b'"message_type": "image", "file", {"name": "sha256": "size": '
+              b'"type": "history", "room_id": "data": [[ "has_more": false, "before_id": null, '
+              b'", "text", "], [{"type": "new_message", "id": "room_id": "username": "message": "message_type": "text", '
+              b'"timestamp": "')
+# Stored messages of at least this many bytes are kept zlib-compressed (as BLOBs); the
+# writer thread compresses once and rows are read many times, so a higher level pays off
+STORE_COMPRESS_THRESHOLD = 1024
+STORE_COMPRESS_LEVEL = 6
+
+# Retention: rooms keep messages up to an age and/or count limit (a default, or their own),
+# and older ones move to archive files partitioned by month, still readable as history
+ARCHIVE_BLOCK_ROWS = 1000  # messages per compressed archive block, and per retention transaction
+ARCHIVE_COMPRESS_LEVEL = 9
+RETENTION_INTERVAL = 600
+VACUUM_STEP_PAGES = 256  # pages handed back to the file system per incremental VACUUM step
+
+# Room directory paging
+ROOM_PAGE_SIZE = 100
+MAX_ROOM_PAGE = 500  # also the most changes sent instead of a fresh listing
+
+# Database connections
+DB_READERS = 4  # read-only connections queries are spread over; writes all go through one
+STATEMENT_CACHE_SIZE = 256  # prepared statements kept per connection, keyed by the SQL text
+WRITE_RETRY_SECONDS = 30.0  # how long a batch of messages waits out another process holding the write lock
+
+# Client rendering: incoming messages are drawn in one batch per tick and the chat
+# widget keeps at most MAX_RENDERED_MESSAGES, loading older pages on scroll-up
+RENDER_INTERVAL_MS = 33
+MAX_RENDERED_MESSAGES = 500
+
+def compress_payload(payload, codec, level=COMPRESS_LEVEL):
+    if codec == 'zlib-dict':
+        deflater = zlib.compressobj(level, zdict=CHAT_ZDICT)
+    else:
+        deflater = zlib.compressobj(level)
+    return deflater.compress(payload) + deflater.flush()
+
+def inflate_payload(payload, max_size=MAX_FRAME_SIZE):
+    # The zlib header says whether the preset dictionary was used; it is only applied then
+    inflater = zlib.decompressobj(zdict=CHAT_ZDICT)
+    data = inflater.decompress(payload, max_size)
+    if inflater.unconsumed_tail:
+        raise ValueError(f"Frame inflates beyond {max_size} bytes")
+    return data
+
+def encode_frame(msg, data=None, codec=None):
+    # Attachment chunks (data) are sent as they are: they are mostly compressed already
+    payload = json.dumps(msg).encode()
+    if data is None:
+        if codec and len(payload) >= COMPRESS_THRESHOLD:
+            packed = compress_payload(payload, codec)
+            if len(packed) < len(payload):
+                return FRAME_HEADER.pack(FLAG_COMPRESSED | len(packed)) + packed
+        return FRAME_HEADER.pack(len(payload)) + payload
+    return (FRAME_HEADER.pack(FLAG_BINARY | (FRAME_HEADER.size + len(payload) + len(data)))
+            + FRAME_HEADER.pack(len(payload)) + payload + data)
+
+def negotiate_version(msg):
+    common = set(msg.get('versions', ())) & set(SUPPORTED_VERSIONS)
+    return max(common) if common else None
+
+def negotiate_codec(msg):
+    offered = msg.get('compression') or ()
+    return next((codec for codec in COMPRESSION_CODECS if codec in offered), None)
+
+def decode_payload(buffer, start, end, binary):
+    if binary:
+        (json_size,) = FRAME_HEADER.unpack_from(buffer, start)
+        msg = json.loads(buffer[start + FRAME_HEADER.size:start + FRAME_HEADER.size + json_size])
+        msg['data'] = bytes(buffer[start + FRAME_HEADER.size + json_size:end])
+        return msg
+    return json.loads(buffer[start:end])
+
+class FrameDecoder:
+    # Reassembles frames from arbitrary recv() chunks; a frame may span many reads
+    # and one read may carry several frames
+    def __init__(self, max_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.max_size = max_size
+    
+    def feed(self, data):
+        self.buffer += data
+        messages, offset = [], 0
+        while len(self.buffer) - offset >= FRAME_HEADER.size:
+            (header,) = FRAME_HEADER.unpack_from(self.buffer, offset)
+            size = header & SIZE_MASK
+            if size > self.max_size:
+                raise ValueError(f"Frame of {size} bytes exceeds limit")
+            start = offset + FRAME_HEADER.size
+            end = start + size
+            if len(self.buffer) < end:
+                break
+            if header & FLAG_COMPRESSED:
+                payload = inflate_payload(self.buffer[start:end], self.max_size)
+                msg = decode_payload(payload, 0, len(payload), header & FLAG_BINARY)
+            else:
+                msg = decode_payload(self.buffer, start, end, header & FLAG_BINARY)
+            messages.append(msg)
+            offset = end
+        if offset:
+            del self.buffer[:offset]
+        return messages
+
+class FramedSocket:
+    # Blocking client-side socket speaking the framed protocol
+    def __init__(self, sock):
+        self.sock = sock
+        self.codec = None  # set from the login reply
+        self.decoder = FrameDecoder()
+        self.pending = deque()
+        self.lock = threading.Lock()
+    
+    def send(self, msg, data=None):
+        frame = encode_frame(msg, data, self.codec)
+        with self.lock:
+            self.sock.sendall(frame)
+    
+    def recv(self):
+        while not self.pending:
+            data = self.sock.recv(65536)
+            if not data:
+                return None
+            self.pending.extend(self.decoder.feed(data))
+        return self.pending.popleft()
+    
+    def close(self):
+        self.sock.close()
+
+class FramedStream:
+    # asyncio counterpart of FramedSocket, used by the benchmarks
+    def __init__(self, reader, writer):
+        self.reader, self.writer = reader, writer
+        self.codec = None
+        self.decoder = FrameDecoder()
+        self.pending = deque()
+    
+    async def send(self, msg, data=None):
+        self.writer.write(encode_frame(msg, data, self.codec))
+        await self.writer.drain()
+    
+    async def recv(self):
+        while not self.pending:
+            data = await self.reader.read(65536)
+            if not data:
+                return None
+            self.pending.extend(self.decoder.feed(data))
+        return self.pending.popleft()
+    
+    def close(self):
+        self.writer.close()
+
+# Durability levels for message writes: SQLite synchronous mode, and whether
+# save_message waits for its batch to commit
+DURABILITY_LEVELS = {
+    'full': ('FULL', True),     # acknowledged only once committed and fsynced
+    'normal': ('NORMAL', False),  # write-behind, survives an app crash (WAL)
+    'off': ('OFF', False),      # write-behind, no fsync at all
+}
+
+def hash_password(password, iterations=KDF_ITERATIONS):
+    salt = secrets.token_bytes(16)
+    key = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+    return f"pbkdf2_sha256${iterations}${salt.hex()}${key.hex()}"
+
+def verify_password(password, stored, iterations=KDF_ITERATIONS):
+    # Returns (matches, needs_rehash); accounts created before salting store a bare sha256
+    if '$' not in stored:
+        ok = hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+        return ok, ok
+    scheme, rounds, salt, key = stored.split('$')
+    candidate = hashlib.pbkdf2_hmac('sha256', password.encode(), bytes.fromhex(salt), int(rounds))
+    ok = scheme == 'pbkdf2_sha256' and hmac.compare_digest(candidate.hex(), key)
+    return ok, ok and int(rounds) < iterations
+
+def token_key(token):
+    # Only a hash of each session token is stored, so a leaked database can't resume sessions
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def is_digest(value):
+    return isinstance(value, str) and len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def parse_attachment(message):
+    # Attachment messages store a small JSON reference instead of the file itself;
+    # anything else (including old inline base64 messages) returns None
+    if not message.startswith('{'):
+        return None
+    try:
+        ref = json.loads(message)
+    except ValueError:
+        return None
+    return ref if isinstance(ref, dict) and is_digest(ref.get('sha256')) else None
+
+class BlobStore:
+    # Content-addressed attachment storage at <root>/<sha[:2]>/<sha>, so identical files
+    # are stored once. Uploads land in <root>/partial first and can resume from the bytes
+    # already received.
+    def __init__(self, root='attachments'):
+        self.root = root
+        os.makedirs(os.path.join(root, 'partial'), exist_ok=True)
+        self.lock = threading.Lock()
+    
+    def path(self, digest, variant=None):
+        # Variants (currently only 'thumb') are stored next to the original
+        path = os.path.join(self.root, digest[:2], digest)
+        return f'{path}.{variant}.png' if variant else path
+    
+    def partial_path(self, digest, owner):
+        return os.path.join(self.root, 'partial', f'{digest}-{owner}.part')
+    
+    def exists(self, digest, variant=None):
+        return is_digest(digest) and variant in (None, 'thumb') and os.path.exists(self.path(digest, variant))
+    
+    def size(self, digest, variant=None):
+        return os.path.getsize(self.path(digest, variant))
+    
+    def received(self, digest, owner):
+        try:
+            return os.path.getsize(self.partial_path(digest, owner))
+        except OSError:
+            return 0
+    
+    def write_chunk(self, digest, owner, offset, data):
+        # Chunks must arrive in order; returns the offset the upload has reached
+        with self.lock:
+            received = self.received(digest, owner)
+            if offset != received:
+                return received
+            with open(self.partial_path(digest, owner), 'ab') as f:
+                f.write(data)
+            return received + len(data)
+    
+    def commit(self, digest, owner):
+        partial = self.partial_path(digest, owner)
+        if file_digest(partial) != digest:
+            os.remove(partial)
+            return False
+        os.makedirs(os.path.dirname(self.path(digest)), exist_ok=True)
+        os.replace(partial, self.path(digest))
+        return True
+    
+    def read_chunks(self, digest, offset, end, variant=None):
+        with open(self.path(digest, variant), 'rb') as f:
+            f.seek(offset)
+            while offset < end:
+                data = f.read(min(BLOB_CHUNK_SIZE, end - offset))
+                if not data:
+                    break
+                yield offset, data
+                offset += len(data)
+
+class Thumbnailer:
+    # Renders each image's thumbnail once, when it is uploaded, on a worker pool (Pillow
+    # releases the GIL while decoding and resizing), and stores it as a PNG next to the
+    # original so clients can show it without decoding the full image
+    def __init__(self, blobs, workers=None):
+        self.blobs = blobs
+        self.pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 2,
+                                       thread_name_prefix='thumbnail')
+        self.pending = {}
+        self.lock = threading.Lock()
+    
+    def submit(self, digest):
+        with self.lock:
+            if digest in self.pending:
+                return self.pending[digest]
+            if self.blobs.exists(digest, 'thumb'):
+                future = Future()
+                future.set_result(True)
+                return future
+            future = self.pool.submit(self.render, digest)
+            self.pending[digest] = future
+        future.add_done_callback(lambda f: self.pending.pop(digest, None))
+        return future
+    
+    def render(self, digest):
+        target = self.blobs.path(digest, 'thumb')
+        try:
+            with Image.open(self.blobs.path(digest)) as img:
+                img.thumbnail(THUMBNAIL_SIZE)
+                if img.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+                    img = img.convert('RGBA')
+                img.save(target + '.tmp', 'PNG', optimize=True)
+            os.replace(target + '.tmp', target)
+            return True
+        except Exception:
+            return False  # not an image Pillow can read; clients fall back to the file name
+
+# Latency histogram buckets, in seconds
+METRIC_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+MAX_METRIC_SERIES = 5000  # per kind, so unexpected label values can't grow memory without bound
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+
+class Metrics:
+    # Counters and latency histograms in the Prometheus text format; gauges come from
+    # collector callbacks run at scrape time, so nothing is updated on the hot path for them
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}    # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [per-bucket counts..., +Inf count, sum, count]
+        self.collectors = []  # callables returning [(name, labels dict, value)]
+        self.lock = threading.Lock()
+    
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key in self.counters or len(self.counters) < MAX_METRIC_SERIES:
+                self.counters[key] = self.counters.get(key, 0) + amount
+    
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                if len(self.histograms) >= MAX_METRIC_SERIES:
+                    return
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 3)
+            histogram[bisect.bisect_left(self.buckets, value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+    
+    def render(self):
+        lines, typed = [], set()
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(values)) for key, values in self.histograms.items())
+        for (name, labels), value in counters:
+            declare(name, 'counter')
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), values in histograms:
+            declare(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), values):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {values[-2]}")
+            lines.append(f"{name}_count{format_labels(labels)} {values[-1]}")
+        for collect in self.collectors:
+            for name, labels, value in collect():
+                declare(name, 'gauge')
+                lines.append(f"{name}{format_labels(sorted(labels.items()))} {value}")
+        return '\n'.join(lines) + '\n'
+
+def db_timed(method):
+    # Records each call's latency in the database's metrics registry, labelled with the method name
+    @functools.wraps(method)
+    def timed(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.registry.observe('chat_db_call_seconds', time.perf_counter() - started, call=method.__name__)
+    return timed
+
+class SamplingProfiler:
+    # Wall-clock sampling profiler: every interval it records the stack of each thread
+    # and reports them as collapsed stacks (one "frame;frame;frame count" line each),
+    # the input format of flame graph tools. Cheap enough to switch on in production.
+    def __init__(self, interval=0.005):
+        self.interval = interval
+    
+    def run(self, seconds):
+        counts = {}
+        me = threading.get_ident()
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                counts[key] = counts.get(key, 0) + 1
+            time.sleep(self.interval)
+        return ''.join(f"{stack} {count}\n" for stack, count in sorted(counts.items(), key=lambda kv: -kv[1]))
+
+class MetricsEndpoint:
+    # Local HTTP admin endpoint on its own thread: GET /metrics for the Prometheus text,
+    # GET /profile?seconds=N to sample the server's stacks for N seconds
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        endpoint = self
+        self.metrics = metrics
+        self.profiler = SamplingProfiler()
+        
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                try:
+                    if url.path == '/metrics':
+                        body = endpoint.metrics.render()
+                    elif url.path == '/profile':
+                        seconds = min(float(parse_qs(url.query).get('seconds', ['10'])[0]), 300)
+                        body = endpoint.profiler.run(seconds)
+                    else:
+                        self.send_error(404)
+                        return
+                except Exception as e:
+                    self.send_error(500, repr(e))
+                    return
+                data = body.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            
+            def log_message(self, *args):
+                pass
+        
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+    
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+# Trace capture (--trace) and replay (--replay). A trace is TRACE_MAGIC followed by records:
+# a TRACE_RECORD header (wall clock in microseconds, connection id, kind, payload size) and,
+# for frames, the frame itself, uncompressed.
+TRACE_MAGIC = b'CHATTRC1'
+TRACE_RECORD = struct.Struct('<QIBI')
+TRACE_OPEN, TRACE_FRAME, TRACE_CLOSE = range(3)
+TRACE_BUFFER = 1024 * 1024
+TRACE_PASSWORD = 'trace-replay'  # every account's password on a replay server
+# The reply that answers each request, for latency during a replay
+TRACE_REPLIES = {'register': ('register_result',), 'login': ('login_success', 'login_failed'),
+                 'resume': ('resumed', 'resume_failed'), 'logout': ('logged_out',),
+                 'get_rooms': ('rooms_list', 'rooms_changed'), 'create_room': ('room_created',),
+                 'delete_room': ('room_deleted',), 'join_room': ('room_joined',), 'leave_room': ('room_left',),
+                 'get_history': ('history',), 'search': ('search_results',),
+                 'upload_start': ('upload_ready', 'upload_done', 'upload_failed'),
+                 'fetch_blob': ('blob_chunk', 'blob_missing'), 'chat_message': ('new_message',)}
+
+class TraceWriter:
+    # Records inbound traffic for --replay: each connection's opening, its frames and its
+    # closing, timestamped, appended through a large write buffer (flushed by the ticker).
+    # Passwords are blanked and session tokens swapped for their user, so a trace holds no
+    # credentials; a replay gives every account the same password.
+    def __init__(self, path, sessions):
+        self.file = open(path, 'wb', buffering=TRACE_BUFFER)
+        self.file.write(TRACE_MAGIC)
+        self.sessions = sessions
+        self.lock = threading.Lock()
+    
+    def record(self, conn_id, kind, payload=b''):
+        header = TRACE_RECORD.pack(time.time_ns() // 1000, conn_id, kind, len(payload))
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(header + payload)
+    
+    def frame(self, conn_id, msg):
+        msg = dict(msg)
+        data = msg.pop('data', None)
+        if 'password' in msg:
+            msg['password'] = ''
+        if msg.get('type') == 'resume':
+            msg['user'] = self.sessions.username(msg.pop('token', None))
+        self.record(conn_id, TRACE_FRAME, encode_frame(msg, data))
+    
+    def flush(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.flush()
+    
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def read_trace(path):
+    # Yields (microseconds, connection id, kind, message or None) from a trace file
+    with open(path, 'rb') as f:
+        if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise ValueError(f"{path} is not a chat trace")
+        decoder = FrameDecoder()
+        while len(header := f.read(TRACE_RECORD.size)) == TRACE_RECORD.size:
+            at, conn_id, kind, size = TRACE_RECORD.unpack(header)
+            payload = f.read(size)
+            if len(payload) < size:
+                break  # cut short while the server was writing it
+            msg = decoder.feed(payload)[0] if kind == TRACE_FRAME else None
+            yield at, conn_id, kind, msg
+
+# Schema migrations, applied in order and tracked with PRAGMA user_version
+MIGRATIONS = [
+    "CREATE INDEX IF NOT EXISTS idx_messages_room ON messages (room_id, id)",
+    "CREATE TABLE IF NOT EXISTS sessions (token TEXT PRIMARY KEY, user_id INTEGER, expires REAL)",
+    # Full-text index over text messages only (attachments are references, and old ones
+    # inline base64). It reads message bodies from the messages table instead of storing
+    # a second copy, and triggers keep it up to date inside each write-behind batch.
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+           message, room_id, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2');
+       INSERT INTO messages_fts (rowid, message, room_id) SELECT id, message, room_id FROM messages WHERE type='text';
+       CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages WHEN new.type='text' BEGIN
+           INSERT INTO messages_fts (rowid, message, room_id) VALUES (new.id, new.message, new.room_id);
+       END;
+       CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages WHEN old.type='text' BEGIN
+           INSERT INTO messages_fts (messages_fts, rowid, message, room_id)
+           VALUES ('delete', old.id, old.message, old.room_id);
+       END;''',
+    # Large message bodies are stored compressed (see deflate_message), so the FTS index
+    # now reads them through a view that inflates them, and existing large rows are
+    # compressed in place. inflate() and deflate() are registered on every connection.
+    '''DROP TRIGGER IF EXISTS messages_fts_insert;
+       DROP TRIGGER IF EXISTS messages_fts_delete;
+       DROP TABLE IF EXISTS messages_fts;
+       UPDATE messages SET message = deflate(message) WHERE typeof(message) = 'text' AND length(message) >= 1024;
+       CREATE VIEW IF NOT EXISTS messages_text AS SELECT id, room_id, inflate(message) AS message FROM messages;
+       CREATE VIRTUAL TABLE messages_fts USING fts5(
+           message, room_id, content='messages_text', content_rowid='id', tokenize='unicode61 remove_diacritics 2');
+       INSERT INTO messages_fts (rowid, message, room_id)
+           SELECT id, inflate(message), room_id FROM messages WHERE type='text';
+       CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages WHEN new.type='text' BEGIN
+           INSERT INTO messages_fts (rowid, message, room_id) VALUES (new.id, inflate(new.message), new.room_id);
+       END;
+       CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages WHEN old.type='text' BEGIN
+           INSERT INTO messages_fts (messages_fts, rowid, message, room_id)
+           VALUES ('delete', old.id, inflate(old.message), old.room_id);
+       END;''',
+    # Retention: messages record when they were created (older rows have no time and count
+    # as older than any age limit) and rooms can have limits of their own
+    '''ALTER TABLE messages ADD COLUMN created REAL;
+       CREATE TABLE IF NOT EXISTS room_retention (room_id INTEGER PRIMARY KEY, max_age_days REAL,
+                                                  max_messages INTEGER);''',
+    '''CREATE TABLE IF NOT EXISTS read_cursors (user_id INTEGER, room_id INTEGER, last_id INTEGER,
+                                                PRIMARY KEY (user_id, room_id)) WITHOUT ROWID''',
+    # Room directory: rooms remember who created them (who may delete them), and every change
+    # is logged, its rowid being the directory version. A removal is logged without a name.
+    '''ALTER TABLE rooms ADD COLUMN owner INTEGER;
+       CREATE TABLE IF NOT EXISTS room_log (version INTEGER PRIMARY KEY, room_id INTEGER NOT NULL,
+                                            name TEXT, description TEXT);
+       INSERT INTO room_log (room_id, name, description) SELECT id, name, description FROM rooms ORDER BY id;''',
+    # Each write-behind batch checks its rooms haven't been removed (possibly by another shard)
+    "CREATE INDEX IF NOT EXISTS idx_room_log_room ON room_log (room_id)",
+    # The highest message id committed, kept apart from the messages so ids aren't handed
+    # out again once retention has moved the newest rows to the archive
+    '''CREATE TABLE IF NOT EXISTS message_ids (high INTEGER NOT NULL);
+       INSERT INTO message_ids SELECT COALESCE(MAX(id), 0) FROM messages;''',
+]
+
+MAX_HISTORY_PAGE = 200
+MAX_SEARCH_PAGE = 50
+MAX_SEARCH_OFFSET = 1000  # ranked results are paged by offset, which gets slower the deeper it goes
+SEARCH_RANK_WINDOW = 5000  # ranked search scores only this many of the newest matches
+SNIPPET_MARKS = ('\x02', '\x03')  # wrap the matched terms in search snippets
+
+def deflate_message(message):
+    # Storage form of a message body: large ones become zlib-compressed BLOBs
+    if isinstance(message, str) and len(message) >= STORE_COMPRESS_THRESHOLD:
+        packed = zlib.compress(message.encode(), STORE_COMPRESS_LEVEL)
+        if len(packed) < len(message):
+            return packed
+    return message
+
+def inflate_message(message):
+    return zlib.decompress(message).decode() if isinstance(message, bytes) else message
+
+def script_statements(script):
+    # Splits a migration into its statements (executescript would commit on its own);
+    # a trigger body's semicolons stay inside the statement until it is complete
+    statements, current = [], ''
+    for part in script.split(';'):
+        current += part + ';'
+        if sqlite3.complete_statement(current):
+            if current.strip(' \t\r\n;'):
+                statements.append(current.strip())
+            current = ''
+    return statements
+
+def connect_db(path, readonly=False):
+    # Statements are compiled once per connection and reused whenever the same SQL text
+    # comes back, which is why queries keep their SQL constant and pass values as parameters
+    if readonly:
+        conn = sqlite3.connect(f"file:{quote(os.path.abspath(path))}?mode=ro", uri=True,
+                               check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+    else:
+        conn = sqlite3.connect(path, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+    conn.create_function('inflate', 1, inflate_message, deterministic=True)
+    conn.create_function('deflate', 1, deflate_message, deterministic=True)
+    return conn
+
+def database_busy(error):
+    # SQLite gave up waiting (busy timeout) for a lock another connection or process holds
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in str(error) or 'busy' in str(error))
+
+class ReaderPool:
+    # Read-only connections lent out one query at a time. Under WAL each reads the last
+    # committed snapshot, so readers neither wait for the writer nor hold it up.
+    def __init__(self, path, size=DB_READERS, metrics=None):
+        self.registry = metrics or Metrics()
+        self.conns = [connect_db(path, readonly=True) for _ in range(max(1, size))]
+        self.idle = list(self.conns)  # a stack: the most recently used connection has the warmest cache
+        # A returned connection goes straight to the longest waiting thread; letting waiters
+        # race for it starves the occasional reader while busy threads take it back every time
+        self.waiters = deque()
+        self.lock = threading.Lock()
+    
+    @contextlib.contextmanager
+    def connection(self):
+        started = time.perf_counter()
+        with self.lock:
+            waiter = None if self.idle and not self.waiters else queue.SimpleQueue()
+            if waiter:
+                self.waiters.append(waiter)
+            else:
+                conn = self.idle.pop()
+        if waiter:
+            conn = waiter.get()
+        self.registry.observe('chat_db_pool_wait_seconds', time.perf_counter() - started)
+        try:
+            yield conn
+        finally:
+            with self.lock:
+                if self.waiters:
+                    self.waiters.popleft().put(conn)
+                else:
+                    self.idle.append(conn)
+    
+    def close(self):
+        for conn in self.conns:
+            conn.close()
+
+def fts_query(text, room_id=None):
+    # Turns user input into a safe FTS5 query: every word has to match the message body,
+    # a trailing * makes a word a prefix, and the search can be limited to one room
+    words = re.findall(r'\w+\*?', str(text))[:16]
+    if not words:
+        return None
+    query = 'message : (' + ' '.join(f'"{word.rstrip("*")}"' + '*' * word.endswith('*') for word in words) + ')'
+    if room_id is not None:
+        query += f' AND room_id : "{int(room_id)}"'
+    return query
+
+class HistoryCache:
+    # Ring buffer of each active room's most recent messages, so history for hot rooms
+    # is served without touching SQLite. Rooms are evicted LRU-first under a memory cap.
+    def __init__(self, capacity=MAX_HISTORY_PAGE, max_bytes=64 * 1024 * 1024):
+        self.capacity, self.max_bytes = capacity, max_bytes
+        self.rooms = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def row_size(row):
+        return len(row[1]) + len(row[2]) + 100
+    
+    def get(self, room_id, limit, before_id=None):
+        # Returns (rows, has_more) or None when the cached window cannot answer
+        with self.lock:
+            entry = self.rooms.get(room_id)
+            if entry is not None and entry['ready']:
+                rows = entry['rows']
+                if before_id is not None:
+                    rows = [row for row in rows if row[0] < before_id]
+                if len(rows) > limit or entry['complete']:
+                    self.hits += 1
+                    self.rooms.move_to_end(room_id)
+                    return list(rows)[-limit:], len(rows) > limit
+            self.misses += 1
+            return None
+    
+    def reserve(self, room_id):
+        # Start capturing appends before the room is loaded from the database
+        with self.lock:
+            if room_id not in self.rooms:
+                self.rooms[room_id] = {'rows': deque(), 'complete': False, 'ready': False, 'bytes': 0}
+    
+    def fill(self, room_id, rows, complete):
+        with self.lock:
+            entry = self.rooms.get(room_id)
+            if entry is None:
+                return  # evicted while loading; appends made meanwhile are lost, so don't cache
+            last_id = rows[-1][0] if rows else 0
+            combined = list(rows) + [row for row in entry['rows'] if row[0] > last_id]
+            if len(combined) > self.capacity:
+                combined, complete = combined[-self.capacity:], False
+            size = sum(self.row_size(row) for row in combined)
+            self.size += size - entry['bytes']
+            entry.update(rows=deque(combined), complete=complete, ready=True, bytes=size)
+            self.rooms.move_to_end(room_id)
+            self.evict()
+    
+    def append(self, room_id, row):
+        with self.lock:
+            entry = self.rooms.get(room_id)
+            if entry is None:
+                return
+            entry['rows'].append(row)
+            entry['bytes'] += self.row_size(row)
+            self.size += self.row_size(row)
+            if len(entry['rows']) > self.capacity:
+                old = entry['rows'].popleft()
+                entry['bytes'] -= self.row_size(old)
+                self.size -= self.row_size(old)
+                entry['complete'] = False
+            self.evict()
+    
+    def invalidate(self, room_id):
+        with self.lock:
+            entry = self.rooms.pop(room_id, None)
+            if entry is not None:
+                self.size -= entry['bytes']
+    
+    def evict(self):
+        while self.size > self.max_bytes and self.rooms:
+            _, entry = self.rooms.popitem(last=False)
+            self.size -= entry['bytes']
+            self.evictions += 1
+    
+    def metrics(self):
+        lookups = self.hits + self.misses
+        return {'rooms': len(self.rooms), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+class ArchivePartition:
+    # One month of archived messages: zlib-compressed JSON blocks of up to
+    # ARCHIVE_BLOCK_ROWS rows of one room, keyed by (room_id, first id)
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS blocks (room_id INTEGER, first_id INTEGER, last_id INTEGER,
+                             count INTEGER, data BLOB, PRIMARY KEY (room_id, first_id)) WITHOUT ROWID''')
+        self.conn.commit()
+        self.mtime = None
+        self.rooms = {}  # room_id -> (first archived id, last archived id)
+    
+    def refresh(self):
+        # Re-reads the room ranges when the file changed (possibly in another process)
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime != self.mtime:
+            self.mtime = mtime
+            self.rooms = {room_id: (first, last) for room_id, first, last in self.conn.execute(
+                "SELECT room_id, MIN(first_id), MAX(last_id) FROM blocks GROUP BY room_id")}
+    
+    def blocks(self, sql, params):
+        for (data,) in self.conn.execute(sql, params):
+            yield [tuple(row[:5]) for row in json.loads(zlib.decompress(data))]
+
+class MessageArchive:
+    # Messages moved out of the live database by retention, in one SQLite file per month
+    # of their creation (messages-YYYY-MM.db; messages-undated.db for rows without a time).
+    # Ids grow with time, so partitions are in id order too.
+    def __init__(self, root='archive'):
+        self.root = root
+        self.parts = {}  # partition name -> ArchivePartition
+        self.listed = None  # directory mtime at the last listing
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def partition_name(created):
+        return 'undated' if created is None else time.strftime('%Y-%m', time.localtime(created))
+    
+    def partition(self, name):
+        if name not in self.parts:
+            self.parts[name] = ArchivePartition(os.path.join(self.root, f'messages-{name}.db'))
+        return self.parts[name]
+    
+    def partitions(self, room_id):
+        # Partitions holding the room, oldest first; called with the lock held
+        try:
+            mtime = os.stat(self.root).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        if mtime != self.listed:
+            self.listed = mtime
+            for entry in os.listdir(self.root):
+                if entry.startswith('messages-') and entry.endswith('.db'):
+                    self.partition(entry[len('messages-'):-len('.db')])
+        parts = [self.parts[name] for name in sorted(self.parts, key=lambda name: (name != 'undated', name))]
+        for part in parts:
+            part.refresh()
+        return [part for part in parts if room_id in part.rooms]
+    
+    def store(self, room_id, rows):
+        # Archives rows (id, username, message, type, timestamp, created) of one room,
+        # oldest first; each partition's block is committed before this returns
+        groups = {}
+        for row in rows:
+            groups.setdefault(self.partition_name(row[5]), []).append(row)
+        stored = 0
+        with self.lock:
+            os.makedirs(self.root, exist_ok=True)
+            for name, group in groups.items():
+                part = self.partition(name)
+                with part.conn:
+                    # Rows a pass interrupted between archiving and deleting left behind are
+                    # archived already: they are skipped, and existing blocks never written over
+                    archived = {row[0] for block in part.blocks(
+                        "SELECT data FROM blocks WHERE room_id=? AND last_id>=? AND first_id<=?",
+                        (room_id, group[0][0], group[-1][0])) for row in block}
+                    group = [row for row in group if row[0] not in archived]
+                    if not group:
+                        continue
+                    data = zlib.compress(json.dumps(group).encode(), ARCHIVE_COMPRESS_LEVEL)
+                    part.conn.execute("INSERT INTO blocks VALUES (?, ?, ?, ?, ?)",
+                                      (room_id, group[0][0], group[-1][0], len(group), data))
+                stored += len(data)
+        return stored
+    
+    def history(self, room_id, limit, before_id=None, after_id=None):
+        # A room's archived rows (id, username, message, type, timestamp), oldest first:
+        # the newest `limit` before before_id, or the oldest `limit` after after_id
+        rows = []
+        with self.lock:
+            parts = self.partitions(room_id)
+            if after_id is not None:
+                for part in parts:
+                    if part.rooms[room_id][1] <= after_id:
+                        continue
+                    for block in part.blocks("SELECT data FROM blocks WHERE room_id=? AND last_id>? ORDER BY first_id",
+                                             (room_id, after_id)):
+                        rows += [row for row in block if row[0] > after_id]
+                        if len(rows) >= limit:
+                            return rows[:limit]
+                return rows
+            before_id = float('inf') if before_id is None else before_id
+            for part in reversed(parts):
+                if part.rooms[room_id][0] >= before_id:
+                    continue
+                for block in part.blocks("SELECT data FROM blocks WHERE room_id=? AND first_id<? "
+                                         "ORDER BY first_id DESC", (room_id, before_id)):
+                    rows[:0] = [row for row in block if row[0] < before_id]
+                    if len(rows) >= limit:
+                        return rows[-limit:]
+        return rows
+    
+    def max_id(self):
+        # The highest archived message id, 0 if there are none
+        with self.lock:
+            self.partitions(None)
+            return max((last for part in self.parts.values() for _, last in part.rooms.values()), default=0)
+    
+    def size(self):
+        with self.lock:
+            self.partitions(None)
+            return sum(os.path.getsize(part.path) for part in self.parts.values())
+    
+    def close(self):
+        with self.lock:
+            for part in self.parts.values():
+                part.conn.close()
+            self.parts.clear()
+            self.listed = None
 
 class ChatDatabase:
-    def __init__(self):
-        self.conn = sqlite3.connect('chat.db', check_same_thread=False)
+    def __init__(self, path='chat.db', durability='normal', batch_size=500, flush_interval=0.005,
+                 cache_bytes=64 * 1024 * 1024, shard=0, shards=1, metrics=None, archive_dir='archive',
+                 readers=DB_READERS):
+        self.synchronous, self.wait_for_commit = DURABILITY_LEVELS[durability]
+        self.registry = metrics or Metrics()
+        # In a sharded server each process owns the rooms with room_id % shards == shard
+        # and hands out the message ids congruent to its shard, so ids never collide
+        self.shard, self.shards = shard, shards
+        self.cache = HistoryCache(max_bytes=cache_bytes)
+        self.archive = MessageArchive(archive_dir)
+        # The one connection that writes, used by a single thread at a time (write_lock);
+        # queries go to the read-only pool instead
+        self.conn = connect_db(path)
+        self.write_lock = threading.RLock()
+        # Takes effect for new files only; --compact converts an existing one
+        self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(f"PRAGMA synchronous={self.synchronous}")
         self.setup_db()
+        self.readers = ReaderPool(path, readers, self.registry)
+        
+        # Write-behind pipeline: chat messages are queued and committed in batches
+        # by a dedicated writer thread
+        self.batch_size, self.flush_interval = batch_size, flush_interval
+        self.pending = queue.Queue()
+        self.id_lock = threading.Lock()
+        # Past every id committed, including ones since archived or deleted
+        self.next_id = max(self.conn.execute("SELECT MAX(id) FROM messages").fetchone()[0] or 0,
+                           self.conn.execute("SELECT high FROM message_ids").fetchone()[0],
+                           self.archive.max_id()) + 1
+        self.next_id += (shard - self.next_id) % shards
+        self.uncommitted = 0
+        self.in_flight = {}  # room_id -> its messages queued but not yet committed
+        self.commit_stats = {'commits': 0, 'rows': 0, 'total_ms': 0.0, 'last_ms': 0.0, 'max_ms': 0.0}
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
         
     def setup_db(self):
         c = self.conn.cursor()
@@ -31,154 +1004,1978 @@ class ChatDatabase:
                      message TEXT, type TEXT DEFAULT 'text', timestamp TEXT)''')
         c.execute("INSERT OR IGNORE INTO rooms (name, description) VALUES ('General', 'Main chat room')")
         self.conn.commit()
+        self.migrate()
+    
+    def migrate(self):
+        # Each step commits together with its user_version bump, so one cut short is rolled
+        # back and runs again on the next start; the version is read under the write lock,
+        # so processes starting side by side never apply the same step twice
+        while True:
+            with self.writing(immediate=True) as conn:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if version >= len(MIGRATIONS):
+                    return
+                for statement in script_statements(MIGRATIONS[version]):
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version={version + 1}")
+    
+    @contextlib.contextmanager
+    def writing(self, immediate=False):
+        # One transaction on the writer connection, committed on success and rolled back
+        # (releasing SQLite's write lock) on error. An immediate one takes SQLite's write
+        # lock up front, so what it reads can't change before it writes, even from
+        # another process.
+        with self.write_lock, self.conn:
+            if immediate:
+                self.conn.execute("BEGIN IMMEDIATE")
+            yield self.conn
     
-    def register_user(self, username, password):
+    def read(self, sql, params=()):
+        with self.readers.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+    
+    @db_timed
+    def register_user(self, username, password_hash):
         try:
-            c = self.conn.cursor()
-            hash_pwd = hashlib.sha256(password.encode()).hexdigest()
-            c.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, hash_pwd))
-            self.conn.commit()
+            with self.writing() as conn:
+                conn.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, password_hash))
             return True
         except sqlite3.IntegrityError:
             return False
     
-    def login_user(self, username, password):
-        c = self.conn.cursor()
-        hash_pwd = hashlib.sha256(password.encode()).hexdigest()
-        c.execute("SELECT id FROM users WHERE username=? AND password=?", (username, hash_pwd))
-        return c.fetchone()
+    @db_timed
+    def get_credentials(self, username):
+        # (user id, stored password hash), or None; hashing is left to the caller
+        rows = self.read("SELECT id, password FROM users WHERE username=?", (username,))
+        return rows[0] if rows else None
+    
+    @db_timed
+    def set_password(self, user_id, password_hash):
+        with self.writing() as conn:
+            conn.execute("UPDATE users SET password=? WHERE id=?", (password_hash, user_id))
     
+    @db_timed
+    def save_session(self, token, user_id, expires):
+        with self.writing() as conn:
+            conn.execute("INSERT OR REPLACE INTO sessions (token, user_id, expires) VALUES (?, ?, ?)",
+                         (token, user_id, expires))
+    
+    @db_timed
+    def load_session(self, token):
+        rows = self.read('''SELECT s.user_id, u.username, s.expires FROM sessions s
+                            JOIN users u ON u.id = s.user_id WHERE s.token=?''', (token,))
+        return rows[0] if rows else None
+    
+    @db_timed
+    def delete_session(self, token):
+        with self.writing() as conn:
+            conn.execute("DELETE FROM sessions WHERE token=?", (token,))
+    
+    def set_retention(self, room_id, max_age_days, max_messages):
+        # A room's own limits (None for no limit), used instead of the server default
+        with self.writing() as conn:
+            conn.execute("INSERT OR REPLACE INTO room_retention VALUES (?, ?, ?)",
+                         (room_id, max_age_days, max_messages))
+    
+    @db_timed
+    def get_read_cursor(self, user_id, room_id):
+        rows = self.read("SELECT last_id FROM read_cursors WHERE user_id=? AND room_id=?", (user_id, room_id))
+        return rows[0][0] if rows else None
+    
+    @db_timed
+    def save_read_cursors(self, rows):
+        # rows of (user_id, room_id, last_id); a cursor never moves back
+        with self.writing() as conn:
+            conn.executemany('''INSERT INTO read_cursors VALUES (?, ?, ?) ON CONFLICT (user_id, room_id)
+                                DO UPDATE SET last_id = max(last_id, excluded.last_id)''', rows)
+    
+    def purge_sessions(self, now):
+        with self.writing() as conn:
+            conn.execute("DELETE FROM sessions WHERE expires<?", (now,))
+    
+    @db_timed
     def get_rooms(self):
-        c = self.conn.cursor()
-        c.execute("SELECT * FROM rooms")
-        return c.fetchall()
+        return self.read("SELECT id, name, description FROM rooms")
     
-    def create_room(self, name, desc):
+    @db_timed
+    def create_room(self, name, desc, owner=None):
+        # Returns the new room's id, or None when the name is taken. Ids are never reused,
+        # so a new room can't inherit a deleted one's archived history; the highest id is
+        # read inside the write transaction, so shards creating rooms at once never pick
+        # the same one.
         try:
-            c = self.conn.cursor()
-            c.execute("INSERT INTO rooms (name, description) VALUES (?, ?)", (name, desc))
-            self.conn.commit()
-            return True
-        except sqlite3.IntegrityError:
-            return False
+            with self.writing(immediate=True) as conn:
+                room_id = conn.execute("SELECT MAX(id) FROM (SELECT MAX(id) AS id FROM rooms "
+                                       "UNION ALL SELECT MAX(room_id) FROM room_log)").fetchone()[0] or 0
+                conn.execute("INSERT INTO rooms (id, name, description, owner) VALUES (?, ?, ?, ?)",
+                             (room_id + 1, name, desc, owner))
+                conn.execute("INSERT INTO room_log (room_id, name, description) VALUES (?, ?, ?)",
+                             (room_id + 1, name, desc))
+            return room_id + 1
+        except sqlite3.IntegrityError as e:
+            if str(e) != 'UNIQUE constraint failed: rooms.name':
+                raise
+            return None
+    
+    @db_timed
+    def delete_room(self, room_id, owner):
+        # Only the room's creator may delete it; its live messages and read cursors go with it
+        if self.in_flight.get(room_id):
+            self.flush()
+        with self.writing() as conn:
+            if not conn.execute("DELETE FROM rooms WHERE id=? AND owner=?", (room_id, owner)).rowcount:
+                return False
+            conn.execute("DELETE FROM messages WHERE room_id=?", (room_id,))
+            conn.execute("DELETE FROM read_cursors WHERE room_id=?", (room_id,))
+            conn.execute("DELETE FROM room_retention WHERE room_id=?", (room_id,))
+            conn.execute("INSERT INTO room_log (room_id) VALUES (?)", (room_id,))
+        self.cache.invalidate(room_id)
+        return True
     
+    @db_timed
+    def room_log(self, after_version, to_version=None):
+        # Directory changes (version, room_id, name, description) after a version, oldest first
+        if to_version is None:
+            return self.read("SELECT version, room_id, name, description FROM room_log WHERE version>? "
+                             "ORDER BY version", (after_version,))
+        return self.read("SELECT version, room_id, name, description FROM room_log WHERE version>? AND version<=? "
+                         "ORDER BY version", (after_version, to_version))
+    
+    def room_log_version(self):
+        return self.read("SELECT MAX(version) FROM room_log")[0][0] or 0
+    
+    @db_timed
     def save_message(self, room_id, username, message, msg_type='text'):
-        c = self.conn.cursor()
-        timestamp = datetime.now().strftime('%H:%M:%S')
-        c.execute("INSERT INTO messages (room_id, username, message, type, timestamp) VALUES (?, ?, ?, ?, ?)",
-                 (room_id, username, message, msg_type, timestamp))
-        self.conn.commit()
+        msg_id, done = self.queue_message(room_id, username, message, msg_type)
+        if done:
+            done.result()  # raises the sqlite3.Error if the message couldn't be committed
+        return msg_id
     
-    def get_history(self, room_id, limit=50):
-        c = self.conn.cursor()
-        c.execute("SELECT username, message, type, timestamp FROM messages WHERE room_id=? ORDER BY id DESC LIMIT ?",
-                 (room_id, limit))
-        return c.fetchall()[::-1]
+    def queue_message(self, room_id, username, message, msg_type='text'):
+        # Ids are handed out here so callers know them before the row is committed. Returns
+        # (id, Future resolved once it is committed), the Future being None unless the
+        # durability level waits for commits.
+        created = time.time()
+        timestamp = datetime.fromtimestamp(created).strftime('%H:%M:%S')
+        with self.id_lock:
+            msg_id = self.next_id
+            self.next_id += self.shards
+            self.uncommitted += 1
+            self.in_flight[room_id] = self.in_flight.get(room_id, 0) + 1
+            row = (msg_id, room_id, username, message, msg_type, timestamp, created)
+            self.cache.append(room_id, (msg_id, username, message, msg_type, timestamp))
+        done = Future() if self.wait_for_commit else None
+        self.pending.put((row, done))
+        return msg_id, done
+    
+    def write_loop(self):
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self.pending.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            stopping = batch[-1] is None
+            if stopping:
+                batch.pop()
+            self.commit_batch(batch)
+            if stopping:
+                return
+    
+    def commit_batch(self, batch):
+        rows = [row for row, _ in batch if row is not None]
+        error = None
+        if rows:
+            started = time.perf_counter()
+            error = self.insert_messages(rows)
+            if error:
+                # The cache already holds these messages; drop their rooms so history is
+                # read back from what was actually committed
+                print(f"Failed to persist {len(rows)} messages: {error}")
+                self.registry.inc('chat_db_rows_lost_total', len(rows))
+                for room_id in {row[1] for row in rows}:
+                    self.cache.invalidate(room_id)
+            else:
+                self.registry.inc('chat_db_rows_committed_total', len(rows))
+            elapsed = (time.perf_counter() - started) * 1000
+            self.registry.observe('chat_db_commit_seconds', elapsed / 1000)
+            stats = self.commit_stats
+            stats['commits'] += 1
+            stats['rows'] += len(rows)
+            stats['total_ms'] += elapsed
+            stats['last_ms'] = elapsed
+            stats['max_ms'] = max(stats['max_ms'], elapsed)
+            with self.id_lock:
+                self.uncommitted -= len(rows)
+                for row in rows:
+                    left = self.in_flight.pop(row[1]) - 1
+                    if left:
+                        self.in_flight[row[1]] = left
+        for row, done in batch:
+            if done and error and row is not None:
+                done.set_exception(error)
+            elif done:
+                done.set_result(None)
+    
+    def insert_messages(self, rows):
+        # Returns None once the rows are committed, else the error. Busy or locked means
+        # another process (a sharded worker, --compact) holds SQLite's write lock past the
+        # busy timeout, so that is waited out with backoff; anything else won't succeed on
+        # a retry. Rows for a room removed since they were queued (by any shard: room ids
+        # are never reused) are dropped, as if they had been deleted with it.
+        deadline = time.monotonic() + WRITE_RETRY_SECONDS
+        delay = 0.01
+        while True:
+            try:
+                with self.writing(immediate=True) as conn:
+                    removed = {room_id for room_id in {row[1] for row in rows}
+                               if conn.execute("SELECT 1 FROM room_log WHERE room_id=? AND name IS NULL",
+                                               (room_id,)).fetchone()}
+                    conn.executemany(
+                        "INSERT INTO messages (id, room_id, username, message, type, timestamp, created) "
+                        "VALUES (?, ?, ?, deflate(?), ?, ?, ?)",
+                        [row for row in rows if row[1] not in removed] if removed else rows)
+                    conn.execute("UPDATE message_ids SET high=max(high, ?)", (max(row[0] for row in rows),))
+                if removed:
+                    self.registry.inc('chat_db_rows_dropped_total', sum(row[1] in removed for row in rows))
+                    for room_id in removed:
+                        self.cache.invalidate(room_id)
+                return None
+            except sqlite3.OperationalError as e:
+                if not database_busy(e) or time.monotonic() + delay > deadline:
+                    return e
+                self.registry.inc('chat_db_commit_retries_total')
+            except sqlite3.Error as e:
+                return e
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+    
+    def flush(self):
+        # Blocks until everything queued so far is committed (or has failed to be)
+        if not self.writer.is_alive():
+            return
+        done = Future()
+        self.pending.put((None, done))
+        done.result()
+    
+    def metrics(self):
+        stats = dict(self.commit_stats)
+        stats['queue_depth'] = self.pending.qsize()
+        stats['avg_ms'] = stats['total_ms'] / stats['commits'] if stats['commits'] else 0.0
+        stats['avg_batch'] = stats['rows'] / stats['commits'] if stats['commits'] else 0.0
+        return stats
+    
+    def close(self):
+        if self.writer.is_alive():
+            self.pending.put(None)
+            self.writer.join()
+        self.readers.close()
+        self.conn.close()
+        self.archive.close()
+    
+    def owns(self, room_id):
+        return room_id % self.shards == self.shard
+    
+    def get_history(self, room_id, limit=50, before_id=None, after_id=None):
+        # Recent pages come from the in-memory cache; a miss on the latest page loads
+        # the room's window into it. Only rooms this shard writes can be cached.
+        if after_id is None and self.owns(room_id):
+            cached = self.cache.get(room_id, limit, before_id)
+            if cached is not None:
+                return cached
+            if before_id is None and limit <= self.cache.capacity:
+                self.cache.reserve(room_id)
+                rows, has_more = self.query_history(room_id, self.cache.capacity)
+                self.cache.fill(room_id, rows, not has_more)
+                return rows[-limit:], len(rows) > limit or has_more
+        return self.query_history(room_id, limit, before_id, after_id)
+    
+    @db_timed
+    def search(self, query, room_id=None, limit=20, order='rank', offset=0, before_id=None):
+        # Full-text search over text messages, best match first ('rank', paged by offset)
+        # or newest first ('recent', paged by before_id). Returns (rows, has_more) with
+        # rows (id, room_id, username, snippet, timestamp).
+        match = fts_query(query, room_id)
+        if match is None:
+            return [], False
+        if self.uncommitted:
+            self.flush()
+        snippet = "snippet(messages_fts, 0, ?, ?, '…', 12)"
+        if order == 'recent':
+            where = "messages_fts MATCH ?" + (" AND rowid < ?" if before_id is not None else "")
+            inner = f"SELECT rowid, {snippet} AS snip FROM messages_fts WHERE {where} ORDER BY rowid DESC LIMIT ?"
+            params = (*SNIPPET_MARKS, match, *(() if before_id is None else (before_id,)), limit + 1)
+            outer = "ORDER BY f.rowid DESC"
+        else:
+            # Scoring every match of a very common term takes far too long, so relevance is
+            # judged among the newest SEARCH_RANK_WINDOW matches (a cheap rowid range)
+            floor = self.read("SELECT rowid FROM messages_fts WHERE messages_fts MATCH ? "
+                              "ORDER BY rowid DESC LIMIT 1 OFFSET ?", (match, SEARCH_RANK_WINDOW))
+            floor = floor and floor[0]
+            where = "messages_fts MATCH ?" + (" AND rowid > ?" if floor else "")
+            inner = f"SELECT rowid, {snippet} AS snip, rank FROM messages_fts WHERE {where} ORDER BY rank LIMIT ? OFFSET ?"
+            params = (*SNIPPET_MARKS, match, *(floor or ()), limit + 1, offset)
+            outer = "ORDER BY f.rank"
+        # Rank and page inside the FTS index first, then fetch only that page's rows
+        rows = self.read(f'''SELECT m.id, m.room_id, m.username, f.snip, m.timestamp
+                            FROM ({inner}) f JOIN messages m ON m.id = f.rowid {outer}''', params)
+        return rows[:limit], len(rows) > limit
+    
+    @db_timed
+    def query_history(self, room_id, limit=50, before_id=None, after_id=None):
+        # Keyset pagination over the (room_id, id) index: before_id pages back from
+        # the newest message, after_id pages forward. Returns (rows, has_more), oldest first.
+        if self.in_flight.get(room_id):
+            self.flush()  # read-your-writes for this room's messages still in the write-behind pipeline
+        columns = "SELECT id, username, inflate(message), type, timestamp FROM messages"
+        # Archived messages are older than every live one, so they come before live rows
+        # going forward and continue where the live rows run out going back
+        if after_id is not None:
+            rows = self.archive.history(room_id, limit + 1, after_id=after_id)
+            if len(rows) <= limit:
+                rows += self.read(f"{columns} WHERE room_id=? AND id>? ORDER BY id LIMIT ?",
+                                  (room_id, rows[-1][0] if rows else after_id, limit + 1 - len(rows)))
+            return rows[:limit], len(rows) > limit
+        if before_id is not None:
+            rows = self.read(f"{columns} WHERE room_id=? AND id<? ORDER BY id DESC LIMIT ?",
+                             (room_id, before_id, limit + 1))
+        else:
+            rows = self.read(f"{columns} WHERE room_id=? ORDER BY id DESC LIMIT ?", (room_id, limit + 1))
+        if len(rows) <= limit:
+            older = self.archive.history(room_id, limit + 1 - len(rows), rows[-1][0] if rows else before_id)
+            rows += older[::-1]
+        return rows[:limit][::-1], len(rows) > limit
+
+class SessionStore:
+    # Issued session tokens are persisted (hashed) in the database and the ones in use are
+    # cached in memory, so resuming a session normally costs no query and no password hash
+    def __init__(self, db, ttl=SESSION_TTL, capacity=SESSION_CACHE_SIZE):
+        self.db = db
+        self.ttl = ttl
+        self.capacity = capacity
+        self.cache = OrderedDict()  # token hash -> session dict
+        self.lock = threading.Lock()
+        db.purge_sessions(time.time())
+    
+    def issue(self, user_id, username):
+        token = secrets.token_urlsafe(32)
+        session = {'user_id': user_id, 'username': username, 'expires': time.time() + self.ttl, 'rooms': []}
+        self.db.save_session(token_key(token), user_id, session['expires'])
+        self.remember(token_key(token), session)
+        return token, session
+    
+    def remember(self, key, session):
+        with self.lock:
+            self.cache[key] = session
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+    
+    def lookup(self, token):
+        # Returns the session for a valid, unexpired token and extends its lifetime
+        if not isinstance(token, str):
+            return None
+        key = token_key(token)
+        with self.lock:
+            session = self.cache.get(key)
+        if session is None:
+            row = self.db.load_session(key)
+            if row is None:
+                return None
+            session = {'user_id': row[0], 'username': row[1], 'expires': row[2], 'rooms': []}
+        now = time.time()
+        if session['expires'] < now:
+            self.revoke(token)
+            return None
+        # Only write the new expiry back once a meaningful part of the TTL has passed
+        if session['expires'] - now < self.ttl * 0.9:
+            session['expires'] = now + self.ttl
+            self.db.save_session(key, session['user_id'], session['expires'])
+        self.remember(key, session)
+        return session
+    
+    def username(self, token):
+        # Whose session a token is, without touching its expiry; None if it isn't one
+        if not isinstance(token, str):
+            return None
+        key = token_key(token)
+        with self.lock:
+            session = self.cache.get(key)
+        if session is not None:
+            return session['username']
+        row = self.db.load_session(key)
+        return row and row[1]
+    
+    def revoke(self, token):
+        key = token_key(token)
+        with self.lock:
+            self.cache.pop(key, None)
+        self.db.delete_session(key)
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+    
+    def __init__(self, rate, burst, now):
+        self.rate, self.burst = rate, burst
+        self.tokens, self.stamp = float(burst), now
+    
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+def parse_rate_limits(specs):
+    # --rate-limit TYPE=RATE/BURST (room:TYPE=... for a room limit, peer:TYPE=... for an
+    # IP address one, TYPE=off to drop one) on top of the defaults; a bare 'off' drops
+    # every limit given before it
+    limits, room_limits, peer_limits = dict(RATE_LIMITS), dict(ROOM_RATE_LIMITS), dict(PEER_RATE_LIMITS)
+    for spec in specs or ():
+        if spec == 'off':
+            limits, room_limits, peer_limits = {}, {}, {}
+            continue
+        name, _, value = spec.partition('=')
+        scope, _, name = name.rpartition(':')
+        target = {'room': room_limits, 'peer': peer_limits}.get(scope, limits)
+        if value == 'off':
+            target.pop(name, None)
+            continue
+        rate, _, burst = value.partition('/')
+        if float(rate) <= 0:
+            raise ValueError(f"Rate limit for {name!r} must be positive")
+        target[name] = (float(rate), float(burst or rate))
+    return limits, room_limits, peer_limits
+
+class RateLimiter:
+    # Token buckets per (request type, user), per (request type, room) and per (request
+    # type, IP address), created on first use and swept once they have been idle long
+    # enough to be full again
+    def __init__(self, limits=RATE_LIMITS, room_limits=ROOM_RATE_LIMITS, peer_limits=PEER_RATE_LIMITS,
+                 sweep_interval=60):
+        self.limits, self.room_limits, self.peer_limits = limits, room_limits, peer_limits
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.sweep_interval = sweep_interval
+        self.next_sweep = time.monotonic() + sweep_interval
+    
+    def bucket(self, key, limit, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(*limit, now)
+        else:
+            bucket.refill(now)
+        return bucket
+    
+    def check(self, msg_type, user, room_id=None, peer=None):
+        # Takes a token from every bucket the request counts against, or from none of them
+        # (a None user, room or peer counts against none). Returns None if the request may
+        # go ahead, else (scope, seconds until it could).
+        limit, room_limit = self.limits.get(msg_type), self.room_limits.get(msg_type)
+        peer_limit = self.peer_limits.get(msg_type)
+        if not limit and not room_limit and not peer_limit:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            if now >= self.next_sweep:
+                self.sweep(now)
+            buckets = []
+            if limit and user is not None:
+                buckets.append(('user', self.bucket((msg_type, 'user', user), limit, now)))
+            if room_limit and room_id is not None:
+                buckets.append(('room', self.bucket((msg_type, 'room', room_id), room_limit, now)))
+            if peer_limit and peer is not None:
+                buckets.append(('peer', self.bucket((msg_type, 'peer', peer), peer_limit, now)))
+            for scope, bucket in buckets:
+                if bucket.tokens < 1:
+                    return scope, (1 - bucket.tokens) / bucket.rate
+            for scope, bucket in buckets:
+                bucket.tokens -= 1
+        return None
+    
+    def sweep(self, now):
+        self.next_sweep = now + self.sweep_interval
+        full = [key for key, b in self.buckets.items() if b.tokens + (now - b.stamp) * b.rate >= b.burst]
+        for key in full:
+            del self.buckets[key]
+
+class RetentionEngine:
+    # Enforces the rooms' age and count limits in the background. A room's oldest messages
+    # move to the archive ARCHIVE_BLOCK_ROWS at a time, each batch deleted in its own short
+    # transaction, and the pages that frees go back to the file system a step at a time
+    # with incremental VACUUM, so live writes only ever wait for one small transaction.
+    # Those transactions go through the database's one writer connection like every other
+    # write; what to archive is read from the reader pool.
+    def __init__(self, db, default=(None, None), interval=RETENTION_INTERVAL, metrics=None, pause=0.01):
+        self.db, self.archive = db, db.archive
+        self.default = default  # (max age in days, max messages) for rooms without limits of their own
+        self.interval, self.pause = interval, pause
+        self.registry = metrics or Metrics()
+        self.stopping = threading.Event()
+        self.warned = False
+        self.thread = None
+    
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True, name='retention')
+        self.thread.start()
+    
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.run_once()
+            except sqlite3.Error as e:
+                print(f"Retention pass failed: {e}")
+    
+    def run_once(self):
+        # One pass over every room; returns (messages archived, pages freed)
+        started = time.perf_counter()
+        moved = 0
+        for room_id, max_age, max_messages in self.policies():
+            if self.stopping.is_set():
+                break
+            moved += self.enforce(room_id, max_age, max_messages)
+        freed = self.vacuum()
+        self.registry.observe('chat_retention_pass_seconds', time.perf_counter() - started)
+        self.registry.inc('chat_retention_archived_total', moved)
+        self.registry.inc('chat_vacuum_pages_total', freed)
+        return moved, freed
+    
+    def policies(self):
+        db = self.db
+        overrides = {room_id: (max_age, max_messages) for room_id, max_age, max_messages
+                     in db.read("SELECT room_id, max_age_days, max_messages FROM room_retention")}
+        # Rooms with messages, one index seek each (rooms needn't exist in the rooms table)
+        room_id = db.read("SELECT MIN(room_id) FROM messages")[0][0]
+        while room_id is not None:
+            policy = overrides.get(room_id, self.default)
+            if policy != (None, None):
+                yield (room_id, *policy)
+            room_id = db.read("SELECT MIN(room_id) FROM messages WHERE room_id>?", (room_id,))[0][0]
+    
+    def enforce(self, room_id, max_age, max_messages):
+        # Archives the room's messages beyond its limits, oldest first; returns how many
+        age_cutoff = time.time() - max_age * 86400 if max_age is not None else None
+        count_cutoff = None
+        if max_messages is not None:
+            row = self.db.read("SELECT id FROM messages WHERE room_id=? ORDER BY id DESC LIMIT 1 OFFSET ?",
+                               (room_id, max_messages))
+            count_cutoff = row[0][0] if row else None
+        moved = 0
+        while not self.stopping.is_set():
+            rows = self.db.read("SELECT id, username, inflate(message), type, timestamp, created FROM messages "
+                                "WHERE room_id=? ORDER BY id LIMIT ?", (room_id, ARCHIVE_BLOCK_ROWS))
+            expired = 0
+            for msg_id, *_, created in rows:
+                if not ((count_cutoff is not None and msg_id <= count_cutoff)
+                        or (age_cutoff is not None and (created is None or created <= age_cutoff))):
+                    break
+                expired += 1
+            if not expired:
+                break
+            # Archived (and durable) first, so a crash in between leaves a copy, not a gap
+            self.archive.store(room_id, rows[:expired])
+            with self.db.writing() as conn:
+                conn.execute("DELETE FROM messages WHERE room_id=? AND id BETWEEN ? AND ?",
+                             (room_id, rows[0][0], rows[expired - 1][0]))
+            moved += expired
+            time.sleep(self.pause)  # let the writer thread in between batches
+        return moved
+    
+    def vacuum(self):
+        db = self.db
+        if db.read("PRAGMA auto_vacuum")[0][0] != 2:
+            if not self.warned and db.read("PRAGMA freelist_count")[0][0]:
+                print("Database doesn't use incremental vacuum; run --compact once to reclaim space")
+                self.warned = True
+            return 0
+        freed = 0
+        while not self.stopping.is_set():
+            step = min(VACUUM_STEP_PAGES, db.read("PRAGMA freelist_count")[0][0])
+            if not step:
+                break
+            # executescript steps the pragma to completion; execute() frees a single page
+            with db.writing() as conn:
+                conn.executescript(f"PRAGMA incremental_vacuum({step})")
+            freed += step
+            time.sleep(self.pause)
+        if freed:
+            with db.writing() as conn:
+                conn.execute("PRAGMA wal_checkpoint(PASSIVE)")  # the file shrinks once the WAL is copied back
+        return freed
+    
+    def stop(self):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+
+class RoomActivity:
+    # Presence, typing and read cursors of the users in each room. Events only update this
+    # state and mark who changed; flush() then yields each room's net change since the last
+    # flush, so a burst of events becomes one delta per room instead of one per event.
+    def __init__(self):
+        self.online = {}   # room_id -> {username: connections in the room}
+        self.typing = {}   # room_id -> {username: monotonic time the indicator lapses}
+        self.reads = {}    # room_id -> {username: last read message id}, for users in the room
+        self.shown = {}    # room_id -> {kind: {username: value}} as of the last delta
+        self.dirty = {}    # room_id -> {kind: usernames changed since the last flush}
+        self.unsaved = {}  # (user_id, room_id) -> read cursor not yet in the database
+        # Sharded server: who is online in each room on the other shards, and the
+        # (room_id, username, online) comings and goings here not yet sent to them
+        self.remote = {}   # room_id -> {username: other shards the user is online on}
+        self.moves = None  # a list when there are other shards
+        self.lock = threading.Lock()
+    
+    def mark(self, room_id, kind, username):
+        self.dirty.setdefault(room_id, {}).setdefault(kind, set()).add(username)
+    
+    def join(self, room_id, username, cursor=None):
+        with self.lock:
+            members = self.online.setdefault(room_id, {})
+            members[username] = members.get(username, 0) + 1
+            if members[username] == 1 and self.moves is not None:
+                self.moves.append((room_id, username, True))
+            self.mark(room_id, 'presence', username)
+            reads = self.reads.setdefault(room_id, {})
+            if cursor is not None and cursor > reads.get(username, 0):
+                reads[username] = cursor
+                self.mark(room_id, 'read', username)
+    
+    def leave(self, room_id, username):
+        with self.lock:
+            members = self.online.get(room_id, {})
+            if members.get(username, 0) > 1:
+                members[username] -= 1
+                return
+            if members.pop(username, None) and self.moves is not None:
+                self.moves.append((room_id, username, False))
+            if not members:
+                self.online.pop(room_id, None)
+            self.typing.get(room_id, {}).pop(username, None)
+            self.reads.get(room_id, {}).pop(username, None)
+            for kind in ('presence', 'typing', 'read'):
+                self.mark(room_id, kind, username)
+    
+    def set_typing(self, room_id, username, active, now):
+        with self.lock:
+            typers = self.typing.setdefault(room_id, {})
+            if active:
+                typers[username] = now + TYPING_TIMEOUT
+            elif typers.pop(username, None) is None:
+                return
+            self.mark(room_id, 'typing', username)
+    
+    def set_read(self, room_id, user_id, username, last_id):
+        with self.lock:
+            reads = self.reads.setdefault(room_id, {})
+            if last_id <= reads.get(username, 0):
+                return
+            reads[username] = last_id
+            self.unsaved[(user_id, room_id)] = last_id
+            self.mark(room_id, 'read', username)
+    
+    def set_remote(self, shard, changes):
+        # Applies another shard's (room_id, username, online) changes
+        with self.lock:
+            for room_id, username, online in changes:
+                members = self.remote.setdefault(room_id, {})
+                shards = members.setdefault(username, set())
+                if online:
+                    shards.add(shard)
+                else:
+                    shards.discard(shard)
+                    if not shards:
+                        del members[username]
+                    if not members:
+                        del self.remote[room_id]
+                self.mark(room_id, 'presence', username)
+    
+    def drop_remote(self, shard):
+        # A shard went away, and everyone who was online on it with it
+        with self.lock:
+            changes = [(room_id, username, False) for room_id, members in self.remote.items()
+                       for username, shards in members.items() if shard in shards]
+        self.set_remote(shard, changes)
+    
+    def local_presence(self):
+        with self.lock:
+            return [(room_id, username, True) for room_id, members in self.online.items() for username in members]
+    
+    def take_moves(self):
+        with self.lock:
+            moves, self.moves = self.moves, []
+        return moves
+    
+    def value(self, room_id, kind, username):
+        if kind == 'presence':
+            online = username in self.online.get(room_id, ()) or username in self.remote.get(room_id, ())
+            return 'online' if online else None
+        if kind == 'typing':
+            return True if username in self.typing.get(room_id, ()) else None
+        return self.reads.get(room_id, {}).get(username)
+    
+    def snapshot(self, room_id):
+        with self.lock:
+            return {'presence': dict.fromkeys([*self.online.get(room_id, ()), *self.remote.get(room_id, ())],
+                                              'online'),
+                    'typing': dict.fromkeys(self.typing.get(room_id, ()), True),
+                    'read': dict(self.reads.get(room_id, {}))}
+    
+    def flush(self, now):
+        # [(room_id, delta)] with delta {kind: {username: value or None for gone}}. Someone
+        # who started and stopped typing in between, or left and came back, isn't in it.
+        with self.lock:
+            for room_id, typers in list(self.typing.items()):
+                for username in [name for name, lapses in typers.items() if lapses <= now]:
+                    del typers[username]
+                    self.mark(room_id, 'typing', username)
+                if not typers:
+                    del self.typing[room_id]
+            deltas = []
+            for room_id, kinds in self.dirty.items():
+                shown = self.shown.setdefault(room_id, {'presence': {}, 'typing': {}, 'read': {}})
+                delta = {}
+                for kind, usernames in kinds.items():
+                    for username in usernames:
+                        value = self.value(room_id, kind, username)
+                        if shown[kind].get(username) != value:
+                            delta.setdefault(kind, {})[username] = value
+                            if value is None:
+                                del shown[kind][username]
+                            else:
+                                shown[kind][username] = value
+                if delta:
+                    deltas.append((room_id, delta))
+                if room_id not in self.online:
+                    self.reads.pop(room_id, None)
+                    if room_id not in self.remote:
+                        self.shown.pop(room_id, None)
+            self.dirty.clear()
+            return deltas
+    
+    def take_unsaved(self):
+        with self.lock:
+            rows = [(user_id, room_id, last_id) for (user_id, room_id), last_id in self.unsaved.items()]
+            self.unsaved.clear()
+        return rows
+
+class RoomIndex:
+    # room_id -> {connection id: connection} plus the reverse connection id -> room_ids,
+    # so join, leave and disconnect are O(1) per room and a client can be in many rooms
+    # on_open / on_close are called when a room gets its first member or loses its last one
+    def __init__(self, on_open=None, on_close=None):
+        self.members = {}
+        self.memberships = {}
+        self.lock = threading.Lock()
+        self.on_open, self.on_close = on_open, on_close
+    
+    def join(self, room_id, client):
+        with self.lock:
+            opened = room_id not in self.members
+            room = self.members.setdefault(room_id, {})
+            joined = client.id not in room
+            room[client.id] = client
+            self.memberships.setdefault(client.id, set()).add(room_id)
+        if opened and self.on_open:
+            self.on_open(room_id)
+        return joined
+    
+    def leave(self, room_id, client):
+        with self.lock:
+            closed = self._remove(room_id, client.id)
+            rooms = self.memberships.get(client.id)
+            if rooms is not None:
+                rooms.discard(room_id)
+                if not rooms:
+                    del self.memberships[client.id]
+        if closed and self.on_close:
+            self.on_close(room_id)
+    
+    def leave_all(self, client):
+        with self.lock:
+            rooms = self.memberships.pop(client.id, set())
+            closed = [room_id for room_id in rooms if self._remove(room_id, client.id)]
+        if self.on_close:
+            for room_id in closed:
+                self.on_close(room_id)
+        return rooms
+    
+    def _remove(self, room_id, conn_id):
+        room = self.members.get(room_id)
+        if room is not None:
+            room.pop(conn_id, None)
+            if not room:
+                del self.members[room_id]
+                return True
+        return False
+    
+    def members_of(self, room_id):
+        # Snapshot, so callers can iterate while others join or leave
+        with self.lock:
+            return list(self.members.get(room_id, {}).values())
+    
+    def rooms_of(self, client):
+        with self.lock:
+            return set(self.memberships.get(client.id, ()))
+    
+    def is_member(self, room_id, client):
+        return client.id in self.members.get(room_id, {})
+    
+    def count(self, room_id):
+        return len(self.members.get(room_id, {}))
+
+class RoomDirectory:
+    # The rooms table kept in memory, sorted by case-folded name for prefix search and keyset
+    # paging, so listing rooms costs no query. Its version is the last room_log entry applied;
+    # every worker of a sharded server reads the same log, so versions agree between them.
+    def __init__(self):
+        self.rooms = {}  # room_id -> (name, description)
+        self.names = []  # sorted (case-folded name, name, room_id)
+        self.version = 0
+        self.subscribers = {}  # connection id -> connection, pushed every change
+        self.lock = threading.RLock()
+    
+    def load(self, rooms, version):
+        with self.lock:
+            self.rooms = {room_id: (name, desc) for room_id, name, desc in rooms}
+            self.names = sorted((name.casefold(), name, room_id) for room_id, (name, _) in self.rooms.items())
+            self.version = version
+    
+    def apply(self, version, room_id, name, desc):
+        # A log entry with a name adds (or replaces) the room, one without removes it
+        with self.lock:
+            self.version = max(self.version, version)
+            old = self.rooms.pop(room_id, None)
+            if old is not None:
+                del self.names[bisect.bisect_left(self.names, (old[0].casefold(), old[0], room_id))]
+            if name is not None:
+                self.rooms[room_id] = (name, desc)
+                bisect.insort(self.names, (name.casefold(), name, room_id))
+    
+    def page(self, prefix='', after=None, limit=ROOM_PAGE_SIZE):
+        # Rooms whose name starts with prefix (ignoring case) in name order, continuing after
+        # the room named `after`. Returns ([(room_id, name, description), ...], has_more).
+        prefix = prefix.casefold()
+        with self.lock:
+            start = bisect.bisect_left(self.names, (prefix,))
+            if after is not None:
+                start = max(start, bisect.bisect_right(self.names, (after.casefold(), after, sys.maxsize)))
+            rows = []
+            for key, name, room_id in self.names[start:start + limit + 1]:
+                if not key.startswith(prefix):
+                    break
+                rows.append((room_id, name, self.rooms[room_id][1]))
+        return rows[:limit], len(rows) > limit
 
 class ChatServer:
-    def __init__(self, host='localhost', port=12345):
+    def __init__(self, host='localhost', port=12345, backlog=128, db_path='chat.db', durability='normal',
+                 blob_dir='attachments', kdf_iterations=KDF_ITERATIONS, session_ttl=SESSION_TTL,
+                 shard=0, shards=1, metrics_port=None, rate_limits=RATE_LIMITS, room_rate_limits=ROOM_RATE_LIMITS,
+                 archive_dir='archive', retention=(None, None), retention_interval=RETENTION_INTERVAL,
+                 activity_interval=ACTIVITY_INTERVAL, db_readers=DB_READERS, trace_path=None,
+                 peer_rate_limits=PEER_RATE_LIMITS):
         self.host, self.port = host, port
+        self.backlog = backlog
         self.clients = {}
-        self.rooms = {}
-        self.db = ChatDatabase()
+        self.connections = {}  # connection id -> connection, authenticated or not
+        self.rooms = RoomIndex()
+        self.activity = RoomActivity()
+        self.activity_interval = activity_interval
+        self.running = True
+        self.metrics = Metrics()
+        self.metrics.collectors.append(self.collect_metrics)
+        self.endpoint = MetricsEndpoint(self.metrics, metrics_port) if metrics_port else None
+        self.db = ChatDatabase(db_path, durability, shard=shard, shards=shards, metrics=self.metrics,
+                               archive_dir=archive_dir, readers=db_readers)
+        # Retention runs in one process only (shard 0 of a sharded server)
+        self.retention = None
+        if shard == 0:
+            self.retention = RetentionEngine(self.db, retention, retention_interval, self.metrics)
+            self.retention.start()
+        self.directory = RoomDirectory()
+        version = self.db.room_log_version()
+        self.directory.load(self.db.get_rooms(), version)
+        self.blobs = BlobStore(blob_dir)
+        self.thumbnails = Thumbnailer(self.blobs)
+        self.sessions = SessionStore(self.db, session_ttl)
+        self.trace = TraceWriter(trace_path, self.sessions) if trace_path else None
+        self.limiter = (RateLimiter(rate_limits, room_rate_limits, peer_rate_limits)
+                        if rate_limits or room_rate_limits or peer_rate_limits else None)
+        # Password hashing is deliberately slow, so it runs on its own pool (PBKDF2 releases
+        # the GIL) and its result is dispatched back like a finished thumbnail
+        self.kdf_iterations = kdf_iterations
+        self.kdf_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 2, thread_name_prefix='kdf')
+        self.dummy_hash = hash_password(secrets.token_hex(8), kdf_iterations)  # for unknown usernames
         
     def start(self):
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server.bind((self.host, self.port))
-        self.server.listen(5)
+        self.server.listen(self.backlog)
         print(f"Server running on {self.host}:{self.port}")
+        self.start_ticker()
         
         while True:
             try:
-                client, addr = self.server.accept()
+                sock, addr = self.server.accept()
+                client = SocketConnection(sock)
                 threading.Thread(target=self.handle_client, args=(client,), daemon=True).start()
             except:
                 break
     
     def handle_client(self, client):
+        decoder = FrameDecoder()
+        self.connections[client.id] = client
+        if self.trace:
+            self.trace.record(client.id, TRACE_OPEN)
         try:
             while True:
-                data = client.recv(4096).decode()
+                if client.queued_bytes > INBOUND_PAUSE_BYTES:
+                    # The client isn't reading its replies: stop reading its requests
+                    self.metrics.inc('chat_inbound_paused_total', reason='queue')
+                    client.wait_writable(INBOUND_PAUSE_BYTES // 2)
+                delay = client.paused_until - time.monotonic()
+                if delay > 0:
+                    self.metrics.inc('chat_inbound_paused_total', reason='rate')
+                    time.sleep(delay)
+                data = client.sock.recv(65536)
                 if not data:
                     break
-                msg = json.loads(data)
-                self.process_message(client, msg)
+                self.metrics.inc('chat_bytes_in_total', len(data))
+                for msg in decoder.feed(data):
+                    self.process_message(client, msg)
         except:
             pass
         finally:
             self.disconnect_client(client)
     
+    def send(self, client, msg, data=None):
+        frame = encode_frame(msg, data, client.codec)
+        self.metrics.inc('chat_bytes_out_total', len(frame))
+        client.send(frame)
+    
+    def dispatch(self, callback):
+        # Runs work finished on another thread (e.g. the thumbnail pool) in the context
+        # process_message runs in; handler threads can simply call it
+        callback()
+    
+    def run_db(self, client, callback, fn, *args):
+        # A call that can block (a database query or write, blob file I/O), its result
+        # handed to callback (if any); a handler thread can just wait. client is who the
+        # call is for, None if no one; a busy database gets it an 'error' to retry on.
+        try:
+            result = fn(*args)
+        except Exception as e:
+            if client is None or not database_busy(e):
+                raise
+            self.metrics.inc('chat_errors_total', type=getattr(fn, '__name__', 'db'))
+            self.send(client, {'type': 'error', 'reason': "Server busy, please retry"})
+            return
+        if callback:
+            callback(result)
+    
+    def start_ticker(self):
+        # Periodic work, dispatched into the message-handling context: coalesced room
+        # activity deltas and lazily saved read cursors (and pushing out the trace buffer)
+        def tick():
+            interval = self.activity_interval or 1.0  # typing still lapses without coalescing
+            next_save = time.monotonic() + READ_SAVE_INTERVAL
+            while True:
+                time.sleep(interval)
+                if not self.running:
+                    return
+                if self.trace:
+                    self.trace.flush()
+                try:
+                    self.dispatch(self.publish_activity)
+                    if time.monotonic() >= next_save:
+                        next_save += READ_SAVE_INTERVAL
+                        self.save_read_cursors()  # a database write: here, not in the loop
+                except RuntimeError:
+                    return  # the event loop has shut down
+        threading.Thread(target=tick, daemon=True, name='ticker').start()
+    
+    def publish_activity(self):
+        if not self.running:
+            return
+        for room_id, delta in self.activity.flush(time.monotonic()):
+            self.broadcast(room_id, {'type': 'room_activity', 'room_id': room_id, **delta})
+            self.metrics.inc('chat_activity_deltas_total')
+    
+    def activity_changed(self):
+        if not self.activity_interval:
+            self.publish_activity()  # uncoalesced: every event goes out at once
+    
+    def save_read_cursors(self):
+        rows = self.activity.take_unsaved()
+        if rows:
+            self.db.save_read_cursors(rows)
+    
+    def enter_room(self, client, room_id):
+        # Presence for a newly joined room, and the room's current activity for the client
+        info = self.clients[client]
+        
+        def entered(cursor):
+            if not self.rooms.is_member(room_id, client):
+                return  # gone again (the room removed, the client disconnected) meanwhile
+            self.activity.join(room_id, info['username'], cursor)
+            self.send(client, {'type': 'room_activity', 'room_id': room_id, 'snapshot': True,
+                               **self.activity.snapshot(room_id)})
+            self.activity_changed()
+        self.run_db(client, entered, self.db.get_read_cursor, info['user_id'], room_id)
+    
+    def list_rooms(self, client, msg):
+        # A page of the directory ('prefix', 'after' the last name seen, 'limit'), or every
+        # room when no limit is given. A client that has a listing at version 'since' gets
+        # just the changes after it instead. With 'subscribe' every later change is pushed
+        # as room_added / room_removed, in version order, after this reply.
+        since, version = msg.get('since'), self.directory.version
+        if since is not None and int(since) <= version:
+            self.run_db(client, lambda changes: self.send_rooms(client, msg, changes, version),
+                        self.db.room_log, int(since), version)
+        else:
+            self.send_rooms(client, msg)
+    
+    def send_rooms(self, client, msg, changes=None, version=None):
+        # The changes read from room_log only do if the directory hasn't moved on since;
+        # otherwise (or if there are too many) the client gets a listing
+        directory = self.directory
+        with directory.lock:
+            reply = None
+            if changes is not None and version == directory.version and len(changes) <= MAX_ROOM_PAGE:
+                reply = {'type': 'rooms_changed', 'version': version, 'changes': changes}
+            if reply is None:
+                prefix, after = str(msg.get('prefix') or ''), msg.get('after')
+                limit = min(int(msg['limit']), MAX_ROOM_PAGE) if msg.get('limit') else len(directory.names)
+                rooms, has_more = directory.page(prefix, after and str(after), limit)
+                reply = {'type': 'rooms_list', 'version': directory.version, 'prefix': prefix, 'after': after,
+                         'has_more': has_more,
+                         'rooms': [(room_id, name, desc, self.rooms.count(room_id)) for room_id, name, desc in rooms]}
+            self.send(client, reply)
+            if msg.get('subscribe'):
+                directory.subscribers[client.id] = client
+    
+    def directory_changed(self):
+        self.refresh_directory()
+    
+    def refresh_directory(self):
+        # Applies the room_log entries the directory hasn't seen yet and pushes each one to
+        # subscribers; members of a removed room are taken out of it
+        self.run_db(None, self.apply_directory, self.db.room_log, self.directory.version)
+    
+    def apply_directory(self, entries):
+        directory = self.directory
+        with directory.lock:
+            for version, room_id, name, desc in entries:
+                if version <= directory.version:
+                    continue  # applied by a refresh that finished first
+                directory.apply(version, room_id, name, desc)
+                if name is None:
+                    # Removed here or by another shard: history this shard cached goes too
+                    self.db.cache.invalidate(room_id)
+                    self.close_room(room_id)
+                    delta = {'type': 'room_removed', 'version': version, 'room_id': room_id}
+                else:
+                    delta = {'type': 'room_added', 'version': version,
+                             'room': [room_id, name, desc, self.rooms.count(room_id)]}
+                self.fan_out(list(directory.subscribers.values()), delta)
+                self.metrics.inc('chat_directory_changes_total')
+    
+    def close_room(self, room_id):
+        for member in self.rooms.members_of(room_id):
+            self.rooms.leave(room_id, member)
+            info = self.clients.get(member)
+            if info:
+                self.activity.leave(room_id, info['username'])
+                if info['room'] == room_id:
+                    info['room'] = None
+        self.activity_changed()
+    
+    def finish_upload(self, client, digest, size, kind):
+        # Image uploads are acknowledged once their thumbnail exists, so the chat message
+        # that follows never references a thumbnail that is still being rendered
+        if kind != 'image':
+            self.send(client, {'type': 'upload_done', 'sha256': digest, 'size': size})
+            return
+        done = lambda future: self.dispatch(
+            lambda: self.send(client, {'type': 'upload_done', 'sha256': digest, 'size': size}))
+        self.thumbnails.submit(digest).add_done_callback(done)
+    
+    def run_kdf(self, callback, fn, *args):
+        # Runs a password hash on the KDF pool and hands its result to callback via dispatch
+        started = time.perf_counter()
+        future = self.kdf_pool.submit(fn, *args)
+        future.add_done_callback(lambda f: self.metrics.observe('chat_kdf_seconds', time.perf_counter() - started))
+        future.add_done_callback(lambda f: self.dispatch(lambda: callback(f.result())))
+    
+    def login(self, client, msg):
+        version = negotiate_version(msg)
+        
+        def found(user):
+            def verified(result):
+                ok, needs_rehash = result
+                if not user or not ok:
+                    self.send(client, {'type': 'login_failed'})
+                    return
+                if needs_rehash:
+                    # Legacy unsalted or weaker hash: upgrade it now that we know the password
+                    self.run_kdf(lambda new_hash: self.run_db(None, None, self.db.set_password, user[0], new_hash),
+                                 hash_password, msg['password'], self.kdf_iterations)
+                self.run_db(client, lambda issued: logged_in(user, *issued),
+                            self.sessions.issue, user[0], msg['username'])
+            # Unknown users are checked against a dummy hash so they take as long as wrong passwords
+            self.run_kdf(verified, verify_password, msg['password'], user[1] if user else self.dummy_hash,
+                         self.kdf_iterations)
+        
+        def logged_in(user, token, session):
+            if client.closed:
+                return
+            self.clients[client] = {'username': msg['username'], 'user_id': user[0], 'room': None,
+                                    'version': version, 'session': session, 'token': token}
+            reply = {'type': 'login_success', 'user_id': user[0], 'version': version,
+                     'token': token, 'expires': session['expires'], 'compression': negotiate_codec(msg)}
+            self.send(client, reply)
+            client.codec = reply['compression']  # the reply itself goes out uncompressed
+        self.run_db(client, found, self.db.get_credentials, msg['username'])
+    
+    def resume(self, client, msg):
+        # Re-authenticates with a session token, rejoins the client's rooms and replays
+        # what it missed after the last message id it saw in each
+        version = negotiate_version(msg)
+        self.run_db(client, lambda session: self.resumed(client, msg, version, session),
+                    self.sessions.lookup, msg.get('token'))
+    
+    def resumed(self, client, msg, version, session):
+        if session is None or version is None:
+            self.send(client, {'type': 'resume_failed', 'reason': "Session expired, please log in again",
+                               'versions': list(SUPPORTED_VERSIONS)})
+            return
+        rooms = msg.get('rooms') or session['rooms']  # [[room_id, last seen id or None], ...]
+        self.clients[client] = {'username': session['username'], 'user_id': session['user_id'],
+                                'room': rooms[-1][0] if rooms else None, 'version': version,
+                                'session': session, 'token': msg['token']}
+        joined = [room_id for room_id, _ in rooms if not self.rooms.is_member(room_id, client)]
+        for room_id, last_id in rooms:
+            self.rooms.join(room_id, client)
+        self.send(client, {'type': 'resumed', 'user_id': session['user_id'], 'username': session['username'],
+                           'version': version, 'rooms': [room_id for room_id, _ in rooms],
+                           'expires': session['expires'], 'compression': negotiate_codec(msg)})
+        client.codec = negotiate_codec(msg)
+        for room_id in joined:
+            self.enter_room(client, room_id)
+        # Joined first, so nothing falls between the replay and live delivery; the client
+        # drops ids it already has
+        def replayed(replies):
+            for reply in replies:
+                self.send(client, reply)
+        self.run_db(client, replayed, self.missed_history, rooms)
+    
+    def missed_history(self, rooms):
+        replies = []
+        for room_id, last_id in rooms:
+            if last_id is None:
+                continue
+            history, has_more = self.db.get_history(room_id, MAX_HISTORY_PAGE, after_id=last_id)
+            after_id = last_id
+            if has_more:
+                # Missed more than a page: start over from the latest page instead
+                history, has_more = self.db.get_history(room_id, MAX_HISTORY_PAGE)
+                after_id = None
+            replies.append({'type': 'history', 'room_id': room_id, 'data': history, 'has_more': has_more,
+                            'before_id': None, 'after_id': after_id})
+        return replies
+    
     def process_message(self, client, msg):
+        # Times every request by message type; errors are counted before they propagate
+        # to the connection handler (which drops the connection)
+        msg_type = str(msg.get('type'))[:32]
+        started = time.perf_counter()
+        if self.trace:
+            self.trace.frame(client.id, msg)
+        try:
+            if self.limiter and self.throttle(client, msg, msg_type):
+                return
+            self.route_message(client, msg)
+        except Exception:
+            self.metrics.inc('chat_errors_total', type=msg_type)
+            raise
+        finally:
+            self.metrics.observe('chat_request_seconds', time.perf_counter() - started, type=msg_type)
+    
+    def throttle(self, client, msg, msg_type):
+        # Checks the request against its rate limits; a throttled request is answered
+        # with 'throttled' (so clients waiting on a reply aren't left hanging) and dropped
+        info = self.clients.get(client)
+        user = info['user_id'] if info else ('conn', client.id)
+        room_id = peer = None
+        if msg_type in ('login', 'register'):
+            # By account and address, so reconnecting doesn't start a fresh allowance
+            user, peer = ('name', str(msg.get('username'))), client.peer
+        if msg_type == 'chat_message' and info:
+            room_id = msg.get('room_id', info['room'])
+            if isinstance(room_id, int) and not self.db.owns(room_id):
+                room_id = None  # the room's own shard applies its limit when the post gets there
+        throttled = self.limiter.check(msg_type, user, room_id, peer)
+        if throttled is None:
+            return False
+        scope, retry_after = throttled
+        self.metrics.inc('chat_throttled_total', type=msg_type, scope=scope)
+        now = time.monotonic()
+        repeat = client.paused_until > now
+        if scope in ('user', 'peer'):
+            # Tarpit: the handler reads nothing more from this connection until then. Room
+            # limits are shared, so hitting one doesn't hold up the sender's connection.
+            client.paused_until = max(client.paused_until, now + retry_after)
+        if repeat and msg_type == 'chat_message':
+            return True  # already told; nothing waits on a reply to a chat message
+        reply = {'type': 'throttled', 'request': msg_type, 'scope': scope, 'retry_after': round(retry_after, 3)}
+        if 'room_id' in msg:
+            reply['room_id'] = msg['room_id']
+        self.send(client, reply)
+        return True
+    
+    def route_message(self, client, msg):
         msg_type = msg.get('type')
         
-        if msg_type == 'register':
-            success = self.db.register_user(msg['username'], msg['password'])
-            client.send(json.dumps({'type': 'register_result', 'success': success}).encode())
+        if msg_type in ('register', 'login') and negotiate_version(msg) is None:
+            reply = 'register_result' if msg_type == 'register' else 'login_failed'
+            self.send(client, {'type': reply, 'success': False, 'reason': "Unsupported protocol version",
+                               'versions': list(SUPPORTED_VERSIONS)})
+            
+        elif msg_type == 'register':
+            registered = lambda success: self.send(client, {
+                'type': 'register_result', 'success': success, 'version': negotiate_version(msg)})
+            self.run_kdf(lambda password_hash: self.run_db(client, registered, self.db.register_user,
+                                                           msg['username'], password_hash),
+                         hash_password, msg['password'], self.kdf_iterations)
             
         elif msg_type == 'login':
-            user = self.db.login_user(msg['username'], msg['password'])
-            if user:
-                self.clients[client] = {'username': msg['username'], 'user_id': user[0], 'room': None}
-                client.send(json.dumps({'type': 'login_success', 'user_id': user[0]}).encode())
+            self.login(client, msg)
+            
+        elif msg_type == 'resume':
+            self.resume(client, msg)
+            
+        elif msg_type == 'logout':
+            logged_out = lambda result=None: self.send(client, {'type': 'logged_out'})
+            if client in self.clients:
+                self.clients[client]['session']['rooms'] = []
+                self.run_db(client, logged_out, self.sessions.revoke, self.clients[client]['token'])
             else:
-                client.send(json.dumps({'type': 'login_failed'}).encode())
+                logged_out()
                 
         elif msg_type == 'get_rooms':
-            rooms = self.db.get_rooms()
-            client.send(json.dumps({'type': 'rooms_list', 'rooms': rooms}).encode())
+            self.list_rooms(client, msg)
             
         elif msg_type == 'create_room':
-            success = self.db.create_room(msg['name'], msg['description'])
-            client.send(json.dumps({'type': 'room_created', 'success': success}).encode())
+            info = self.clients.get(client)
+            
+            def created(room_id):
+                self.send(client, {'type': 'room_created', 'success': room_id is not None, 'room_id': room_id})
+                if room_id is not None:
+                    self.directory_changed()
+            self.run_db(client, created, self.db.create_room, msg['name'], msg['description'],
+                        info and info['user_id'])
+            
+        elif msg_type == 'delete_room':
+            info = self.clients.get(client)
+            
+            def deleted(success):
+                self.send(client, {'type': 'room_deleted', 'success': success, 'room_id': msg['room_id']})
+                if success:
+                    self.directory_changed()
+            if info:
+                self.run_db(client, deleted, self.db.delete_room, msg['room_id'], info['user_id'])
+            else:
+                deleted(False)
             
         elif msg_type == 'join_room':
             room_id = msg['room_id']
             self.clients[client]['room'] = room_id
-            if room_id not in self.rooms:
-                self.rooms[room_id] = []
-            if client not in self.rooms[room_id]:
-                self.rooms[room_id].append(client)
-            client.send(json.dumps({'type': 'room_joined'}).encode())
+            joined = not self.rooms.is_member(room_id, client)
+            self.rooms.join(room_id, client)
+            self.send(client, {'type': 'room_joined', 'room_id': room_id})
+            if joined:
+                self.enter_room(client, room_id)
+            
+        elif msg_type == 'leave_room':
+            room_id = msg['room_id']
+            if self.rooms.is_member(room_id, client):
+                self.rooms.leave(room_id, client)
+                if client in self.clients:
+                    self.activity.leave(room_id, self.clients[client]['username'])
+                    self.activity_changed()
+            if client in self.clients and self.clients[client]['room'] == room_id:
+                self.clients[client]['room'] = None
+            self.send(client, {'type': 'room_left', 'room_id': room_id})
+            
+        elif msg_type == 'typing':
+            room_id = msg['room_id']
+            if self.rooms.is_member(room_id, client):
+                self.activity.set_typing(room_id, self.clients[client]['username'], bool(msg.get('active', True)),
+                                         time.monotonic())
+                self.activity_changed()
+            
+        elif msg_type == 'read':
+            room_id, info = msg['room_id'], self.clients[client]
+            if self.rooms.is_member(room_id, client):
+                self.activity.set_read(room_id, info['user_id'], info['username'], int(msg['last_id']))
+                self.activity_changed()
             
         elif msg_type == 'get_history':
-            history = self.db.get_history(msg['room_id'])
-            client.send(json.dumps({'type': 'history', 'data': history}).encode())
+            room_id = msg['room_id']
+            limit = min(int(msg.get('limit', 50)), MAX_HISTORY_PAGE)
+            before_id, after_id = msg.get('before_id'), msg.get('after_id')
+            
+            def loaded(page):
+                history, has_more = page
+                self.send(client, {'type': 'history', 'room_id': room_id, 'data': history, 'has_more': has_more,
+                                   'before_id': before_id, 'after_id': after_id})
+            self.run_db(client, loaded, self.db.get_history, room_id, limit, before_id, after_id)
+            
+        elif msg_type == 'search':
+            limit = max(1, min(int(msg.get('limit', 20)), MAX_SEARCH_PAGE))
+            order = 'recent' if msg.get('order') == 'recent' else 'rank'
+            offset = max(0, min(int(msg.get('offset') or 0), MAX_SEARCH_OFFSET))
+            room_id = msg.get('room_id')
+            
+            def found(page):
+                results, has_more = page
+                reply = {'type': 'search_results', 'query': msg.get('query', ''), 'room_id': room_id,
+                         'order': order, 'results': results, 'has_more': has_more}
+                if has_more:
+                    reply['next'] = ({'before_id': results[-1][0]} if order == 'recent'
+                                     else {'offset': offset + len(results)})
+                self.send(client, reply)
+            self.run_db(client, found, self.db.search, msg.get('query', ''), room_id, limit, order, offset,
+                        msg.get('before_id'))
+            
+        elif msg_type in ('upload_start', 'upload_chunk', 'fetch_blob') and client not in self.clients:
+            # Attachments are for logged-in users only
+            if msg_type == 'fetch_blob':
+                self.send(client, {'type': 'blob_missing', 'sha256': msg.get('sha256'), 'variant': msg.get('variant')})
+            else:
+                self.send(client, {'type': 'upload_failed', 'sha256': msg.get('sha256'), 'reason': "Not logged in"})
+            
+        elif msg_type == 'upload_start':
+            digest, size = msg['sha256'], int(msg['size'])
+            owner = self.clients[client]['user_id']
+            kind = msg.get('kind', 'file')
+            self.clients[client].setdefault('uploads', {})[digest] = kind
+            if not is_digest(digest) or not 0 <= size <= MAX_BLOB_SIZE:
+                self.send(client, {'type': 'upload_failed', 'sha256': digest, 'reason': "Invalid upload"})
+            elif self.blobs.exists(digest):
+                self.finish_upload(client, digest, size, kind)
+            else:
+                self.send(client, {'type': 'upload_ready', 'sha256': digest,
+                                   'offset': self.blobs.received(digest, owner)})
+            
+        elif msg_type == 'upload_chunk':
+            digest, size = msg['sha256'], int(msg['size'])
+            owner = self.clients[client]['user_id']
+            if not is_digest(digest) or size > MAX_BLOB_SIZE:
+                return
+            offset, data = msg['offset'], msg['data']
+            
+            # Disk writes, and hashing the whole file once it is complete, happen off the
+            # event loop (run_db)
+            def store():
+                received = self.blobs.write_chunk(digest, owner, offset, data)
+                return received, received == offset + len(data) == size and self.blobs.commit(digest, owner)
+            
+            def stored(result):
+                received, committed = result
+                if received != offset + len(data):
+                    # Out of order (e.g. after a reconnect): tell the client where to resume
+                    self.send(client, {'type': 'upload_ready', 'sha256': digest, 'offset': received})
+                elif received >= size:
+                    if committed:
+                        kind = self.clients[client].get('uploads', {}).pop(digest, 'file')
+                        self.finish_upload(client, digest, size, kind)
+                    else:
+                        self.send(client, {'type': 'upload_failed', 'sha256': digest,
+                                           'reason': "Upload corrupted, please retry"})
+            self.run_db(client, stored, store)
+            
+        elif msg_type == 'fetch_blob':
+            digest, variant = msg['sha256'], msg.get('variant')
+            
+            def load():
+                if not self.blobs.exists(digest, variant):
+                    return None
+                size = self.blobs.size(digest, variant)
+                offset = min(max(0, int(msg.get('offset', 0))), size)
+                end = min(size, offset + min(int(msg.get('length', MAX_FETCH_WINDOW)), MAX_FETCH_WINDOW))
+                return size, offset, list(self.blobs.read_chunks(digest, offset, end, variant))
+            
+            def loaded(result):
+                if result is None:
+                    self.send(client, {'type': 'blob_missing', 'sha256': digest, 'variant': variant})
+                    return
+                size, offset, chunks = result
+                reply = {'type': 'blob_chunk', 'sha256': digest, 'variant': variant, 'size': size}
+                for chunk_offset, data in chunks:
+                    self.send(client, dict(reply, offset=chunk_offset), data)
+                if not chunks:
+                    self.send(client, dict(reply, offset=offset), b'')
+            self.run_db(client, loaded, load)
             
         elif msg_type == 'chat_message':
             if client in self.clients:
                 username = self.clients[client]['username']
-                room_id = self.clients[client]['room']
+                room_id = msg.get('room_id', self.clients[client]['room'])
+                if not self.rooms.is_member(room_id, client):
+                    return
                 message = msg['message']
                 msg_typ = msg.get('message_type', 'text')
+                attachment = msg.get('attachment')
+                if attachment:
+                    # Only a reference to an uploaded blob is stored and broadcast
+                    if not self.blobs.exists(attachment.get('sha256')):
+                        return
+                    message = json.dumps({'name': os.path.basename(str(attachment.get('name', 'file'))),
+                                          'sha256': attachment['sha256'],
+                                          'size': self.blobs.size(attachment['sha256'])})
                 
-                self.db.save_message(room_id, username, message, msg_typ)
-                
-                broadcast = {
-                    'type': 'new_message',
-                    'username': username,
-                    'message': message,
-                    'message_type': msg_typ,
-                    'timestamp': datetime.now().strftime('%H:%M:%S')
-                }
-                
-                if room_id in self.rooms:
-                    for c in self.rooms[room_id]:
-                        try:
-                            c.send(json.dumps(broadcast).encode())
-                        except:
-                            self.rooms[room_id].remove(c)
+                self.post_message(room_id, username, message, msg_typ, client)
+                # Sending ends typing, without waiting for the client to say so
+                self.activity.set_typing(room_id, username, False, time.monotonic())
+                self.activity_changed()
+    
+    def post_message(self, room_id, username, message, msg_type, sender=None):
+        try:
+            msg_id = self.db.save_message(room_id, username, message, msg_type)
+        except sqlite3.Error:
+            return  # durability 'full' and the commit failed: it is reported, not delivered
+        self.announce_message(msg_id, room_id, username, message, msg_type)
+    
+    def announce_message(self, msg_id, room_id, username, message, msg_type):
+        broadcast = {
+            'type': 'new_message',
+            'id': msg_id,
+            'room_id': room_id,
+            'username': username,
+            'message': message,
+            'message_type': msg_type,
+            'timestamp': datetime.now().strftime('%H:%M:%S')
+        }
+        
+        self.broadcast(room_id, broadcast)
+    
+    def broadcast(self, room_id, msg):
+        self.fan_out(self.rooms.members_of(room_id), msg)
+    
+    def fan_out(self, members, msg):
+        # Serialize once and queue the same bytes for every member; a member whose
+        # queue overflows is evicted by its connection and cleaned up by its handler
+        started = time.perf_counter()
+        frames = {}  # one encoding per negotiated codec
+        dropped = sent = 0
+        for c in members:
+            frame = frames.get(c.codec)
+            if frame is None:
+                frame = frames[c.codec] = encode_frame(msg, codec=c.codec)
+            if c.send(frame):
+                sent += len(frame)
+            else:
+                dropped += 1
+        self.metrics.observe('chat_broadcast_seconds', time.perf_counter() - started)
+        self.metrics.inc('chat_broadcast_recipients_total', len(members))
+        self.metrics.inc('chat_bytes_out_total', sent)
+        if dropped:
+            self.metrics.inc('chat_slow_consumer_drops_total', dropped)
+    
+    def collect_metrics(self):
+        # Gauges sampled at scrape time
+        connections = list(self.connections.values())
+        queued = [c.queued_bytes for c in connections]
+        with self.rooms.lock:
+            rooms = sorted(((room_id, len(members)) for room_id, members in self.rooms.members.items()),
+                           key=lambda item: -item[1])
+        gauges = [('chat_connections', {}, len(connections)),
+                  ('chat_authenticated_clients', {}, len(self.clients)),
+                  ('chat_rooms_active', {}, len(rooms)),
+                  ('chat_outbound_queue_bytes', {'stat': 'max'}, max(queued, default=0)),
+                  ('chat_outbound_queue_bytes', {'stat': 'total'}, sum(queued)),
+                  ('chat_sessions_cached', {}, len(self.sessions.cache))]
+        # Members per room, for the busiest rooms only to keep the series count bounded
+        gauges += [('chat_room_members', {'room': room_id}, count) for room_id, count in rooms[:100]]
+        gauges += [('chat_db_' + key, {}, value) for key, value in self.db.metrics().items()]
+        gauges += [('chat_history_cache_' + key, {}, value) for key, value in self.db.cache.metrics().items()]
+        return gauges
     
     def disconnect_client(self, client):
-        if client in self.clients:
-            room_id = self.clients[client].get('room')
-            if room_id and room_id in self.rooms and client in self.rooms[room_id]:
-                self.rooms[room_id].remove(client)
-            del self.clients[client]
+        self.connections.pop(client.id, None)
+        if self.trace:
+            self.trace.record(client.id, TRACE_CLOSE)
+        self.directory.subscribers.pop(client.id, None)
+        info = self.clients.pop(client, None)
+        if info:
+            rooms = self.rooms.rooms_of(client)
+            # Remembered for a resume that doesn't list its rooms (no replay then)
+            info['session']['rooms'] = [[room_id, None] for room_id in rooms]
+            for room_id in rooms:
+                self.activity.leave(room_id, info['username'])
+        self.rooms.leave_all(client)
+        if info:
+            self.activity_changed()
         try:
             client.close()
         except:
             pass
+    
+    def stop(self):
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.server.close()
+        self.running = False
+        self.save_read_cursors()
+        if self.retention:
+            self.retention.stop()
+        if self.trace:
+            self.trace.close()
+        self.db.close()
+        if self.endpoint:
+            self.endpoint.close()
+
+class SocketConnection:
+    # Frames go into a bounded outbound queue drained by a writer thread, so a
+    # broadcasting handler never blocks on a slow peer and frames never interleave
+    def __init__(self, sock, max_queued=MAX_OUTBOUND_BYTES):
+        self.id = next(CONNECTION_IDS)
+        self.sock = sock
+        self.max_queued = max_queued
+        self.codec = None  # negotiated compression
+        self.paused_until = 0.0  # monotonic time before which requests aren't read (rate limits)
+        peer = sock.getpeername()
+        self.peer = peer[0] if isinstance(peer, tuple) else None  # IP address, for login limits
+        self.queue = deque()
+        self.queued_bytes = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        threading.Thread(target=self.drain, daemon=True).start()
+    
+    def send(self, data):
+        with self.cond:
+            if self.closed:
+                return False
+            if not self.queued_bytes or self.queued_bytes + len(data) <= self.max_queued:
+                self.queue.append(data)
+                self.queued_bytes += len(data)
+                self.cond.notify_all()
+                return True
+        # Slow consumer: evict rather than buffer without limit
+        self.close()
+        return False
+    
+    def drain(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                batch = list(self.queue)
+                self.queue.clear()
+            size = sum(len(data) for data in batch)
+            try:
+                self.sock.sendall(batch[0] if len(batch) == 1 else b''.join(batch))
+            except OSError:
+                self.close()
+                return
+            with self.cond:
+                self.queued_bytes -= size
+                self.cond.notify_all()  # the handler may be waiting in wait_writable
+    
+    def wait_writable(self, limit):
+        with self.cond:
+            while self.queued_bytes > limit and not self.closed:
+                self.cond.wait()
+    
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)  # wakes the handler thread blocked in recv()
+        except OSError:
+            pass
+        self.sock.close()
+
+class AsyncConnection:
+    # Same interface as SocketConnection; the transport's write buffer is the outbound
+    # queue and the event loop drains it
+    def __init__(self, writer, max_queued=MAX_OUTBOUND_BYTES):
+        self.id = next(CONNECTION_IDS)
+        self.writer = writer
+        self.codec = None
+        self.paused_until = 0.0
+        peer = writer.get_extra_info('peername')
+        self.peer = peer[0] if isinstance(peer, tuple) else None
+        self.max_queued = max_queued
+        # drain() in the read loop waits while more than this is buffered (flow control)
+        writer.transport.set_write_buffer_limits(high=INBOUND_PAUSE_BYTES)
+        self.busy = None  # a database call off the loop this connection's next request waits for
+        self.calls = deque()  # calls for this connection queued behind it
+        self.held = None  # frames kept back until that call's reply has gone out
+    
+    def hold(self):
+        self.held = []
+    
+    def release(self):
+        held, self.held = self.held or [], None
+        return held
+    
+    def send(self, data):
+        if self.held is not None:
+            self.held.append(data)
+            return True
+        if self.writer.is_closing():
+            return False
+        queued = self.writer.transport.get_write_buffer_size()
+        if queued and queued + len(data) > self.max_queued:
+            self.writer.transport.abort()  # slow consumer
+            return False
+        self.writer.write(data)
+        return True
+    
+    def close(self):
+        self.writer.close()
+    
+    @property
+    def closed(self):
+        return self.writer.is_closing()
+    
+    @property
+    def queued_bytes(self):
+        return self.writer.transport.get_write_buffer_size()
+
+class AsyncChatServer(ChatServer):
+    # Multiplexes every connection on a single event loop instead of one thread each
+    def start(self):
+        asyncio.run(self.serve())
+    
+    reuse_port = False
+    
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port,
+                                                 backlog=self.backlog, reuse_address=True,
+                                                 reuse_port=self.reuse_port)
+        print(f"Async server running on {self.host}:{self.port}")
+        self.start_ticker()
+        try:
+            self.loop.add_signal_handler(signal.SIGTERM, self.server.close)
+        except (NotImplementedError, RuntimeError, ValueError):
+            pass  # not on the main thread, or not supported on this platform
+        async with self.server:
+            try:
+                await self.server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+    
+    async def handle_connection(self, reader, writer):
+        client = AsyncConnection(writer)
+        decoder = FrameDecoder()
+        self.connections[client.id] = client
+        if self.trace:
+            self.trace.record(client.id, TRACE_OPEN)
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                self.metrics.inc('chat_bytes_in_total', len(data))
+                for msg in decoder.feed(data):
+                    self.process_message(client, msg)
+                    while client.busy:  # a reply can start another call (e.g. a finished upload)
+                        await asyncio.wait([client.busy])
+                if client.queued_bytes > INBOUND_PAUSE_BYTES:
+                    self.metrics.inc('chat_inbound_paused_total', reason='queue')
+                await writer.drain()  # stops reading while the client isn't reading
+                delay = client.paused_until - time.monotonic()
+                if delay > 0:
+                    self.metrics.inc('chat_inbound_paused_total', reason='rate')
+                    await asyncio.sleep(delay)
+        except (Exception, asyncio.CancelledError):
+            pass  # cancellation only happens when the server shuts down
+        finally:
+            self.disconnect_client(client)
+    
+    def dispatch(self, callback):
+        self.loop.call_soon_threadsafe(callback)
+    
+    def run_db(self, client, callback, fn, *args):
+        # Runs on the default executor instead of blocking the loop. A client's calls run one
+        # at a time, in order, and its next request waits for them (handle_connection); frames
+        # for the client are held back until each reply is out, so the client sees the same
+        # order as if the calls had run inline. A busy database gets the client an 'error' to
+        # retry on, any other failure drops the connection as it would inline.
+        if client is None:
+            def done(future):
+                if not future.cancelled() and future.exception() is None and callback:
+                    callback(future.result())
+            self.loop.run_in_executor(None, fn, *args).add_done_callback(done)
+            return
+        client.calls.append((callback, fn, args))
+        if client.busy is None:
+            self.next_db_call(client)
+    
+    def next_db_call(self, client):
+        callback, fn, args = client.calls.popleft()
+        client.hold()
+        client.busy = self.loop.run_in_executor(None, fn, *args)
+        
+        def finished(future):
+            # busy stays set until the held frames are out, so a call the callback makes queues
+            held = client.release()
+            error = None if future.cancelled() else future.exception()
+            if error is not None:
+                self.metrics.inc('chat_errors_total', type=getattr(fn, '__name__', 'db'))
+                if database_busy(error):
+                    self.send(client, {'type': 'error', 'reason': "Server busy, please retry"})
+                else:
+                    client.close()
+            elif not future.cancelled() and callback:
+                callback(future.result())
+            for frame in held:
+                client.send(frame)
+            if client.calls:
+                self.next_db_call(client)
+            else:
+                client.busy = None
+        client.busy.add_done_callback(finished)
+    
+    def post_message(self, room_id, username, message, msg_type, sender=None):
+        # With durability 'full' the message is announced once its commit succeeds, which the
+        # loop doesn't wait for
+        msg_id, done = self.db.queue_message(room_id, username, message, msg_type)
+        if done is None:
+            self.announce_message(msg_id, room_id, username, message, msg_type)
+            return
+        
+        def committed(future):
+            if future.exception() is None:
+                self.dispatch(lambda: self.announce_message(msg_id, room_id, username, message, msg_type))
+        done.add_done_callback(committed)
+    
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.server.close)
+        self.running = False
+        self.save_read_cursors()
+        if self.retention:
+            self.retention.stop()
+        if self.trace:
+            self.trace.close()
+        self.db.close()
+        if self.endpoint:
+            self.endpoint.close()
+
+class ShardedChatServer(AsyncChatServer):
+    # One of N worker processes sharing the listening port (SO_REUSEPORT), so the server
+    # is no longer limited to one core. Rooms are sharded by room_id: the owning worker
+    # assigns ids and persists messages, and a MessageBus relays each room's events to
+    # the other workers that have members in it.
+    reuse_port = True
+    
+    def __init__(self, *args, bus_path, shard, shards, **kwargs):
+        super().__init__(*args, shard=shard, shards=shards, **kwargs)
+        self.bus_path = bus_path
+        self.shard, self.shards = shard, shards
+        self.rooms = RoomIndex(lambda room_id: self.bus_send({'type': 'subscribe', 'room_id': room_id}),
+                               lambda room_id: self.bus_send({'type': 'unsubscribe', 'room_id': room_id}))
+        self.activity.moves = []
+    
+    async def serve(self):
+        reader, self.bus = await asyncio.open_unix_connection(self.bus_path)
+        self.bus_send({'type': 'hello', 'shard': self.shard})
+        listener = asyncio.create_task(self.listen_bus(reader))
+        try:
+            await super().serve()
+        finally:
+            listener.cancel()
+    
+    async def listen_bus(self, reader):
+        decoder = FrameDecoder()
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            for msg in decoder.feed(data):
+                if msg['type'] == 'publish':
+                    ChatServer.broadcast(self, msg['room_id'], msg['msg'])
+                elif msg['type'] == 'post' and not self.throttle_post(msg):
+                    AsyncChatServer.post_message(self, msg['room_id'], msg['username'], msg['message'],
+                                                 msg['message_type'])
+                elif msg['type'] == 'reply':
+                    client = self.connections.get(msg['conn'])
+                    if client:
+                        self.send(client, msg['msg'])
+                elif msg['type'] == 'directory':
+                    self.refresh_directory()
+                elif msg['type'] == 'presence':
+                    self.activity.set_remote(msg['origin'], msg['changes'])
+                    self.activity_changed()
+                elif msg['type'] == 'worker':
+                    if msg['up']:
+                        # A worker (re)started: it learns who is online here
+                        self.bus_send({'type': 'presence', 'origin': self.shard,
+                                       'changes': self.activity.local_presence()})
+                    else:
+                        self.activity.drop_remote(msg['shard'])
+                        self.activity_changed()
+        self.server.close()  # the supervisor is gone
+    
+    def bus_send(self, msg):
+        self.bus.write(encode_frame(msg))
+    
+    def publish_activity(self):
+        # Every worker merges presence from all of them, so each sends its own clients the
+        # presence changes, and only typing and read receipts are relayed
+        moves = self.activity.take_moves()
+        if moves:
+            self.bus_send({'type': 'presence', 'origin': self.shard, 'changes': moves})
+        if not self.running:
+            return
+        for room_id, delta in self.activity.flush(time.monotonic()):
+            presence = delta.pop('presence', None)
+            if presence:
+                ChatServer.broadcast(self, room_id, {'type': 'room_activity', 'room_id': room_id,
+                                                     'presence': presence})
+            if delta:
+                self.broadcast(room_id, {'type': 'room_activity', 'room_id': room_id, **delta})
+            self.metrics.inc('chat_activity_deltas_total')
+    
+    def directory_changed(self):
+        # Every worker catches up from room_log, in the same order
+        super().directory_changed()
+        self.bus_send({'type': 'directory'})
+    
+    def post_message(self, room_id, username, message, msg_type, sender=None):
+        owner = room_id % self.shards
+        if owner == self.shard:
+            super().post_message(room_id, username, message, msg_type)
+        else:
+            self.bus_send({'type': 'post', 'shard': owner, 'room_id': room_id, 'username': username,
+                           'message': message, 'message_type': msg_type, 'origin': self.shard,
+                           'conn': sender and sender.id})
+    
+    def throttle_post(self, msg):
+        # Posts from every worker reach the room's owner, so its room limit is the only one;
+        # a throttled post is answered on the sender's worker
+        throttled = self.limiter and self.limiter.check('chat_message', None, msg['room_id'])
+        if not throttled:
+            return False
+        scope, retry_after = throttled
+        self.metrics.inc('chat_throttled_total', type='chat_message', scope=scope)
+        if msg.get('conn') is not None:
+            self.bus_send({'type': 'reply', 'shard': msg['origin'], 'conn': msg['conn'],
+                           'msg': {'type': 'throttled', 'request': 'chat_message', 'scope': scope,
+                                   'retry_after': round(retry_after, 3), 'room_id': msg['room_id']}})
+        return True
+    
+    def broadcast(self, room_id, msg):
+        super().broadcast(room_id, msg)
+        self.bus_send({'type': 'publish', 'room_id': room_id, 'msg': msg})
+
+class MessageBus:
+    # Local broker between the workers of a sharded server, over a Unix domain socket:
+    # publishes go to every other worker subscribed to the room, posts to the room's owner,
+    # replies to the worker holding the connection, and directory and presence changes (and
+    # workers coming and going) to every other worker
+    def __init__(self, path):
+        self.path = path
+        self.workers = {}      # shard -> stream writer
+        self.subscribers = {}  # room_id -> set of shards with members in the room
+    
+    async def handle_worker(self, reader, writer):
+        decoder = FrameDecoder()
+        shard = None
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for msg in decoder.feed(data):
+                    kind = msg['type']
+                    if kind == 'hello':
+                        shard = msg['shard']
+                        self.workers[shard] = writer
+                        self.tell_others(shard, {'type': 'worker', 'shard': shard, 'up': True})
+                    elif kind == 'subscribe':
+                        self.subscribers.setdefault(msg['room_id'], set()).add(shard)
+                    elif kind == 'unsubscribe':
+                        self.unsubscribe(msg['room_id'], shard)
+                    elif kind == 'publish':
+                        frame = encode_frame(msg)
+                        for other in self.subscribers.get(msg['room_id'], ()):
+                            if other != shard and other in self.workers:
+                                self.workers[other].write(frame)
+                    elif kind in ('post', 'reply') and msg['shard'] in self.workers:
+                        self.workers[msg['shard']].write(encode_frame(msg))
+                    elif kind in ('directory', 'presence'):
+                        self.tell_others(shard, msg)
+        except (Exception, asyncio.CancelledError):
+            pass
+        finally:
+            self.workers.pop(shard, None)
+            for room_id in list(self.subscribers):
+                self.unsubscribe(room_id, shard)
+            if shard is not None:
+                self.tell_others(shard, {'type': 'worker', 'shard': shard, 'up': False})
+            writer.close()
+    
+    def tell_others(self, shard, msg):
+        frame = encode_frame(msg)
+        for other, worker in self.workers.items():
+            if other != shard:
+                worker.write(frame)
+    
+    def unsubscribe(self, room_id, shard):
+        shards = self.subscribers.get(room_id)
+        if shards is not None:
+            shards.discard(shard)
+            if not shards:
+                del self.subscribers[room_id]
+
+def serve_sharded(workers, worker_args, db_path='chat.db'):
+    # Supervisor for --sharded: prepares the database once, runs the bus and one
+    # --async-server process per shard, and stops them all on SIGTERM or if one dies
+    ChatDatabase(db_path).close()
+    bus_path = os.path.join(tempfile.mkdtemp(prefix='chatbus'), 'bus.sock')
+    
+    async def supervise():
+        bus = MessageBus(bus_path)
+        server = await asyncio.start_unix_server(bus.handle_worker, bus_path)
+        stop = asyncio.Event()
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+        except (NotImplementedError, RuntimeError, ValueError):
+            pass
+        procs = [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--async-server', '--bus', bus_path,
+                                   '--shard', str(shard), '--workers', str(workers), *worker_args])
+                 for shard in range(workers)]
+        print(f"Sharded server: {workers} workers")
+        try:
+            while not stop.is_set() and all(proc.poll() is None for proc in procs):
+                try:
+                    await asyncio.wait_for(stop.wait(), 0.5)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for proc in procs:
+                proc.terminate()
+            for proc in procs:
+                proc.wait()
+            server.close()
+            os.unlink(bus_path)
+            os.rmdir(os.path.dirname(bus_path))
+    
+    try:
+        asyncio.run(supervise())
+    except KeyboardInterrupt:
+        pass
 
 class LoginWindow:
     def __init__(self, on_success):
@@ -221,7 +3018,7 @@ class LoginWindow:
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             sock.connect(('localhost', 12345))
-            return sock
+            return FramedSocket(sock)
         except:
             self.status.config(text="Cannot connect to server")
             return None
@@ -238,15 +3035,17 @@ class LoginWindow:
         if not sock:
             return
         
-        msg = {'type': 'login', 'username': username, 'password': password}
-        sock.send(json.dumps(msg).encode())
-        response = json.loads(sock.recv(1024).decode())
+        msg = {'type': 'login', 'username': username, 'password': password,
+               'versions': list(SUPPORTED_VERSIONS), 'compression': list(COMPRESSION_CODECS)}
+        sock.send(msg)
+        response = sock.recv() or {}
         
-        if response['type'] == 'login_success':
+        if response.get('type') == 'login_success':
+            sock.codec = response.get('compression')
             self.root.destroy()
-            self.on_success(username, response['user_id'], sock)
+            self.on_success(username, response['user_id'], sock, response.get('token'))
         else:
-            self.status.config(text="Invalid credentials")
+            self.status.config(text=response.get('reason', "Invalid credentials"))
             sock.close()
     
     def register(self):
@@ -261,25 +3060,52 @@ class LoginWindow:
         if not sock:
             return
         
-        msg = {'type': 'register', 'username': username, 'password': password}
-        sock.send(json.dumps(msg).encode())
-        response = json.loads(sock.recv(1024).decode())
+        msg = {'type': 'register', 'username': username, 'password': password,
+               'versions': list(SUPPORTED_VERSIONS)}
+        sock.send(msg)
+        response = sock.recv() or {}
         
-        if response['success']:
+        if response.get('success'):
             self.status.config(text="Registration successful!", fg='green')
         else:
-            self.status.config(text="Username already exists")
+            self.status.config(text=response.get('reason', "Username already exists"))
         sock.close()
     
     def run(self):
         self.root.mainloop()
 
 class ChatClient:
-    def __init__(self, username, user_id, socket):
+    def __init__(self, username, user_id, socket, token=None):
         self.username = username
         self.user_id = user_id
         self.socket = socket
+        self.token = token
+        self.closing = False
         self.current_room = None
+        self.rendered = deque()  # (message id, start mark, image marks, photo keys) per message in the widget
+        self.has_older = False
+        self.loading_older = False
+        self.inbox = deque()
+        self.render_lock = threading.Lock()
+        self.render_scheduled = False
+        self.mark_ids = itertools.count()
+        self.uploads = {}
+        self.downloads = {}
+        self.blob_cache = OrderedDict()
+        self.photos = OrderedDict()  # bounded LRU of decoded images, keyed by blob digest
+        self.photo_pins = {}  # photo key -> rendered messages showing it; those are never evicted
+        self.search_view = None
+        self.activity = {'presence': {}, 'typing': {}, 'read': {}}  # of the current room
+        self.typing_sent = 0.0
+        self.read_sent = 0
+        self.read_scheduled = False
+        # The loaded part of the room directory, in name order: (folded name, name, room_id,
+        # description, online) for the rooms matching rooms_prefix, kept current by pushed deltas
+        self.room_entries = []
+        self.rooms_version = 0
+        self.rooms_prefix = ''
+        self.rooms_more = self.rooms_loading = self.rooms_catching_up = False
+        self.filter_scheduled = None
         self.emojis = {':)': '😊', ':D': '😃', ':(': '😢', '<3': '❤️', ':P': '😛'}
         
         self.root = tk.Tk()
@@ -306,10 +3132,17 @@ class ChatClient:
         
         tk.Button(left_frame, text="Create Room", bg='#27ae60', fg='white',
                  command=self.create_room_dialog).pack(fill='x', padx=10, pady=5)
+        tk.Button(left_frame, text="Delete Room", bg='#c0392b', fg='white',
+                 command=self.delete_room).pack(fill='x', padx=10)
+        
+        self.room_filter = tk.Entry(left_frame)
+        self.room_filter.pack(fill='x', padx=10, pady=(5, 0))
+        self.room_filter.bind('<KeyRelease>', self.on_room_filter)
         
         self.rooms_list = tk.Listbox(left_frame, bg='#2c3e50', fg='white', selectbackground='#3498db')
         self.rooms_list.pack(fill='both', expand=True, padx=10, pady=5)
         self.rooms_list.bind('<Double-Button-1>', self.join_room)
+        self.rooms_list.config(yscrollcommand=self.on_rooms_scroll)
         
         # Right panel - Chat
         right_frame = tk.Frame(self.root, bg='#34495e')
@@ -324,10 +3157,20 @@ class ChatClient:
                                   font=('Arial', 14, 'bold'))
         self.room_label.pack(side='left', pady=10)
         
+        self.older_btn = tk.Button(header, text="⬆ Older", command=self.load_older, state='disabled')
+        self.older_btn.pack(side='right', padx=5)
+        tk.Button(header, text="🔍 Search", command=self.search_dialog).pack(side='right', padx=5)
+        
         # Chat area
         self.chat_area = scrolledtext.ScrolledText(right_frame, bg='#2c3e50', fg='white',
                                                   state='disabled', wrap='word')
         self.chat_area.pack(fill='both', expand=True, pady=(0, 5))
+        self.chat_area.config(yscrollcommand=self.on_scroll)
+        
+        # Who's here, typing, and has read the latest message
+        self.activity_label = tk.Label(right_frame, text="", fg='#bdc3c7', bg='#34495e', anchor='w',
+                                       font=('Arial', 9, 'italic'))
+        self.activity_label.pack(fill='x')
         
         # Input area
         input_frame = tk.Frame(right_frame, bg='#34495e')
@@ -352,29 +3195,142 @@ class ChatClient:
         self.message_entry = tk.Entry(msg_frame)
         self.message_entry.pack(side='left', fill='x', expand=True, padx=(0, 5))
         self.message_entry.bind('<Return>', lambda e: self.send_message())
+        self.message_entry.bind('<Key>', self.on_typing)
         
         tk.Button(msg_frame, text="Send", bg='#27ae60', fg='white',
                  command=self.send_message).pack(side='right')
     
-    def load_rooms(self):
-        msg = {'type': 'get_rooms'}
-        self.socket.send(json.dumps(msg).encode())
+    def load_rooms(self, after=None):
+        # First page (or the one after `after`) of the rooms matching the filter; the server
+        # pushes directory changes from then on
+        self.rooms_loading = True
+        self.socket.send({'type': 'get_rooms', 'prefix': self.rooms_prefix, 'after': after,
+                          'limit': ROOM_PAGE_SIZE, 'subscribe': True})
+    
+    def catch_up_rooms(self, sock=None):
+        # The changes since rooms_version, or a fresh first page if there are too many
+        self.rooms_catching_up = True
+        (sock or self.socket).send({'type': 'get_rooms', 'since': self.rooms_version, 'prefix': self.rooms_prefix,
+                                    'limit': ROOM_PAGE_SIZE, 'subscribe': True})
+    
+    def apply_room_changes(self, msg):
+        self.rooms_catching_up = False
+        for change in msg['changes']:
+            self.apply_room_change(*change)
+        self.rooms_version = max(self.rooms_version, msg['version'])
+    
+    def on_room_filter(self, event=None):
+        if self.filter_scheduled:
+            self.root.after_cancel(self.filter_scheduled)
+        self.filter_scheduled = self.root.after(300, self.apply_room_filter)
+    
+    def apply_room_filter(self):
+        self.filter_scheduled = None
+        prefix = self.room_filter.get().strip()
+        if prefix != self.rooms_prefix:
+            self.rooms_prefix = prefix
+            self.load_rooms()
+    
+    def on_rooms_scroll(self, first, last):
+        if float(last) >= 1.0 and self.rooms_more and not self.rooms_loading and self.room_entries:
+            self.load_rooms(after=self.room_entries[-1][1])
+    
+    def show_rooms(self, msg):
+        if msg.get('prefix', '') != self.rooms_prefix:
+            return  # the filter has changed since
+        if not msg.get('after'):
+            self.room_entries = []
+            self.rooms_list.delete(0, 'end')
+        self.rooms_version = max(self.rooms_version, msg.get('version', 0))
+        self.rooms_more = msg.get('has_more', False)
+        self.rooms_loading = self.rooms_catching_up = False
+        for room_id, name, desc, online in msg['rooms']:
+            self.room_entries.append((name.casefold(), name, room_id, desc, online))
+            self.rooms_list.insert('end', self.room_display(name, room_id, desc, online))
+    
+    @staticmethod
+    def room_display(name, room_id, desc, online):
+        display = f"{room_id} - {name}"
+        if desc:
+            display += f" ({desc})"
+        if online:
+            display += f" [{online} online]"
+        return display
+    
+    def apply_room_change(self, version, room_id, name, desc, online=0):
+        # Removes the room's entry, then adds it back when the change has a name and the room
+        # matches the filter and falls within the pages loaded so far
+        if version <= self.rooms_version:
+            return
+        self.rooms_version = version
+        for index, entry in enumerate(self.room_entries):
+            if entry[2] == room_id:
+                del self.room_entries[index]
+                self.rooms_list.delete(index)
+                break
+        if name is None:
+            if self.current_room == room_id:
+                self.current_room = None
+                self.room_label.config(text="Room deleted")
+            return
+        entry = (name.casefold(), name, room_id, desc, online)
+        if not entry[0].startswith(self.rooms_prefix.casefold()):
+            return
+        index = bisect.bisect_left(self.room_entries, entry[:3])
+        if index < len(self.room_entries) or not self.rooms_more:
+            self.room_entries.insert(index, entry)
+            self.rooms_list.insert(index, self.room_display(name, room_id, desc, online))
+    
+    def on_room_delta(self, msg):
+        if msg['version'] <= self.rooms_version:
+            return
+        if msg['version'] != self.rooms_version + 1:
+            if not self.rooms_catching_up:
+                self.catch_up_rooms()  # missed a change
+            return
+        if msg['type'] == 'room_added':
+            self.apply_room_change(msg['version'], *msg['room'])
+        else:
+            self.apply_room_change(msg['version'], msg['room_id'], None, None)
+    
+    def delete_room(self):
+        selection = self.rooms_list.curselection()
+        if not selection:
+            return
+        _, name, room_id, _, _ = self.room_entries[selection[0]]
+        if messagebox.askyesno("Delete Room", f"Delete {name} and all its messages?"):
+            self.socket.send({'type': 'delete_room', 'room_id': room_id})
     
     def join_room(self, event=None):
         selection = self.rooms_list.curselection()
         if not selection:
             return
         
-        room_text = self.rooms_list.get(selection[0])
-        room_id = int(room_text.split(' - ')[0])
-        room_name = room_text.split(' - ')[1]
+        _, room_name, room_id, _, _ = self.room_entries[selection[0]]
         
+        if self.current_room and self.current_room != room_id:
+            self.socket.send({'type': 'leave_room', 'room_id': self.current_room})
         self.current_room = room_id
+        self.has_older = self.loading_older = False  # until this room's history arrives
+        self.activity = {'presence': {}, 'typing': {}, 'read': {}}
+        self.read_sent = 0
+        self.show_activity()
         self.room_label.config(text=f"Room: {room_name}")
         
         # Join room and get history
-        self.socket.send(json.dumps({'type': 'join_room', 'room_id': room_id}).encode())
-        self.socket.send(json.dumps({'type': 'get_history', 'room_id': room_id}).encode())
+        self.socket.send({'type': 'join_room', 'room_id': room_id})
+        self.socket.send({'type': 'get_history', 'room_id': room_id})
+    
+    def load_older(self):
+        if self.current_room and self.rendered and self.has_older and not self.loading_older:
+            self.loading_older = True
+            self.socket.send({'type': 'get_history', 'room_id': self.current_room,
+                              'before_id': self.rendered[0][0]})
+    
+    def on_scroll(self, first, last):
+        self.chat_area.vbar.set(first, last)
+        if float(first) <= 0.0:
+            self.load_older()
     
     def create_room_dialog(self):
         dialog = tk.Toplevel(self.root)
@@ -396,11 +3352,67 @@ class ChatClient:
             desc = desc_entry.get().strip()
             if name:
                 msg = {'type': 'create_room', 'name': name, 'description': desc}
-                self.socket.send(json.dumps(msg).encode())
+                self.socket.send(msg)
                 dialog.destroy()
         
         tk.Button(dialog, text="Create", bg='#27ae60', fg='white', command=create).pack(pady=20)
     
+    def search_dialog(self):
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Search Messages")
+        dialog.geometry("520x400")
+        dialog.configure(bg='#2c3e50')
+        
+        top = tk.Frame(dialog, bg='#2c3e50')
+        top.pack(fill='x', padx=10, pady=10)
+        query_entry = tk.Entry(top)
+        query_entry.pack(side='left', fill='x', expand=True)
+        this_room = tk.BooleanVar(value=self.current_room is not None)
+        tk.Checkbutton(top, text="This room", variable=this_room, fg='white', bg='#2c3e50',
+                       selectcolor='#34495e').pack(side='left', padx=5)
+        
+        results = tk.Text(dialog, bg='#34495e', fg='white', wrap='word', state='disabled')
+        results.pack(fill='both', expand=True, padx=10)
+        results.tag_config('hit', foreground='#f1c40f', font=('Arial', 10, 'bold'))
+        more_btn = tk.Button(dialog, text="More", state='disabled')
+        more_btn.pack(pady=5)
+        self.search_view = {'dialog': dialog, 'text': results, 'more': more_btn, 'request': None}
+        
+        def search(page=None):
+            msg = {'type': 'search', 'query': query_entry.get(),
+                   'room_id': self.current_room if this_room.get() else None}
+            if page:
+                msg.update(page)
+            else:
+                results.config(state='normal')
+                results.delete('1.0', 'end')
+                results.config(state='disabled')
+            self.search_view['request'] = msg
+            self.socket.send(msg)
+        
+        query_entry.bind('<Return>', lambda e: search())
+        more_btn.config(command=lambda: search(self.search_view.get('next')))
+        tk.Button(top, text="Search", command=search).pack(side='left')
+        query_entry.focus_set()
+    
+    def show_search_results(self, msg):
+        view = self.search_view
+        if not view or not view['dialog'].winfo_exists() or msg.get('query') != view['request']['query']:
+            return
+        text = view['text']
+        text.config(state='normal')
+        for msg_id, room_id, username, snippet, timestamp in msg['results']:
+            text.insert('end', f"#{room_id} [{timestamp}] {username}: ")
+            # Matched terms arrive wrapped in SNIPPET_MARKS
+            for i, part in enumerate(re.split('[' + ''.join(SNIPPET_MARKS) + ']', snippet)):
+                text.insert('end', part, 'hit' if i % 2 else ())
+            text.insert('end', '\n')
+        if not msg['results'] and text.index('end-1c') == '1.0':
+            text.insert('end', "No matches\n")
+        text.config(state='disabled')
+        view['next'] = msg.get('next')
+        view['more'].config(state='normal' if msg.get('has_more') else 'disabled')
+    
     def send_message(self):
         message = self.message_entry.get().strip()
         if not message or not self.current_room:
@@ -411,8 +3423,57 @@ class ChatClient:
             message = message.replace(shortcut, emoji)
         
         msg = {'type': 'chat_message', 'message': message}
-        self.socket.send(json.dumps(msg).encode())
+        self.socket.send(msg)
         self.message_entry.delete(0, 'end')
+        self.typing_sent = 0.0  # the server ends our typing indicator when the message arrives
+    
+    def on_typing(self, event):
+        # Typing is re-announced at most every few seconds while keys keep coming
+        if self.current_room and event.char and time.monotonic() - self.typing_sent > TYPING_TIMEOUT / 2:
+            self.typing_sent = time.monotonic()
+            self.socket.send({'type': 'typing', 'room_id': self.current_room, 'active': True})
+    
+    def schedule_read(self):
+        # Read receipts go out at most once a second, for the newest message shown
+        if not self.read_scheduled:
+            self.read_scheduled = True
+            self.root.after(1000, self.send_read)
+    
+    def send_read(self):
+        self.read_scheduled = False
+        last_id = next((item[0] for item in reversed(self.rendered) if item[0] is not None), None)
+        if self.current_room and last_id and last_id > self.read_sent:
+            self.read_sent = last_id
+            self.socket.send({'type': 'read', 'room_id': self.current_room, 'last_id': last_id})
+    
+    def apply_activity(self, msg):
+        if msg['room_id'] != self.current_room:
+            return
+        if msg.get('snapshot'):
+            self.activity = {'presence': {}, 'typing': {}, 'read': {}}
+        for kind, changes in self.activity.items():
+            for username, value in msg.get(kind, {}).items():
+                if value is None:
+                    changes.pop(username, None)
+                else:
+                    changes[username] = value
+        self.show_activity()
+    
+    def show_activity(self):
+        if not self.current_room:
+            self.activity_label.config(text="")
+            return
+        parts = [f"{len(self.activity['presence'])} online"]
+        typers = sorted(name for name in self.activity['typing'] if name != self.username)
+        if typers:
+            parts.append(f"{', '.join(typers[:3])}{' and others' if len(typers) > 3 else ''} typing…")
+        last_id = next((item[0] for item in reversed(self.rendered) if item[0] is not None), None)
+        if last_id:
+            readers = sorted(name for name, read in self.activity['read'].items()
+                             if read >= last_id and name != self.username)
+            if readers:
+                parts.append(f"seen by {', '.join(readers[:3])}{' and others' if len(readers) > 3 else ''}")
+        self.activity_label.config(text=" · ".join(parts))
     
     def send_image(self):
         if not self.current_room:
@@ -421,14 +3482,7 @@ class ChatClient:
         
         file_path = filedialog.askopenfilename(filetypes=[("Images", "*.png *.jpg *.jpeg *.gif")])
         if file_path:
-            try:
-                with open(file_path, 'rb') as f:
-                    data = base64.b64encode(f.read()).decode()
-                filename = os.path.basename(file_path)
-                msg = {'type': 'chat_message', 'message': f"[IMG:{filename}:{data}]", 'message_type': 'image'}
-                self.socket.send(json.dumps(msg).encode())
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to send image: {e}")
+            self.start_upload(file_path, 'image')
     
     def send_file(self):
         if not self.current_room:
@@ -437,18 +3491,128 @@ class ChatClient:
         
         file_path = filedialog.askopenfilename()
         if file_path:
+            if os.path.getsize(file_path) > MAX_BLOB_SIZE:
+                messagebox.showerror("Error", "File too large")
+                return
+            self.start_upload(file_path, 'file')
+    
+    def start_upload(self, file_path, msg_type):
+        # Hashing and streaming run off the Tk thread; the server answers upload_start
+        # with the offset to (re)start from, or upload_done if it already has the blob
+        def prepare():
             try:
-                if os.path.getsize(file_path) > 5*1024*1024:  # 5MB limit
-                    messagebox.showerror("Error", "File too large (max 5MB)")
-                    return
-                
-                with open(file_path, 'rb') as f:
-                    data = base64.b64encode(f.read()).decode()
-                filename = os.path.basename(file_path)
-                msg = {'type': 'chat_message', 'message': f"[FILE:{filename}:{data}]", 'message_type': 'file'}
-                self.socket.send(json.dumps(msg).encode())
+                digest = file_digest(file_path)
+                self.uploads[digest] = {'path': file_path, 'type': msg_type, 'room_id': self.current_room,
+                                        'name': os.path.basename(file_path),
+                                        'size': os.path.getsize(file_path), 'generation': 0}
+                self.socket.send({'type': 'upload_start', 'sha256': digest, 'kind': msg_type,
+                                  'size': self.uploads[digest]['size']})
             except Exception as e:
-                messagebox.showerror("Error", f"Failed to send file: {e}")
+                self.root.after(0, lambda err=e: messagebox.showerror("Error", f"Failed to send {msg_type}: {err}"))
+        threading.Thread(target=prepare, daemon=True).start()
+    
+    def stream_upload(self, digest, offset):
+        upload = self.uploads.get(digest)
+        if not upload:
+            return
+        upload['generation'] += 1
+        generation = upload['generation']
+        
+        def stream():
+            try:
+                with open(upload['path'], 'rb') as f:
+                    f.seek(offset)
+                    position = offset
+                    while upload['generation'] == generation:
+                        data = f.read(BLOB_CHUNK_SIZE)
+                        if not data:
+                            break
+                        self.socket.send({'type': 'upload_chunk', 'sha256': digest, 'offset': position,
+                                          'size': upload['size']}, data)
+                        position += len(data)
+            except OSError:
+                pass  # connection lost; the next upload_start resumes from the server's offset
+        threading.Thread(target=stream, daemon=True).start()
+    
+    def finish_upload(self, digest):
+        upload = self.uploads.pop(digest, None)
+        if upload:
+            self.socket.send({'type': 'chat_message', 'room_id': upload['room_id'], 'message': upload['name'],
+                              'message_type': upload['type'],
+                              'attachment': {'sha256': digest, 'name': upload['name']}})
+    
+    def fetch_blob(self, ref, on_complete, path=None, variant=None):
+        # Blobs are fetched lazily, one window at a time; into memory or straight to a file
+        key = (ref['sha256'], variant)
+        if key in self.blob_cache and path is None:
+            on_complete(self.blob_cache[key])
+            return
+        download = self.downloads.get(key)
+        if download and download['path'] == path:
+            download['callbacks'].append(on_complete)
+            return
+        sink = open(path, 'wb') if path else bytearray()
+        self.downloads[key] = {'sink': sink, 'path': path, 'received': 0, 'callbacks': [on_complete]}
+        self.socket.send({'type': 'fetch_blob', 'sha256': ref['sha256'], 'variant': variant,
+                          'offset': 0, 'length': MAX_FETCH_WINDOW})
+    
+    def receive_blob_chunk(self, msg):
+        key = (msg['sha256'], msg.get('variant'))
+        download = self.downloads.get(key)
+        if not download or msg['offset'] != download['received']:
+            return
+        if download['path']:
+            download['sink'].write(msg['data'])
+        else:
+            download['sink'] += msg['data']
+        download['received'] += len(msg['data'])
+        if download['received'] >= msg['size']:
+            del self.downloads[key]
+            if download['path']:
+                download['sink'].close()
+                result = download['path']
+            else:
+                result = bytes(download['sink'])
+                self.blob_cache[key] = result
+                while len(self.blob_cache) > 32:
+                    self.blob_cache.popitem(last=False)
+            for callback in download['callbacks']:
+                self.root.after(0, lambda cb=callback: cb(result))
+        elif download['received'] % MAX_FETCH_WINDOW == 0:
+            self.socket.send({'type': 'fetch_blob', 'sha256': msg['sha256'], 'variant': msg.get('variant'),
+                              'offset': download['received'], 'length': MAX_FETCH_WINDOW})
+    
+    def save_attachment(self, ref):
+        path = filedialog.asksaveasfilename(initialfile=ref.get('name', 'file'))
+        if path:
+            self.fetch_blob(ref, lambda saved: messagebox.showinfo("Download", f"Saved to {saved}"), path)
+    
+    def cache_photo(self, key, photo):
+        self.photos[key] = photo
+        self.photos.move_to_end(key)
+        # Tk blanks an image the moment its last PhotoImage goes, so photos still shown in
+        # the widget (which may hold more messages than the cache) are skipped
+        excess = len(self.photos) - PHOTO_CACHE_SIZE
+        if excess > 0:
+            for old in [k for k in self.photos if k not in self.photo_pins][:excess]:
+                del self.photos[old]
+        return photo
+    
+    def pin_photo(self, key, keys):
+        self.photo_pins[key] = self.photo_pins.get(key, 0) + 1
+        keys.append(key)
+    
+    def show_thumbnail(self, mark, digest, data):
+        # Thumbnails arrive as small PNGs that Tk decodes natively, no Pillow work needed
+        try:
+            photo = self.photos.get(digest) or self.cache_photo(
+                digest, tk.PhotoImage(data=base64.b64encode(data).decode()))
+            state = self.chat_area.cget('state')  # may be called mid-render from display_message
+            self.chat_area.config(state='normal')
+            self.chat_area.image_create(mark, image=photo)
+            self.chat_area.config(state=state)
+        except Exception:
+            pass  # the room was re-rendered and the mark is gone, or the image is unreadable
     
     def insert_emoji(self, emoji):
         pos = self.message_entry.index(tk.INSERT)
@@ -458,91 +3622,280 @@ class ChatClient:
         self.message_entry.insert(0, new_text)
         self.message_entry.icursor(pos + len(emoji))
     
-    def display_message(self, username, message, msg_type='text', timestamp=None):
-        self.chat_area.config(state='normal')
-        
+    def new_mark(self, index, prefix='msg'):
+        mark = f"{prefix}{next(self.mark_ids)}"
+        self.chat_area.mark_set(mark, 'end-1c' if index == 'end' else index)
+        self.chat_area.mark_gravity(mark, 'left')
+        return mark
+    
+    def display_message(self, username, message, msg_type='text', timestamp=None, index='end'):
+        # Inserts one message at index ('end', or a right-gravity mark when prepending);
+        # the widget must already be editable. Returns marks where thumbnails will go and the
+        # keys of the photos it shows.
         time_str = timestamp or datetime.now().strftime('%H:%M:%S')
-        self.chat_area.insert('end', f"[{time_str}] {username}: ")
+        self.chat_area.insert(index, f"[{time_str}] {username}: ")
+        ref = parse_attachment(message) if msg_type in ('image', 'file') else None
+        image_marks, photo_keys = [], []
         
-        if msg_type == 'image' and message.startswith('[IMG:'):
+        if ref and msg_type == 'image':
+            tag = f"file_{ref['sha256'][:16]}"
+            self.chat_area.insert(index, f"📷 {ref.get('name', 'image')}", tag)
+            self.chat_area.insert(index, '\n')
+            self.chat_area.tag_bind(tag, '<Button-1>', lambda e, ref=ref: self.save_attachment(ref))
+            mark = self.new_mark(index, 'img')
+            image_marks.append(mark)
+            self.chat_area.insert(index, '\n')
+            digest = ref['sha256']
+            self.pin_photo(digest, photo_keys)
+            if digest in self.photos:
+                self.show_thumbnail(mark, digest, None)
+            else:
+                self.fetch_blob(ref, lambda data, mark=mark: self.show_thumbnail(mark, digest, data),
+                                variant='thumb')
+        elif ref:
+            tag = f"file_{ref['sha256'][:16]}"
+            self.chat_area.insert(index, f"📎 {ref.get('name', 'file')} ({ref.get('size', 0) // 1024} KB)", tag)
+            self.chat_area.insert(index, '\n')
+            self.chat_area.tag_config(tag, foreground='#3498db', underline=True)
+            self.chat_area.tag_bind(tag, '<Button-1>', lambda e, ref=ref: self.save_attachment(ref))
+        elif msg_type == 'image' and message.startswith('[IMG:'):
             try:
                 parts = message[5:-1].split(':', 2)
                 filename = parts[0]
-                self.chat_area.insert('end', f"📷 {filename}\n")
+                self.chat_area.insert(index, f"📷 {filename}\n")
                 
                 # Show small image preview
-                image_data = base64.b64decode(parts[1])
-                img = Image.open(io.BytesIO(image_data))
-                img.thumbnail((150, 150))
-                photo = ImageTk.PhotoImage(img)
-                self.chat_area.image_create('end', image=photo)
-                self.chat_area.insert('end', '\n')
-                
-                # Keep reference
-                if not hasattr(self, 'images'):
-                    self.images = []
-                self.images.append(photo)
+                key = hashlib.sha256(parts[1].encode()).hexdigest()
+                photo = self.photos.get(key)
+                if photo is None:
+                    image_data = base64.b64decode(parts[1])
+                    img = Image.open(io.BytesIO(image_data))
+                    img.thumbnail(THUMBNAIL_SIZE)
+                    photo = self.cache_photo(key, ImageTk.PhotoImage(img))
+                self.pin_photo(key, photo_keys)
+                self.chat_area.image_create(index, image=photo)
+                self.chat_area.insert(index, '\n')
             except:
-                self.chat_area.insert('end', f"[Image error]\n")
+                self.chat_area.insert(index, f"[Image error]\n")
         elif msg_type == 'file' and message.startswith('[FILE:'):
             filename = message[6:-1].split(':', 1)[0]
-            self.chat_area.insert('end', f"📎 {filename}\n")
+            self.chat_area.insert(index, f"📎 {filename}\n")
         else:
-            self.chat_area.insert('end', f"{message}\n")
+            self.chat_area.insert(index, f"{message}\n")
+        return image_marks, photo_keys
+    
+    def render_row(self, row, index='end'):
+        msg_id, username, message, m_type, timestamp = row
+        start = self.new_mark(index)
+        return (msg_id, start, *self.display_message(username, message, m_type, timestamp, index))
+    
+    def forget_rendered(self, item):
+        for mark in (item[1], *item[2]):
+            self.chat_area.mark_unset(mark)
+        for key in item[3]:
+            left = self.photo_pins.pop(key) - 1
+            if left:
+                self.photo_pins[key] = left
+    
+    def queue_render(self, kind, payload):
+        # Called from the listener thread; everything that arrives within one tick is
+        # drawn by a single flush_inbox call
+        with self.render_lock:
+            self.inbox.append((kind, payload))
+            if self.render_scheduled:
+                return
+            self.render_scheduled = True
+        self.root.after(RENDER_INTERVAL_MS, self.flush_inbox)
+    
+    def flush_inbox(self):
+        with self.render_lock:
+            items = list(self.inbox)
+            self.inbox.clear()
+            self.render_scheduled = False
+        
+        at_bottom = self.chat_area.yview()[1] >= 0.999
+        appended = []
+        self.chat_area.config(state='normal')
+        for kind, (room_id, rows, has_more) in items:
+            if room_id != self.current_room:
+                continue
+            if kind == 'history':
+                for item in self.rendered:
+                    self.forget_rendered(item)
+                self.rendered.clear()
+                self.chat_area.delete('1.0', 'end')
+                self.has_older = has_more
+                appended = list(rows)
+            elif kind == 'message':
+                # A replay after a resume can overlap live messages; ids only grow, so drop repeats
+                last = appended[-1][0] if appended else self.rendered[-1][0] if self.rendered else None
+                appended.extend(row for row in rows if last is None or row[0] is None or row[0] > last)
+            elif kind == 'older':
+                self.prepend_rows(rows)
+                self.has_older = has_more
+                self.loading_older = False
         
+        # Rows beyond the cap would be trimmed straight away, so don't draw them at all;
+        # they stay reachable by scrolling up
+        if len(appended) > MAX_RENDERED_MESSAGES:
+            appended = appended[-MAX_RENDERED_MESSAGES:]
+            self.has_older = True
+        for row in appended:
+            self.rendered.append(self.render_row(row))
+        self.trim_scrollback(at_bottom)
         self.chat_area.config(state='disabled')
-        self.chat_area.see('end')
+        self.older_btn.config(state='normal' if self.has_older else 'disabled')
+        if appended and at_bottom:
+            self.chat_area.see('end')
+            self.schedule_read()
+        if appended:
+            self.show_activity()
+    
+    def prepend_rows(self, rows):
+        if not rows:
+            return
+        first = self.rendered[0][1] if self.rendered else None
+        if first:
+            self.chat_area.mark_gravity(first, 'right')  # let the page go in above it
+        self.chat_area.mark_set('prepend', '1.0')
+        self.chat_area.mark_gravity('prepend', 'right')
+        page = [self.render_row(row, 'prepend') for row in rows]
+        self.chat_area.mark_unset('prepend')
+        self.rendered.extendleft(reversed(page))
+        if first:
+            self.chat_area.mark_gravity(first, 'left')
+            self.chat_area.yview(first)  # keep the view where it was instead of at the new top
+    
+    def trim_scrollback(self, at_bottom):
+        # Drop the oldest messages over the cap; while the user is reading scrollback
+        # the widget may grow to twice the cap before it is trimmed anyway
+        excess = len(self.rendered) - MAX_RENDERED_MESSAGES
+        if excess <= 0 or (not at_bottom and excess < MAX_RENDERED_MESSAGES):
+            return
+        self.chat_area.delete('1.0', self.rendered[excess][1])
+        for _ in range(excess):
+            self.forget_rendered(self.rendered.popleft())
+        self.has_older = True
     
     def start_listener(self):
         def listen():
             while True:
                 try:
-                    data = self.socket.recv(4096).decode()
-                    if not data:
-                        break
-                    msg = json.loads(data)
-                    self.handle_message(msg)
+                    msg = self.socket.recv()
                 except:
+                    msg = None
+                if msg is not None:
+                    self.handle_message(msg)
+                elif self.closing or not self.reconnect():
                     break
         
         threading.Thread(target=listen, daemon=True).start()
     
+    def reconnect(self, attempts=8):
+        # Resumes the session on a new connection after a network drop; the server rejoins
+        # the current room and replays what was missed since the last message shown
+        last_id = self.rendered[-1][0] if self.rendered else None
+        rooms = [[self.current_room, last_id]] if self.current_room else []
+        for attempt in range(attempts):
+            time.sleep(min(0.5 * 2 ** attempt, 10))
+            if self.closing or not self.token:
+                return False
+            try:
+                sock = FramedSocket(socket.create_connection(('localhost', 12345), timeout=5))
+                sock.sock.settimeout(None)
+                sock.send({'type': 'resume', 'token': self.token, 'rooms': rooms,
+                           'versions': list(SUPPORTED_VERSIONS), 'compression': list(COMPRESSION_CODECS)})
+                reply = sock.recv() or {}
+            except OSError:
+                continue
+            if reply.get('type') == 'resumed':
+                sock.codec = reply.get('compression')
+                self.socket = sock
+                self.catch_up_rooms(sock)  # on the directory changes missed while disconnected
+                return True
+            sock.close()
+            break  # the session is gone; only a new login helps
+        self.root.after(0, lambda: messagebox.showerror("Disconnected", "Connection lost, please log in again"))
+        return False
+    
     def handle_message(self, msg):
         msg_type = msg.get('type')
         
         if msg_type == 'new_message':
-            self.root.after(0, lambda: self.display_message(
-                msg['username'], msg['message'], 
-                msg.get('message_type', 'text'), msg['timestamp']))
+            row = (msg.get('id'), msg['username'], msg['message'], msg.get('message_type', 'text'),
+                   msg['timestamp'])
+            self.queue_render('message', (msg.get('room_id', self.current_room), [row], None))
                 
         elif msg_type == 'rooms_list':
-            def update_rooms():
-                self.rooms_list.delete(0, 'end')
-                for room_id, name, desc in msg['rooms']:
-                    display = f"{room_id} - {name}"
-                    if desc:
-                        display += f" ({desc})"
-                    self.rooms_list.insert('end', display)
-            self.root.after(0, update_rooms)
+            self.root.after(0, lambda: self.show_rooms(msg))
+            
+        elif msg_type in ('room_added', 'room_removed'):
+            self.root.after(0, lambda: self.on_room_delta(msg))
+            
+        elif msg_type == 'rooms_changed':
+            self.root.after(0, lambda: self.apply_room_changes(msg))
             
         elif msg_type == 'history':
-            def show_history():
-                self.chat_area.config(state='normal')
-                self.chat_area.delete('1.0', 'end')
-                for username, message, m_type, timestamp in msg['data']:
-                    self.display_message(username, message, m_type, timestamp)
-                self.chat_area.config(state='disabled')
-            self.root.after(0, show_history)
+            # A page requested with before_id is an older page to prepend, one with after_id
+            # (replayed after a resume) continues the current view
+            kind = 'older' if msg.get('before_id') else 'message' if msg.get('after_id') else 'history'
+            self.queue_render(kind, (msg.get('room_id', self.current_room), msg['data'],
+                                     msg.get('has_more', False)))
+            
+        elif msg_type == 'search_results':
+            self.root.after(0, lambda: self.show_search_results(msg))
+            
+        elif msg_type == 'room_activity':
+            self.root.after(0, lambda: self.apply_activity(msg))
+            
+        elif msg_type == 'upload_ready':
+            self.stream_upload(msg['sha256'], msg['offset'])
+            
+        elif msg_type == 'upload_done':
+            self.finish_upload(msg['sha256'])
+            
+        elif msg_type == 'upload_failed':
+            self.uploads.pop(msg['sha256'], None)
+            self.root.after(0, lambda: messagebox.showerror("Error", msg.get('reason', "Upload failed")))
+            
+        elif msg_type == 'blob_chunk':
+            self.receive_blob_chunk(msg)
+            
+        elif msg_type == 'blob_missing':
+            download = self.downloads.pop((msg['sha256'], msg.get('variant')), None)
+            if download and download['path']:
+                download['sink'].close()
+            
+        elif msg_type == 'throttled':
+            # Sending too fast: the request was dropped, so say so until it could be retried
+            if msg.get('request') == 'get_history':
+                self.loading_older = False
+            retry_after = max(1, round(msg.get('retry_after', 1)))
+            self.root.after(0, lambda: self.root.title(f"Chat - {self.username} (slow down, retry in {retry_after}s)"))
+            self.root.after(retry_after * 1000, lambda: self.root.title(f"Chat - {self.username}"))
+            
+        elif msg_type == 'error':
+            # The server couldn't serve a request just now (e.g. its database was busy)
+            self.loading_older = False
+            reason = msg.get('reason', "Server error")
+            self.root.after(0, lambda: self.root.title(f"Chat - {self.username} ({reason})"))
+            self.root.after(3000, lambda: self.root.title(f"Chat - {self.username}"))
             
         elif msg_type == 'room_created':
+            # The room itself arrives as a room_added delta
             if msg['success']:
                 self.root.after(0, lambda: messagebox.showinfo("Success", "Room created!"))
-                self.load_rooms()
             else:
                 self.root.after(0, lambda: messagebox.showerror("Error", "Room name exists"))
+            
+        elif msg_type == 'room_deleted':
+            if not msg['success']:
+                self.root.after(0, lambda: messagebox.showerror("Error", "Only the room's creator can delete it"))
     
     def on_close(self):
+        self.closing = True
         try:
+            self.socket.send({'type': 'logout'})
             self.socket.close()
         except:
             pass
@@ -556,21 +3909,1520 @@ def start_server():
     threading.Thread(target=server.start, daemon=True).start()
     time.sleep(1)  # Wait for server to start
 
+def raise_fd_limit():
+    # Thousands of sockets need more descriptors than the usual soft limit of 1024
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+def process_tree(pid):
+    # pid and all its descendants, e.g. a sharded server's workers (Linux only)
+    pids = [pid]
+    for parent in pids:
+        try:
+            for tid in os.listdir(f'/proc/{parent}/task'):
+                with open(f'/proc/{parent}/task/{tid}/children') as f:
+                    pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+def process_stats(pid):
+    # RSS, thread count and CPU seconds used by the server process and its children (Linux only)
+    stats = {'rss_kb': None, 'threads': None, 'cpu_s': None}
+    for proc in process_tree(pid) if pid else ():
+        try:
+            with open(f'/proc/{proc}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        stats['rss_kb'] = (stats['rss_kb'] or 0) + int(line.split()[1])
+                    elif line.startswith('Threads:'):
+                        stats['threads'] = (stats['threads'] or 0) + int(line.split()[1])
+            with open(f'/proc/{proc}/stat') as f:
+                utime, stime = f.read().rsplit(')', 1)[1].split()[11:13]
+            stats['cpu_s'] = (stats['cpu_s'] or 0) + (int(utime) + int(stime)) / os.sysconf('SC_CLK_TCK')
+        except OSError:
+            pass
+    return stats
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+async def bench_request(stream, msg, expect):
+    await stream.send(msg)
+    while True:
+        reply = await asyncio.wait_for(stream.recv(), 10)
+        if reply is None:
+            raise ConnectionError("Server closed connection")
+        if reply.get('type') == expect:
+            return reply
+
+async def bench_connect(port, room_id, token):
+    # Connections share one session token, so the benchmark measures messaging, not the KDF
+    # (and the servers run without rate limits, which would throttle the shared user)
+    stream = FramedStream(*await asyncio.wait_for(asyncio.open_connection('localhost', port), 10))
+    await bench_request(stream, {'type': 'resume', 'token': token, 'rooms': [[room_id, None]],
+                                 'versions': list(SUPPORTED_VERSIONS)}, 'resumed')
+    return stream
+
+async def bench_register(port):
+    # Registers and logs in the benchmark user once; returns its session token
+    stream = FramedStream(*await asyncio.open_connection('localhost', port))
+    await bench_request(stream, {'type': 'register', 'username': 'bench', 'password': 'bench',
+                                 'versions': list(SUPPORTED_VERSIONS)}, 'register_result')
+    reply = await bench_request(stream, {'type': 'login', 'username': 'bench', 'password': 'bench',
+                                         'versions': list(SUPPORTED_VERSIONS)}, 'login_success')
+    stream.close()
+    return reply['token']
+
+async def bench_worker(stream, idx, deadline, stats):
+    # Closed loop: send one message, wait for our own echo, repeat
+    seq = 0
+    while time.perf_counter() < deadline:
+        marker = f'bench-{idx}-{seq}'
+        started = time.perf_counter()
+        await stream.send({'type': 'chat_message', 'message': marker})
+        while True:
+            msg = await asyncio.wait_for(stream.recv(), 10)
+            if msg is None:
+                return
+            if msg.get('type') == 'new_message':
+                stats['delivered'] += 1
+                if msg['message'] == marker:
+                    break
+        stats['latencies'].append(time.perf_counter() - started)
+        seq += 1
+
+async def bench_load(port, pid, connections, duration, room_size, first_room=1000):
+    token = await bench_register(port)
+    results = await asyncio.gather(*(bench_connect(port, first_room + i // room_size, token)
+                                     for i in range(connections)), return_exceptions=True)
+    streams = [r for r in results if not isinstance(r, BaseException)]
+    stats = {'connections': len(streams), 'delivered': 0, 'latencies': []}
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*(bench_worker(st, i, deadline, stats) for i, st in enumerate(streams)),
+                         return_exceptions=True)
+    stats['server'] = process_stats(pid)
+    for st in streams:
+        st.close()
+    return stats
+
+async def bench_fanout(port, sizes, messages):
+    # Latency from one member sending until the last member of the room has the message
+    token = await bench_register(port)
+    results = {}
+    for size in sizes:
+        room_id = 2000 + size
+        members = await asyncio.gather(*(bench_connect(port, room_id, token) for _ in range(size)))
+        latencies = []
+        for seq in range(messages):
+            marker = f'fanout-{size}-{seq}'
+            started = time.perf_counter()
+            await members[0].send({'type': 'chat_message', 'message': marker})
+            
+            async def receive(stream):
+                while (await stream.recv())['message'] != marker:
+                    pass
+            await asyncio.wait_for(asyncio.gather(*(receive(m) for m in members)), 30)
+            latencies.append(time.perf_counter() - started)
+        for m in members:
+            m.close()
+        results[size] = latencies
+    return results
+
+def benchmark_history(sizes=(1_000_000, 10_000_000), rooms=1000, pages=20):
+    # Latest page, a scroll-back through `pages` pages, and a forward catch-up,
+    # each with the (room_id, id) index and with it disabled via NOT INDEXED
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'history.db')
+            conn = sqlite3.connect(path)
+            conn.execute('''CREATE TABLE messages (id INTEGER PRIMARY KEY, room_id INTEGER, username TEXT,
+                            message TEXT, type TEXT DEFAULT 'text', timestamp TEXT)''')
+            started = time.perf_counter()
+            conn.execute('''WITH RECURSIVE seq(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM seq WHERE x < ?)
+                            INSERT INTO messages (room_id, username, message, type, timestamp)
+                            SELECT x % ?, 'user' || (x % 97), 'message number ' || x, 'text', '12:00:00' FROM seq''',
+                         (size, rooms))
+            conn.commit()
+            print(f"{size:,} messages in {rooms} rooms: generated in {time.perf_counter() - started:.1f}s")
+            started = time.perf_counter()
+            conn.executescript(MIGRATIONS[0])
+            print(f"  index build (migration) {time.perf_counter() - started:.1f}s")
+            
+            room_id = rooms // 2
+            for label, source in (('indexed', 'messages'), ('no index', 'messages NOT INDEXED')):
+                columns = f"SELECT id, username, message, type, timestamp FROM {source}"
+                timings = {}
+                started = time.perf_counter()
+                rows = conn.execute(f"{columns} WHERE room_id=? ORDER BY id DESC LIMIT 50", (room_id,)).fetchall()
+                timings['latest page'] = time.perf_counter() - started
+                started = time.perf_counter()
+                for _ in range(pages):
+                    rows = conn.execute(f"{columns} WHERE room_id=? AND id<? ORDER BY id DESC LIMIT 50",
+                                        (room_id, rows[-1][0])).fetchall()
+                timings[f'{pages} pages back'] = time.perf_counter() - started
+                started = time.perf_counter()
+                conn.execute(f"{columns} WHERE room_id=? AND id>? ORDER BY id LIMIT 50",
+                             (room_id, size // 2)).fetchall()
+                timings['after_id page'] = time.perf_counter() - started
+                print(f"  {label:9} " + " | ".join(f"{k} {v * 1000:8.2f}ms" for k, v in timings.items()))
+            conn.close()
+
+def stress_db(pool_sizes=(1, DB_READERS), reader_threads=8, writer_threads=4, duration=5.0, preload=200_000,
+              rooms=100):
+    # Hammers one ChatDatabase with concurrent readers and writers, checking as it goes:
+    # every history page is ordered and belongs to its room, each writer reads its own
+    # message back straight away, a new account can log in at once, and in the end every
+    # message was stored exactly once. Reports read throughput per read pool size.
+    failures = 0
+    for pool_size in pool_sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'stress.db')
+            ChatDatabase(path, archive_dir=os.path.join(tmp, 'archive')).close()
+            conn = connect_db(path)
+            conn.execute('''WITH RECURSIVE seq(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM seq WHERE x < ?)
+                            INSERT INTO messages (room_id, username, message, type, timestamp)
+                            SELECT x % ?, 'old', (x % ?) || ':old:' || x, 'text', '12:00:00' FROM seq''',
+                         (preload, rooms, rooms))
+            conn.executemany("INSERT INTO rooms (name, description) VALUES (?, '')",
+                             [(f'room{i}',) for i in range(rooms)])
+            conn.commit()
+            conn.close()
+            db = ChatDatabase(path, archive_dir=os.path.join(tmp, 'archive'), readers=pool_size)
+            stop = threading.Event()
+            errors = []
+            reads, writes = [], [0] * writer_threads
+            
+            def check(condition, what):
+                if not condition:
+                    errors.append(what)
+            
+            def writer(w):
+                rng = random.Random(w)
+                seq = 0
+                while not stop.is_set():
+                    try:
+                        room_id = rng.randrange(rooms)
+                        msg_id = db.save_message(room_id, f'w{w}', f'{room_id}:w{w}:{seq}')
+                        seq += 1
+                        if seq % 10 == 0:
+                            rows, _ = db.get_history(room_id, 1, after_id=msg_id - 1)
+                            check(rows and rows[0][0] == msg_id, f"w{w} did not read back message {msg_id}")
+                        if seq % 100 == 0:
+                            name = f'w{w}-{seq}'
+                            check(db.register_user(name, 'x'), f"registering {name} failed")
+                            check(db.get_credentials(name) is not None, f"{name} cannot log in after registering")
+                    except Exception as e:
+                        errors.append(f"writer: {e!r}")
+                writes[w] = seq
+            
+            def reader(r):
+                rng = random.Random(1000 + r)
+                latencies = []
+                while not stop.is_set():
+                    room_id = rng.randrange(rooms)
+                    started = time.perf_counter()
+                    try:
+                        op = rng.random()
+                        if op < 0.7:
+                            # Scroll back from the latest page, bypassing the in-memory cache
+                            rows, _ = db.query_history(room_id, 50)
+                            if rows:
+                                older, _ = db.query_history(room_id, 50, before_id=rows[0][0])
+                                rows = older + rows
+                            ids = [row[0] for row in rows]
+                            check(ids == sorted(set(ids)), f"room {room_id} history out of order")
+                            check(all(row[2].split(':')[0] == str(room_id) for row in rows),
+                                  f"room {room_id} history has another room's messages")
+                        elif op < 0.9:
+                            check(len(db.get_rooms()) > rooms, "rooms missing")
+                        else:
+                            db.get_credentials(f'w{rng.randrange(writer_threads)}-100')
+                    except Exception as e:
+                        errors.append(f"reader: {e!r}")
+                    latencies.append(time.perf_counter() - started)
+                reads.append(latencies)
+            
+            threads = [threading.Thread(target=writer, args=(w,)) for w in range(writer_threads)]
+            threads += [threading.Thread(target=reader, args=(r,)) for r in range(reader_threads)]
+            for thread in threads:
+                thread.start()
+            time.sleep(duration)
+            stop.set()
+            for thread in threads:
+                thread.join()
+            db.flush()
+            # Every acknowledged message is stored exactly once, and in each writer's order
+            for w in range(writer_threads):
+                stored = [int(message.split(':')[2]) for (message,) in db.read(
+                    "SELECT inflate(message) FROM messages WHERE username=? ORDER BY id", (f'w{w}',))]
+                check(stored == list(range(writes[w])), f"w{w}: stored {len(stored)} of {writes[w]} messages")
+            db.close()
+            latencies = [x for thread in reads for x in thread]
+            failures += len(errors)
+            print(f"{pool_size} reader connection(s), {reader_threads} reader + {writer_threads} writer threads: "
+                  f"{len(latencies) / duration:,.0f} reads/s (p50 {percentile(latencies, 50) * 1000:.2f}ms "
+                  f"p99 {percentile(latencies, 99) * 1000:.2f}ms) during {sum(writes) / duration:,.0f} writes/s | "
+                  f"{len(errors)} errors")
+            for error in errors[:5]:
+                print(f"  {error}")
+    return failures
+
+def parse_retention(spec):
+    # --room-retention ROOM=DAYS/COUNT -> (room_id, max age in days, max messages)
+    room, _, limits = spec.partition('=')
+    days, _, count = limits.partition('/')
+    return int(room), float(days) if days else None, int(count) if count else None
+
+def file_size(path):
+    return sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+
+def compact(db_path, archive_dir='archive', default=(None, None)):
+    # --compact: a retention pass with the server stopped, then a full VACUUM, which also
+    # switches an older file to incremental vacuum so later passes can shrink it live
+    before = file_size(db_path)
+    db = ChatDatabase(db_path, archive_dir=archive_dir)
+    started = time.perf_counter()
+    moved, _ = RetentionEngine(db, default, pause=0).run_once()
+    print(f"Archived {moved:,} messages in {time.perf_counter() - started:.1f}s")
+    started = time.perf_counter()
+    with db.write_lock:
+        db.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        db.conn.execute("VACUUM")
+        db.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    archived = db.archive.size()
+    db.close()
+    print(f"Vacuumed in {time.perf_counter() - started:.1f}s: {before / 1024 / 1024:.1f} MB -> "
+          f"{file_size(db_path) / 1024 / 1024:.1f} MB (archive {archived / 1024 / 1024:.1f} MB)")
+
+def benchmark_retention(size=1_000_000, rooms=1000, days=180, keep_days=30, duration=5.0):
+    # A retention pass over `size` messages spread over `days` days, keeping `keep_days`,
+    # while a client thread posts messages (durability 'full', so each waits for its
+    # commit) and pages history: latency with and without the pass, the space it frees
+    # and what archived history costs to read
+    with tempfile.TemporaryDirectory() as tmp:
+        path, archive_dir = os.path.join(tmp, 'retention.db'), os.path.join(tmp, 'archive')
+        ChatDatabase(path, archive_dir=archive_dir).close()
+        conn = connect_db(path)
+        started, now = time.perf_counter(), time.time()
+        conn.execute('''WITH RECURSIVE seq(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM seq WHERE x < ?)
+                        INSERT INTO messages (room_id, username, message, type, timestamp, created)
+                        SELECT x % ?, 'user' || (x % 97), 'message number ' || x || ' ' || hex(randomblob(8)),
+                               'text', '12:00:00', ? + x * ? FROM seq''', (size, rooms, now - days * 86400, days * 86400 / size))
+        conn.commit()
+        before = file_size(path)
+        print(f"{size:,} messages in {rooms} rooms over {days} days, keeping {keep_days}: generated in "
+              f"{time.perf_counter() - started:.1f}s, {before / 1024 / 1024:.1f} MB")
+        db = ChatDatabase(path, 'full', archive_dir=archive_dir)
+        
+        def client(stats, stop):
+            rng = random.Random(1)
+            while not stop.is_set():
+                room_id = rng.randrange(rooms)
+                started = time.perf_counter()
+                db.save_message(room_id, 'bench', 'live message')
+                stats['post'].append(time.perf_counter() - started)
+                started = time.perf_counter()
+                db.query_history(room_id, 50)
+                stats['history'].append(time.perf_counter() - started)
+                time.sleep(0.005)
+        
+        def measure(work):
+            stats, stop = {'post': [], 'history': []}, threading.Event()
+            thread = threading.Thread(target=client, args=(stats, stop))
+            thread.start()
+            started = time.perf_counter()
+            result = work()
+            elapsed = time.perf_counter() - started
+            stop.set()
+            thread.join()
+            print(" | ".join(f"{op} p50 {percentile(lat, 50) * 1000:6.2f}ms p99 {percentile(lat, 99) * 1000:7.2f}ms "
+                             f"max {max(lat, default=0) * 1000:7.1f}ms" for op, lat in stats.items()))
+            return result, elapsed
+        
+        print("idle:            ", end='')
+        measure(lambda: time.sleep(duration))
+        engine = RetentionEngine(db, (keep_days, None), pause=0.002)
+        print("retention pass:  ", end='')
+        (moved, freed), elapsed = measure(engine.run_once)
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        print(f"archived {moved:,} messages in {elapsed:.1f}s ({moved / elapsed:,.0f}/s), freed {freed:,} pages: "
+              f"{before / 1024 / 1024:.1f} MB -> {file_size(path) / 1024 / 1024:.1f} MB live + "
+              f"{db.archive.size() / 1024 / 1024:.1f} MB archive")
+        latencies = []
+        for room_id in range(0, rooms, max(1, rooms // 50)):
+            oldest = conn.execute("SELECT MIN(id) FROM messages WHERE room_id=?", (room_id,)).fetchone()[0]
+            started = time.perf_counter()
+            rows, _ = db.query_history(room_id, 50, before_id=oldest)
+            latencies.append(time.perf_counter() - started)
+        print(f"archived history page: p50 {percentile(latencies, 50) * 1000:.2f}ms "
+              f"p99 {percentile(latencies, 99) * 1000:.2f}ms ({len(rows)} rows)")
+        conn.close()
+        db.close()
+
+def benchmark_search(sizes=(1_000_000, 10_000_000), rooms=1000, repeats=20):
+    # Search latency through ChatDatabase.search on a synthetic corpus: terms that are
+    # rare, medium and common across all rooms and within one room, ranked and by recency
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'search.db')
+            conn = sqlite3.connect(path)
+            conn.execute('''CREATE TABLE messages (id INTEGER PRIMARY KEY, room_id INTEGER, username TEXT,
+                            message TEXT, type TEXT DEFAULT 'text', timestamp TEXT)''')
+            started = time.perf_counter()
+            # alphaN is in 1 of 1000 messages, betaN in 1 of 37, gammaN in 1 of 5
+            conn.execute('''WITH RECURSIVE seq(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM seq WHERE x < ?)
+                            INSERT INTO messages (room_id, username, message, type, timestamp)
+                            SELECT x % ?, 'user' || (x % 97),
+                                   'note alpha' || (x * 7 % 1000) || ' beta' || (x % 37) || ' gamma' || (x % 5)
+                                   || ' number ' || x, 'text', '12:00:00' FROM seq''', (size, rooms))
+            conn.commit()
+            conn.close()
+            print(f"{size:,} messages in {rooms} rooms: generated in {time.perf_counter() - started:.1f}s")
+            started = time.perf_counter()
+            db = ChatDatabase(path)  # runs the migrations, including the FTS backfill
+            print(f"  index build (migration) {time.perf_counter() - started:.1f}s")
+            room_id = rooms // 2
+            for label, query in (('rare', 'alpha123'), ('medium', 'beta5'), ('common', 'gamma1'),
+                                 ('two terms', 'beta5 gamma1'), ('prefix', 'alpha12*')):
+                timings = []
+                for scope, order in ((None, 'rank'), (None, 'recent'), (room_id, 'rank'), (room_id, 'recent')):
+                    started = time.perf_counter()
+                    for _ in range(repeats):
+                        db.search(query, scope, 20, order)
+                    timings.append((time.perf_counter() - started) / repeats)
+                print(f"  {label:9} all rooms: rank {timings[0] * 1000:8.2f}ms recent {timings[1] * 1000:8.2f}ms | "
+                      f"one room: rank {timings[2] * 1000:8.2f}ms recent {timings[3] * 1000:8.2f}ms")
+            db.close()
+
+def chat_text(rng, words):
+    vocabulary = ("the a to and of is in it you that for on was with this are be have at not but what "
+                  "we can do so if just like about meeting tomorrow deploy build server room message "
+                  "thanks ok sure lunch today see review code test release fix bug").split()
+    return ' '.join(rng.choice(vocabulary) for _ in range(words))
+
+def benchmark_compression(levels=(1, 6, 9), repeats=200):
+    # Bytes saved against CPU spent for representative frames, per codec and level,
+    # then the disk saved by storing large message bodies compressed
+    rng = random.Random(0)
+    stamp = '12:00:00'
+    message = lambda i, text: {'type': 'new_message', 'id': i, 'room_id': 1, 'username': f'user{i % 50}',
+                               'message': text, 'message_type': 'text', 'timestamp': stamp}
+    history = lambda rows: {'type': 'history', 'room_id': 1, 'has_more': True, 'before_id': None, 'after_id': None,
+                            'data': rows}
+    legacy_image = '[IMG:photo.jpg:' + base64.b64encode(rng.randbytes(24 * 1024)).decode() + ']'
+    frames = {
+        'chat message (10 words)': message(1, chat_text(rng, 10)),
+        'chat message (120 words)': message(2, chat_text(rng, 120)),
+        'pasted text (800 words)': message(3, chat_text(rng, 800)),
+        'history, 50 rows': history([[i, f'user{i % 50}', chat_text(rng, rng.randint(3, 30)), 'text', stamp]
+                                     for i in range(50)]),
+        'history, 200 rows': history([[i, f'user{i % 50}', chat_text(rng, rng.randint(3, 30)), 'text', stamp]
+                                      for i in range(200)]),
+        'history, inline images': history([[i, 'user1', legacy_image, 'image', stamp] for i in range(5)]),
+        'rooms list, 1000 rooms': {'type': 'rooms_list', 'rooms': [[i, f'room-{i}', chat_text(rng, 4), i % 7]
+                                                                   for i in range(1000)]},
+    }
+    print(f"{'frame':26} {'bytes':>8} {'codec':>9} {'level':>5} {'ratio':>6} {'compress':>10} {'inflate':>9}")
+    for name, msg in frames.items():
+        payload = json.dumps(msg).encode()
+        if len(payload) < COMPRESS_THRESHOLD:
+            print(f"{name:26} {len(payload):8} {'(below threshold, sent as is)':>42}")
+            continue
+        count = max(5, repeats * 1000 // len(payload))
+        for codec in COMPRESSION_CODECS:
+            for level in levels:
+                started = time.perf_counter()
+                for _ in range(count):
+                    packed = compress_payload(payload, codec, level)
+                compress_us = (time.perf_counter() - started) / count * 1e6
+                started = time.perf_counter()
+                for _ in range(count):
+                    inflate_payload(packed)
+                inflate_us = (time.perf_counter() - started) / count * 1e6
+                print(f"{name:26} {len(payload):8} {codec:>9} {level:5} {len(payload) / len(packed):5.1f}x "
+                      f"{compress_us:8.1f}us {inflate_us:7.1f}us")
+    
+    # Storage: 100k messages, 5% of them long pastes, stored as they are and compressed
+    with tempfile.TemporaryDirectory() as tmp:
+        rows = [(i, 1, f'user{i % 50}', chat_text(rng, 400 if i % 20 == 0 else rng.randint(3, 30)), 'text', stamp)
+                for i in range(100_000)]
+        for label, store in (('plain', lambda text: text), ('compressed', deflate_message)):
+            conn = sqlite3.connect(os.path.join(tmp, label + '.db'))
+            conn.execute('''CREATE TABLE messages (id INTEGER PRIMARY KEY, room_id INTEGER, username TEXT,
+                            message TEXT, type TEXT DEFAULT 'text', timestamp TEXT)''')
+            started = time.perf_counter()
+            conn.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?)",
+                             [row[:3] + (store(row[3]),) + row[4:] for row in rows])
+            conn.commit()
+            elapsed = time.perf_counter() - started
+            size = conn.execute("PRAGMA page_count").fetchone()[0] * conn.execute("PRAGMA page_size").fetchone()[0]
+            conn.close()
+            print(f"storage {label:10} {size / 1024 / 1024:7.1f} MB, written in {elapsed:.2f}s")
+
+def spawn_server(mode, tmp, backlog=1024, extra=(), script=None):
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, script or os.path.abspath(__file__), mode, '--port', str(port),
+                             '--backlog', str(backlog), '--db', os.path.join(tmp, 'bench.db'),
+                             '--blobs', os.path.join(tmp, 'attachments'), *extra],
+                            stdout=subprocess.DEVNULL)
+    if not wait_for_port(port):
+        proc.terminate()
+        raise RuntimeError(f"{mode}: server did not start")
+    return proc, port
+
+def benchmark_fanout(sizes=(10, 100, 1000), messages=50):
+    raise_fd_limit()
+    print(f"Fan-out latency, {messages} messages per room size")
+    for mode in ('--server', '--async-server'):
+        with tempfile.TemporaryDirectory() as tmp:
+            proc, port = spawn_server(mode, tmp, extra=('--rate-limit', 'off'))
+            try:
+                results = asyncio.run(bench_fanout(port, sizes, messages))
+            finally:
+                proc.terminate()
+                proc.wait()
+        for size, latencies in results.items():
+            print(f"{mode:15} room of {size:5} | p50 {percentile(latencies, 50) * 1000:7.2f}ms "
+                  f"p99 {percentile(latencies, 99) * 1000:7.2f}ms")
+
+def benchmark_servers(connections=1000, duration=5.0, room_size=10, backlog=1024):
+    raise_fd_limit()
+    print(f"{connections} connections, rooms of {room_size}, {duration:.0f}s per server")
+    for mode in ('--server', '--async-server'):
+        with tempfile.TemporaryDirectory() as tmp:
+            proc, port = spawn_server(mode, tmp, backlog, ('--rate-limit', 'off'))
+            try:
+                stats = asyncio.run(bench_load(port, proc.pid, connections, duration, room_size))
+            finally:
+                proc.terminate()
+                proc.wait()
+        sent = len(stats['latencies'])
+        print(f"{mode:15} held {stats['connections']}/{connections} connections | "
+              f"{sent / duration:,.0f} msg/s sent | {stats['delivered'] / duration:,.0f} msg/s delivered | "
+              f"p50 {percentile(stats['latencies'], 50) * 1000:.1f}ms p99 {percentile(stats['latencies'], 99) * 1000:.1f}ms | "
+              f"RSS {stats['server']['rss_kb']} kB, {stats['server']['threads']} threads")
+
+def bench_load_process(port, connections, duration, room_size, first_room):
+    return asyncio.run(bench_load(port, None, connections, duration, room_size, first_room))
+
+def benchmark_sharded(worker_counts=None, connections=1000, duration=5.0, room_size=10, clients=None):
+    # Throughput of the sharded server by worker count. The load is generated by several
+    # processes too, so the client side isn't the single-core bottleneck being measured.
+    raise_fd_limit()
+    cores = os.cpu_count() or 1
+    worker_counts = worker_counts or [n for n in (1, 2, 4, 8, 16, 32, 64) if n <= max(2, cores // 2)]
+    clients = clients or max(1, cores // 2)
+    per_client = connections // clients
+    print(f"{connections} connections from {clients} load processes, rooms of {room_size}, "
+          f"{duration:.0f}s per run, {cores} cores")
+    baseline = None
+    for workers in worker_counts:
+        with tempfile.TemporaryDirectory() as tmp:
+            proc, port = spawn_server('--sharded', tmp, extra=('--workers', str(workers), '--rate-limit', 'off'))
+            time.sleep(1)  # let every worker bind, not just the first
+            try:
+                with ProcessPoolExecutor(clients) as pool:
+                    runs = list(pool.map(bench_load_process, [port] * clients, [per_client] * clients,
+                                         [duration] * clients, [room_size] * clients,
+                                         [1000 + i * per_client for i in range(clients)]))
+            finally:
+                proc.terminate()
+                proc.wait()
+        latencies = [lat for run in runs for lat in run['latencies']]
+        delivered = sum(run['delivered'] for run in runs) / duration
+        baseline = baseline or delivered
+        print(f"{workers:3} workers | held {sum(run['connections'] for run in runs)}/{per_client * clients} | "
+              f"{len(latencies) / duration:,.0f} msg/s sent | {delivered:,.0f} msg/s delivered "
+              f"({delivered / baseline:.2f}x) | p50 {percentile(latencies, 50) * 1000:.1f}ms "
+              f"p99 {percentile(latencies, 99) * 1000:.1f}ms")
+
+class Throttled(RuntimeError):
+    def __init__(self, reply):
+        super().__init__(f"{reply.get('request')} throttled, retry in {reply.get('retry_after')}s")
+        self.retry_after = reply.get('retry_after', 1)
+
+class HeadlessClient:
+    # Scriptable asyncio client for the chat protocol, without Tk. It runs one request
+    # at a time: request() waits for the first reply of an expected type, while every
+    # new_message goes to on_message.
+    def __init__(self, stream, on_message=None, codecs=COMPRESSION_CODECS, on_activity=None, on_directory=None):
+        self.stream = stream
+        self.codecs = list(codecs)  # compression to offer at login; empty for none
+        self.on_message = on_message
+        self.on_activity = on_activity
+        self.on_directory = on_directory  # room_added / room_removed
+        self.pending = None  # (expected reply types, future, request type)
+        self.throttled = 0
+        self.reader = asyncio.create_task(self.read_loop())
+    
+    @classmethod
+    async def connect(cls, host, port, on_message=None, timeout=10, codecs=COMPRESSION_CODECS, on_activity=None,
+                      on_directory=None):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        return cls(FramedStream(reader, writer), on_message, codecs, on_activity, on_directory)
+    
+    async def read_loop(self):
+        try:
+            while (msg := await self.stream.recv()) is not None:
+                if msg.get('type') == 'new_message' and self.on_message:
+                    self.on_message(msg)
+                elif msg.get('type') == 'room_activity' and self.on_activity:
+                    self.on_activity(msg)
+                elif msg.get('type') in ('room_added', 'room_removed') and self.on_directory:
+                    self.on_directory(msg)
+                elif msg.get('type') == 'throttled':
+                    self.throttled += 1
+                    if self.pending and msg.get('request') == self.pending[2] and not self.pending[1].done():
+                        self.pending[1].set_exception(Throttled(msg))
+                elif msg.get('type') == 'error':
+                    if self.pending and not self.pending[1].done():
+                        self.pending[1].set_exception(RuntimeError(msg.get('reason')))
+                elif self.pending and msg.get('type') in self.pending[0] and not self.pending[1].done():
+                    self.pending[1].set_result(msg)
+        except (OSError, ValueError):
+            pass
+        if self.pending and not self.pending[1].done():
+            self.pending[1].set_exception(ConnectionError("Server closed connection"))
+    
+    async def request(self, msg, *expect, data=None, timeout=30):
+        if self.reader.done():
+            raise ConnectionError("Server closed connection")
+        # Without an expected reply nothing awaits a future, so none is made for a later
+        # 'throttled' to fail
+        self.pending = (expect, asyncio.get_running_loop().create_future(), msg.get('type')) if expect else None
+        await self.stream.send(msg, data)
+        if not expect:
+            return None
+        return await asyncio.wait_for(self.pending[1], timeout)
+    
+    async def register(self, username, password):
+        reply = await self.request({'type': 'register', 'username': username, 'password': password,
+                                    'versions': list(SUPPORTED_VERSIONS)}, 'register_result')
+        return reply['success']
+    
+    async def login(self, username, password):
+        reply = await self.request({'type': 'login', 'username': username, 'password': password,
+                                    'versions': list(SUPPORTED_VERSIONS), 'compression': self.codecs},
+                                   'login_success', 'login_failed')
+        self.stream.codec = reply.get('compression')
+        return reply.get('token')
+    
+    async def resume(self, token, rooms=()):
+        reply = await self.request({'type': 'resume', 'token': token, 'rooms': [[r, None] for r in rooms],
+                                    'versions': list(SUPPORTED_VERSIONS), 'compression': self.codecs},
+                                   'resumed', 'resume_failed')
+        self.stream.codec = reply.get('compression')
+        return reply['type'] == 'resumed'
+    
+    async def join(self, room_id):
+        await self.request({'type': 'join_room', 'room_id': room_id}, 'room_joined')
+    
+    async def rooms(self, prefix='', after=None, limit=ROOM_PAGE_SIZE, subscribe=False, since=None):
+        # A directory page (rooms_list), or the changes since a version (rooms_changed)
+        return await self.request({'type': 'get_rooms', 'prefix': prefix, 'after': after, 'limit': limit,
+                                   'subscribe': subscribe, 'since': since}, 'rooms_list', 'rooms_changed')
+    
+    async def create_room(self, name, description=''):
+        reply = await self.request({'type': 'create_room', 'name': name, 'description': description},
+                                   'room_created')
+        return reply['room_id']
+    
+    async def delete_room(self, room_id):
+        reply = await self.request({'type': 'delete_room', 'room_id': room_id}, 'room_deleted')
+        return reply['success']
+    
+    async def leave(self, room_id):
+        await self.request({'type': 'leave_room', 'room_id': room_id}, 'room_left')
+    
+    async def history(self, room_id, limit=50, before_id=None):
+        reply = await self.request({'type': 'get_history', 'room_id': room_id, 'limit': limit,
+                                    'before_id': before_id}, 'history')
+        return reply['data'], reply['has_more']
+    
+    async def chat(self, room_id, text):
+        await self.request({'type': 'chat_message', 'room_id': room_id, 'message': text})
+    
+    async def typing(self, room_id, active=True):
+        await self.request({'type': 'typing', 'room_id': room_id, 'active': active})
+    
+    async def read(self, room_id, last_id):
+        await self.request({'type': 'read', 'room_id': room_id, 'last_id': last_id})
+    
+    async def upload(self, data, kind='file'):
+        digest = hashlib.sha256(data).hexdigest()
+        reply = await self.request({'type': 'upload_start', 'sha256': digest, 'size': len(data), 'kind': kind},
+                                   'upload_ready', 'upload_done', 'upload_failed')
+        if reply['type'] == 'upload_ready':
+            offset = reply['offset']
+            while offset < len(data):
+                chunk = data[offset:offset + BLOB_CHUNK_SIZE]
+                header = {'type': 'upload_chunk', 'sha256': digest, 'offset': offset, 'size': len(data)}
+                offset += len(chunk)
+                if offset < len(data):
+                    await self.request(header, data=chunk)
+                else:
+                    reply = await self.request(header, 'upload_done', 'upload_failed', 'upload_ready', data=chunk)
+        if reply['type'] != 'upload_done':
+            raise RuntimeError(reply.get('reason', "Upload failed"))
+        return digest
+    
+    async def send_attachment(self, room_id, name, data, kind='file'):
+        digest = await self.upload(data, kind)
+        await self.request({'type': 'chat_message', 'room_id': room_id, 'message_type': kind, 'message': '',
+                            'attachment': {'name': name, 'sha256': digest}})
+    
+    def close(self):
+        self.reader.cancel()
+        self.stream.close()
+
+LOADGEN_MIX = 'chat=80,history=10,join=4,image=2,file=2,login=2'
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        op, _, weight = part.partition('=')
+        if op.strip() not in LOADGEN_OPS:
+            raise ValueError(f"Unknown operation {op.strip()!r}; choose from {', '.join(LOADGEN_OPS)}")
+        mix[op.strip()] = float(weight or 1)
+    return mix
+
+def loadgen_image(size, rng):
+    # A small valid PNG padded with random trailing bytes (which decoders ignore), so
+    # every upload is a new blob of roughly the requested size
+    buf = io.BytesIO()
+    Image.frombytes('RGB', (64, 64), rng.randbytes(64 * 64 * 3)).save(buf, 'PNG')
+    return buf.getvalue() + rng.randbytes(max(0, size - buf.tell()))
+
+async def loadgen_chat(user, opts, rng):
+    # Delivery latency is measured from the send time embedded in the message text
+    await user['client'].chat(user['room'], f"lg {time.perf_counter():.6f} " + 'x' * opts['payload'])
+
+async def loadgen_history(user, opts, rng):
+    await user['client'].history(user['room'])
+
+async def loadgen_join(user, opts, rng):
+    await user['client'].leave(user['room'])
+    await user['client'].join(user['room'])
+
+async def loadgen_image_op(user, opts, rng):
+    await user['client'].send_attachment(user['room'], 'load.png', loadgen_image(opts['attachment_size'], rng),
+                                         'image')
+
+async def loadgen_file(user, opts, rng):
+    await user['client'].send_attachment(user['room'], 'load.bin', rng.randbytes(opts['attachment_size']))
+
+async def loadgen_login(user, opts, rng):
+    # A full password login, so the KDF cost shows up in the numbers
+    if not await user['client'].login(user['username'], 'load'):
+        raise RuntimeError("Login failed")
+
+LOADGEN_OPS = {'chat': loadgen_chat, 'history': loadgen_history, 'join': loadgen_join,
+               'image': loadgen_image_op, 'file': loadgen_file, 'login': loadgen_login}
+
+async def loadgen_user(user, mix, opts, deadline, stats):
+    rng = random.Random(user['index'])
+    ops, weights = list(mix), list(mix.values())
+    while time.perf_counter() < deadline:
+        if opts['think']:
+            await asyncio.sleep(rng.expovariate(1 / opts['think']))
+        op = rng.choices(ops, weights)[0]
+        started = time.perf_counter()
+        try:
+            await LOADGEN_OPS[op](user, opts, rng)
+        except ConnectionError:
+            stats['errors'][op] = stats['errors'].get(op, 0) + 1
+            return
+        except (asyncio.TimeoutError, RuntimeError):
+            stats['errors'][op] = stats['errors'].get(op, 0) + 1
+            continue
+        stats['ops'].setdefault(op, []).append(time.perf_counter() - started)
+
+async def run_loadgen(host, port, users=1000, duration=30.0, mix=LOADGEN_MIX, room_size=10, accounts=10,
+                      think=1.0, payload=64, attachment_size=64 * 1024, server_pid=None, connect_limit=200,
+                      codecs=COMPRESSION_CODECS, on_ready=None):
+    # Simulated users each hold a connection in one room and run a closed loop of
+    # operations drawn from mix. Accounts are registered and logged in once up front and
+    # users attach with session resume, so setup doesn't hammer the KDF. on_ready is
+    # called once they are attached, just before the measured run.
+    mix = parse_mix(mix) if isinstance(mix, str) else mix
+    opts = {'think': think, 'payload': payload, 'attachment_size': attachment_size}
+    stats = {'ops': {}, 'errors': {}, 'delivery': [], 'delivered': 0}
+    
+    def on_message(msg):
+        stats['delivered'] += 1
+        text = msg.get('message', '')
+        if text.startswith('lg '):
+            stats['delivery'].append(time.perf_counter() - float(text.split(' ', 2)[1]))
+    
+    gate = asyncio.Semaphore(connect_limit)  # don't overrun the server's accept backlog
+    
+    async def enroll(n):
+        # A connection per account, needed only until its session token is issued
+        async with gate:
+            client = await HeadlessClient.connect(host, port, codecs=codecs)
+            try:
+                await client.register(f'load{n}', 'load')
+                return await client.login(f'load{n}', 'load')
+            finally:
+                client.close()
+    
+    tokens = await asyncio.gather(*(enroll(n) for n in range(accounts)))
+    
+    async def attach(index):
+        async with gate:
+            client = await HeadlessClient.connect(host, port, on_message, codecs=codecs)
+            room = 1000 + index // room_size
+            if not await client.resume(tokens[index % accounts], [room]):
+                raise RuntimeError("Resume failed")
+            return {'index': index, 'client': client, 'room': room, 'username': f'load{index % accounts}'}
+    
+    results = await asyncio.gather(*(attach(i) for i in range(users)), return_exceptions=True)
+    active = [r for r in results if not isinstance(r, BaseException)]
+    stats['connected'] = len(active)
+    if on_ready:
+        on_ready()
+    
+    before = process_stats(server_pid)
+    started = time.perf_counter()
+    await asyncio.gather(*(loadgen_user(user, mix, opts, started + duration, stats) for user in active))
+    stats['elapsed'] = time.perf_counter() - started
+    stats['server'] = after = process_stats(server_pid)
+    if before['cpu_s'] is not None and after['cpu_s'] is not None:
+        stats['server']['cpu_pct'] = 100 * (after['cpu_s'] - before['cpu_s']) / stats['elapsed']
+    stats['throttled'] = sum(user['client'].throttled for user in active)
+    for user in active:
+        user['client'].close()
+    return stats
+
+def report_loadgen(stats, users):
+    elapsed = stats['elapsed']
+    print(f"{stats['connected']}/{users} users connected, {elapsed:.1f}s")
+    print(f"{'operation':10} {'count':>8} {'per s':>9} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for op, latencies in sorted(stats['ops'].items()):
+        print(f"{op:10} {len(latencies):8} {len(latencies) / elapsed:9.1f} {percentile(latencies, 50) * 1000:9.2f} "
+              f"{percentile(latencies, 99) * 1000:9.2f} {stats['errors'].get(op, 0):7}")
+    delivery = stats['delivery']
+    print(f"delivery   {stats['delivered']:8} {stats['delivered'] / elapsed:9.1f} "
+          f"{percentile(delivery, 50) * 1000:9.2f} {percentile(delivery, 99) * 1000:9.2f}")
+    if stats['throttled']:
+        print(f"throttled  {stats['throttled']:8} {stats['throttled'] / elapsed:9.1f}")
+    server = stats['server']
+    if server['rss_kb'] is not None:
+        print(f"server: CPU {server.get('cpu_pct', 0):.0f}%, RSS {server['rss_kb'] / 1024:.1f} MB, "
+              f"{server['threads']} threads")
+
+def loadgen(args):
+    # --loadgen: drive a running server (--target) or one spawned for the run (--spawn)
+    raise_fd_limit()
+    tmp = None
+    if args.target:
+        host, _, port = args.target.rpartition(':')
+        host, port, pid = host or 'localhost', int(port), args.server_pid
+    else:
+        tmp = tempfile.TemporaryDirectory()
+        # Users share --accounts, so the per-user rate limits are off unless asked for
+        limits = [x for spec in args.rate_limit or ['off'] for x in ('--rate-limit', spec)]
+        proc, port = spawn_server('--' + args.spawn, tmp.name, args.backlog,
+                                  ('--kdf-iterations', str(args.kdf_iterations), *limits))
+        host, pid = 'localhost', proc.pid
+    try:
+        stats = asyncio.run(run_loadgen(host, port, args.users, args.duration, args.mix, args.room_size,
+                                        args.accounts, args.think, args.payload, args.attachment_size, pid,
+                                        codecs=args.codecs))
+    finally:
+        if tmp:
+            proc.terminate()
+            proc.wait()
+            tmp.cleanup()
+    report_loadgen(stats, args.users)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(stats, f)
+    # Regression gate: a non-zero exit when delivery p99 exceeds the budget
+    if args.max_p99 and percentile(stats['delivery'], 99) * 1000 > args.max_p99:
+        print(f"FAIL: delivery p99 above {args.max_p99}ms")
+        sys.exit(1)
+
+def load_trace(paths):
+    # Merges trace files (one per worker of a sharded server) into a list of connections,
+    # each a list of (seconds since the trace began, kind, message or None)
+    connections, first = {}, None
+    for index, path in enumerate(paths):
+        for at, conn_id, kind, msg in read_trace(path):
+            connections.setdefault((index, conn_id), []).append((at, kind, msg))
+            first = at if first is None else min(first, at)
+    return [[((at - first) / 1e6, kind, msg) for at, kind, msg in events] for events in connections.values()]
+
+def seed_replay_db(path, connections, kdf_iterations, tmp, seed=None):
+    # The database a replay starts from: a copy of `seed` if given, plus every account the
+    # trace logs in to or resumes (all with TRACE_PASSWORD), except those it registers
+    # itself, and a session for each one that resumes. Returns {username: session token}.
+    if seed:
+        with sqlite3.connect(seed) as source, sqlite3.connect(path) as target:
+            source.backup(target)
+    first = {}  # username -> (time, request) where the trace first names them
+    for events in connections:
+        for at, kind, msg in events:
+            request = msg and msg.get('type')
+            name = msg.get('user') if request == 'resume' else msg.get('username') if request in (
+                'login', 'register') else None
+            if name and (name not in first or at < first[name][0]):
+                first[name] = (at, request)
+    resumed = {msg.get('user') for events in connections for _, _, msg in events
+               if msg and msg.get('type') == 'resume' and msg.get('user')}
+    accounts = [name for name, (_, request) in first.items() if request != 'register']
+    db = ChatDatabase(path, archive_dir=os.path.join(tmp, 'archive'))
+    password_hash = hash_password(TRACE_PASSWORD, kdf_iterations)  # hashed once, shared by all
+    tokens = {}
+    with db.writing() as conn:
+        conn.executemany("INSERT INTO users (username, password) VALUES (?, ?) "
+                         "ON CONFLICT (username) DO UPDATE SET password=excluded.password",
+                         [(name, password_hash) for name in accounts])
+        for name in resumed & set(accounts):
+            tokens[name] = secrets.token_urlsafe(32)
+            conn.execute("INSERT INTO sessions (token, user_id, expires) SELECT ?, id, ? FROM users WHERE username=?",
+                         (token_key(tokens[name]), time.time() + SESSION_TTL, name))
+    db.close()
+    return tokens
+
+async def replay_connection(port, events, start, speed, tokens, stats):
+    # Sends one captured connection's frames on their original schedule (sped up by speed)
+    # with the replay's credentials, timing each request until the reply that answers it
+    stream = reader = None
+    me = None
+    pending = []  # [request type, sent at, reply types, chat text]
+    
+    async def read():
+        while (msg := await stream.recv()) is not None:
+            kind, now = msg.get('type'), time.perf_counter()
+            if kind == 'login_success' and me:
+                tokens[me] = msg['token']
+            if kind in ('login_success', 'resumed'):
+                stream.codec = msg.get('compression')
+            if kind == 'throttled':
+                stats['throttled'] += 1
+            elif kind == 'error' or kind.endswith('_failed'):
+                stats['failed'] += 1
+            for index, (request, sent, expect, text) in enumerate(pending):
+                if kind == 'throttled':
+                    answered = request == msg.get('request')
+                else:
+                    # A chat message is answered by its own broadcast, an attachment by one naming its blob
+                    answered = kind in expect and (text is None or msg.get('username') == me and (
+                        msg.get('message') == text or msg.get('message_type', 'text') != 'text'
+                        and text in msg.get('message', '')))
+                if answered:
+                    del pending[index]
+                    if kind != 'throttled':
+                        stats['latency'].setdefault(request, []).append(now - sent)
+                    break
+    
+    try:
+        for at, kind, msg in events:
+            delay = start + at / speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if kind == TRACE_CLOSE:
+                break
+            if stream is None:
+                stream = FramedStream(*await asyncio.open_connection('localhost', port))
+                reader = asyncio.create_task(read())
+            if kind != TRACE_FRAME:
+                continue
+            # Clients wait for an account request to be answered before sending anything else
+            deadline = time.perf_counter() + 10
+            while (any(request in ('register', 'login', 'resume') for request, *_ in pending)
+                   and not reader.done() and time.perf_counter() < deadline):
+                await asyncio.sleep(0.005)
+            stats['late'].append(max(0.0, start + at / speed - time.perf_counter()))
+            msg = dict(msg)
+            data = msg.pop('data', None)
+            request = msg.get('type')
+            if 'password' in msg:
+                msg['password'] = TRACE_PASSWORD
+            if request in ('login', 'register'):
+                me = msg.get('username')
+            elif request == 'resume':
+                me = msg.pop('user', None)
+                # The session may come from a login earlier in the trace that is still being answered
+                deadline = time.perf_counter() + 10
+                while me and me not in tokens and time.perf_counter() < deadline:
+                    await asyncio.sleep(0.005)
+                msg['token'] = tokens.get(me)
+            expect = TRACE_REPLIES.get(request)
+            if request == 'upload_chunk' and msg.get('offset', 0) + len(data or b'') >= msg.get('size', 0):
+                expect = ('upload_done', 'upload_failed', 'upload_ready')  # the last chunk is answered
+            if expect:
+                text = (msg.get('attachment') or {}).get('sha256') or msg.get('message')
+                pending.append([request, time.perf_counter(), expect, text if request == 'chat_message' else None])
+            await stream.send(msg, data)
+            stats['sent'] += 1
+        # Give the last replies a moment before hanging up like the original client did
+        deadline = time.perf_counter() + 5
+        while pending and not reader.done() and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+    except (OSError, ValueError):
+        stats['errors'] += 1
+    finally:
+        stats['unanswered'] += len(pending)
+        if stream:
+            reader.cancel()
+            stream.close()
+
+async def run_replay(port, connections, speed, tokens, server_pid):
+    stats = {'sent': 0, 'latency': {}, 'late': [], 'throttled': 0, 'failed': 0, 'unanswered': 0, 'errors': 0}
+    before = process_stats(server_pid)
+    start = time.perf_counter() + 0.5
+    await asyncio.gather(*(replay_connection(port, events, start, speed, tokens, stats) for events in connections))
+    stats['elapsed'] = time.perf_counter() - start
+    stats['cpu_s'] = (process_stats(server_pid)['cpu_s'] or 0) - (before['cpu_s'] or 0)
+    return stats
+
+def replay(args):
+    # --replay: drive a fresh server from a captured trace, once per build given with
+    # --builds (other versions of this file), and compare how each kept up
+    raise_fd_limit()
+    connections = load_trace(args.replay)
+    span = max((events[-1][0] for events in connections if events), default=0.0)
+    frames = sum(kind == TRACE_FRAME for events in connections for _, kind, _ in events)
+    print(f"Trace: {len(connections)} connections, {frames:,} frames over {span:.1f}s, replayed at {args.speed:g}x")
+    results = []
+    for build in args.builds or [os.path.abspath(__file__)]:
+        with tempfile.TemporaryDirectory() as tmp:
+            tokens = seed_replay_db(os.path.join(tmp, 'bench.db'), connections, args.kdf_iterations, tmp,
+                                    args.replay_seed)
+            # Options older builds may not have are only passed to those that list them
+            usage = subprocess.run([sys.executable, build, '--help'], capture_output=True, text=True).stdout
+            extra = ['--kdf-iterations', str(args.kdf_iterations)]
+            if '--rate-limit' in usage:
+                # Sped up, the rate limits would measure themselves rather than the server
+                specs = args.rate_limit or (['off'] if args.speed > 1 else [])
+                extra += [x for spec in specs for x in ('--rate-limit', spec)]
+            if '--archive-dir' in usage:
+                extra += ['--archive-dir', os.path.join(tmp, 'archive')]
+            proc, port = spawn_server('--' + args.spawn, tmp, args.backlog, extra, script=build)
+            try:
+                results.append((build, asyncio.run(run_replay(port, connections, args.speed, tokens, proc.pid))))
+            finally:
+                proc.terminate()
+                proc.wait()
+    report_replay(results)
+
+def report_replay(results):
+    labels = [f"{n}: {os.path.basename(build)}" for n, (build, _) in enumerate(results, 1)]
+    width = max(map(len, labels))
+    for label, (_, stats) in zip(labels, results):
+        latencies = [x for values in stats['latency'].values() for x in values]
+        print(f"{label:{width}} | {stats['sent'] / stats['elapsed']:8,.0f} req/s | answered p50 "
+              f"{percentile(latencies, 50) * 1000:7.1f}ms p99 {percentile(latencies, 99) * 1000:7.1f}ms | "
+              f"sent late p99 {percentile(stats['late'], 99) * 1000:6.1f}ms | {stats['unanswered']} unanswered, "
+              f"{stats['failed']} failed, {stats['throttled']} throttled, {stats['errors']} connections lost | "
+              f"server CPU {stats['cpu_s']:.1f}s")
+    requests = sorted({request for _, stats in results for request in stats['latency']})
+    print(f"{'p50 / p99 ms':14} " + " ".join(f"| {label:>22}" for label in labels))
+    for request in requests:
+        cells = []
+        for _, stats in results:
+            values = stats['latency'].get(request, [])
+            cells.append(f"{percentile(values, 50) * 1000:9.1f} / {percentile(values, 99) * 1000:9.1f}"
+                         if values else "-")
+        print(f"{request:14} " + " ".join(f"| {cell:>22}" for cell in cells))
+
+async def bench_activity(port, members, typers, readers, duration, activity=True, on_start=None):
+    # One room of `members`: `typers` of them type for a few seconds (re-announcing it every
+    # second) and then post, and `readers` send a read receipt at most once a second as
+    # messages arrive. Returns chat delivery latencies and room_activity frames received.
+    room_id = 5000
+    stats = {'delivery': [], 'activity': 0, 'last_id': 0}
+    
+    def on_message(msg):
+        stats['last_id'] = max(stats['last_id'], msg['id'] or 0)
+        stats['delivery'].append(time.perf_counter() - float(msg['message'].split(' ', 2)[1]))
+    
+    def on_activity(msg):
+        stats['activity'] += 1
+    
+    gate = asyncio.Semaphore(100)
+    
+    async def attach(n):
+        async with gate:
+            client = await HeadlessClient.connect('localhost', port, on_message, codecs=(), on_activity=on_activity)
+            await client.register(f'member{n}', 'bench')
+            await client.login(f'member{n}', 'bench')
+            await client.join(room_id)
+            return client
+    
+    clients = await asyncio.gather(*(attach(n) for n in range(members)))
+    await asyncio.sleep(1)  # let the join deltas settle
+    stats.update(delivery=[], activity=0)
+    if on_start:
+        on_start()
+    started = time.perf_counter()
+    deadline = started + duration
+    
+    async def typer(client, rng):
+        await asyncio.sleep(rng.uniform(0, 1))
+        while time.perf_counter() < deadline:
+            for _ in range(3):
+                if activity:
+                    await client.typing(room_id)
+                await asyncio.sleep(1)
+            await client.chat(room_id, f"lg {time.perf_counter():.6f} hello")
+    
+    async def reader(client):
+        sent = 0
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(1)
+            if stats['last_id'] > sent:
+                sent = stats['last_id']
+                await client.read(room_id, sent)
+    
+    tasks = [typer(client, random.Random(n)) for n, client in enumerate(clients[:typers])]
+    if activity:
+        tasks += [reader(client) for client in clients[typers:typers + readers]]
+    await asyncio.gather(*tasks)
+    stats['elapsed'] = time.perf_counter() - started
+    await asyncio.sleep(1)  # deliveries still in flight
+    for client in clients:
+        client.close()
+    return stats
+
+def scrape_metric(port, name):
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=10) as response:
+        return sum(float(line.split()[-1]) for line in response.read().decode().splitlines()
+                   if line.startswith(name) and line[len(name)] in ' {')
+
+def benchmark_activity(members=1000, typers=20, readers=100, duration=10.0):
+    # Cost of presence, typing and read receipts in one big room: chat alone, then with
+    # activity broadcast per event, then coalesced into a delta per ACTIVITY_INTERVAL
+    raise_fd_limit()
+    print(f"Room of {members}: {typers} typing and posting, {readers} sending read receipts, {duration:.0f}s per run")
+    runs = (('chat only', False, ACTIVITY_INTERVAL), ('per event', True, 0), ('coalesced', True, ACTIVITY_INTERVAL))
+    for label, activity, interval in runs:
+        with tempfile.TemporaryDirectory() as tmp:
+            metrics_port = free_port()
+            proc, port = spawn_server('--async-server', tmp, extra=(
+                '--kdf-iterations', '1000', '--rate-limit', 'off', '--activity-interval', str(interval),
+                '--metrics-port', str(metrics_port)))
+            try:
+                before = {}
+                
+                def snapshot():
+                    before.update(cpu=process_stats(proc.pid)['cpu_s'],
+                                  sent=scrape_metric(metrics_port, 'chat_bytes_out_total'))
+                
+                stats = asyncio.run(bench_activity(port, members, typers, readers, duration, activity, snapshot))
+                cpu = process_stats(proc.pid)['cpu_s'] - before['cpu']
+                sent = scrape_metric(metrics_port, 'chat_bytes_out_total') - before['sent']
+            finally:
+                proc.terminate()
+                proc.wait()
+        print(f"{label:10} | delivery p50 {percentile(stats['delivery'], 50) * 1000:7.1f}ms "
+              f"p99 {percentile(stats['delivery'], 99) * 1000:7.1f}ms | "
+              f"{stats['activity'] / members / stats['elapsed']:5.1f} activity frames/member/s | "
+              f"server sent {sent / 1024 / 1024 / stats['elapsed']:6.2f} MB/s, CPU {100 * cpu / stats['elapsed']:.0f}%")
+
+async def bench_rooms(port, clients, changes, push, on_start=None):
+    # `clients` connections watch the room directory while another creates `changes` rooms,
+    # one at a time. With push they hold the first page and get room_added; without it
+    # every client fetches the whole list again after each change, as the client used to.
+    # Returns the latencies from each create until each client had the new room.
+    setup = await HeadlessClient.connect('localhost', port, codecs=())
+    await setup.register('bench', 'bench')
+    token = await setup.login('bench', 'bench')
+    full = json.dumps(await setup.rooms(limit=None))
+    page = json.dumps(await setup.rooms())
+    seen = {}
+    
+    def on_directory(msg):
+        seen.setdefault(msg['room'][1], []).append(time.perf_counter())
+    
+    gate = asyncio.Semaphore(100)
+    
+    async def attach(n):
+        async with gate:
+            client = await HeadlessClient.connect('localhost', port, codecs=(), on_directory=on_directory)
+            await client.resume(token)
+            if push:
+                await client.rooms(subscribe=True)
+            return client
+    
+    members = await asyncio.gather(*(attach(n) for n in range(clients)))
+    if on_start:
+        on_start()
+    latencies = []
+    
+    async def refetch(client, sent):
+        await client.rooms(limit=None)
+        latencies.append(time.perf_counter() - sent)
+    
+    started = time.perf_counter()
+    for n in range(changes):
+        name = f'new-room-{n}'
+        sent = time.perf_counter()
+        await setup.create_room(name)
+        if push:
+            while len(seen.get(name, ())) < clients and time.perf_counter() - sent < 30:
+                await asyncio.sleep(0.002)
+            latencies += [at - sent for at in seen.get(name, ())]
+        else:
+            await asyncio.gather(*(refetch(client, sent) for client in members))
+    elapsed = time.perf_counter() - started
+    for client in (setup, *members):
+        client.close()
+    return {'latencies': latencies, 'elapsed': elapsed, 'full_bytes': len(full), 'page_bytes': len(page)}
+
+def benchmark_rooms(rooms=5000, clients=1000, changes=20):
+    # Keeping every client's room list current as rooms are created: refetching the full
+    # list everywhere after each change versus pushing the change itself
+    raise_fd_limit()
+    print(f"{rooms:,} rooms, {clients} clients watching the directory, {changes} rooms created")
+    for label, push in (('full refetch', False), ('pushed deltas', True)):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = ChatDatabase(os.path.join(tmp, 'bench.db'), archive_dir=os.path.join(tmp, 'archive'))
+            with db.writing() as conn:
+                conn.executemany("INSERT INTO rooms (name, description) VALUES (?, ?)",
+                                 [(f'room-{n:05}', f'benchmark room number {n}') for n in range(rooms)])
+                conn.execute("INSERT INTO room_log (room_id, name, description) "
+                             "SELECT id, name, description FROM rooms WHERE name LIKE 'room-%' ORDER BY id")
+            db.close()
+            metrics_port = free_port()
+            proc, port = spawn_server('--async-server', tmp, extra=(
+                '--kdf-iterations', '1000', '--rate-limit', 'off', '--archive-dir', os.path.join(tmp, 'archive'),
+                '--metrics-port', str(metrics_port)))
+            try:
+                before = {}
+                
+                def snapshot():
+                    before.update(cpu=process_stats(proc.pid)['cpu_s'],
+                                  sent=scrape_metric(metrics_port, 'chat_bytes_out_total'))
+                
+                stats = asyncio.run(bench_rooms(port, clients, changes, push, snapshot))
+                cpu = process_stats(proc.pid)['cpu_s'] - before['cpu']
+                sent = scrape_metric(metrics_port, 'chat_bytes_out_total') - before['sent']
+            finally:
+                proc.terminate()
+                proc.wait()
+        latencies = stats['latencies']
+        print(f"{label:13} | all clients current: p50 {percentile(latencies, 50) * 1000:7.1f}ms "
+              f"p99 {percentile(latencies, 99) * 1000:7.1f}ms | per change: server sent "
+              f"{sent / changes / 1024:8.1f} KB, CPU {cpu / changes * 1000:6.1f}ms | "
+              f"{len(latencies)}/{clients * changes} updates")
+    print(f"initial listing: full list {stats['full_bytes'] / 1024:.0f} KB, "
+          f"first page of {ROOM_PAGE_SIZE} {stats['page_bytes'] / 1024:.1f} KB")
+
+async def abuse_flood(port, abusers, connections, rooms, ready, go, stop):
+    # Abusive accounts, each flooding several connections with messages, history and
+    # room requests as fast as the server takes them; half the connections never read
+    tokens = []
+    for n in range(abusers):
+        setup = await HeadlessClient.connect('localhost', port, codecs=())
+        await setup.register(f'abuser{n}', 'abuse')
+        tokens.append(await setup.login(f'abuser{n}', 'abuse'))
+        setup.close()
+    totals = {'sent': 0, 'throttled': 0}
+    
+    async def flood(n, client):
+        room, seq = rooms[n % len(rooms)], 0
+        while True:
+            await client.stream.send({'type': 'chat_message', 'room_id': room, 'message': f'spam {seq} ' + 'x' * 200})
+            if seq % 5 == 0:
+                await client.stream.send({'type': 'get_history', 'room_id': room, 'limit': MAX_HISTORY_PAGE})
+            if seq % 100 == 0:
+                await client.stream.send({'type': 'create_room', 'name': f'spam-{n}-{seq}', 'description': ''})
+            totals['sent'] += 1 + (seq % 5 == 0) + (seq % 100 == 0)
+            seq += 1
+            await asyncio.sleep(0)  # drain() doesn't yield until the server stops reading
+    
+    clients = []
+    for n in range(abusers * connections):
+        client = await HeadlessClient.connect('localhost', port, codecs=())
+        await client.resume(tokens[n % abusers], [rooms[n % len(rooms)]])
+        if n % 2:
+            client.reader.cancel()  # never reads its replies or the room's messages again
+        clients.append(client)
+    ready.set()
+    while not go.is_set():
+        await asyncio.sleep(0.01)
+    tasks = [asyncio.create_task(flood(n, client)) for n, client in enumerate(clients)]
+    while not stop.is_set():
+        await asyncio.sleep(0.1)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    totals['throttled'] = sum(client.throttled for client in clients)
+    for client in clients:
+        client.close()
+    return totals
+
+def abuse_process(port, abusers, connections, rooms, ready, go, stop, results):
+    results.put(asyncio.run(abuse_flood(port, abusers, connections, rooms, ready, go, stop)))
+
+def benchmark_abuse(users=200, abusers=4, connections=8, duration=10.0, room_size=10):
+    # Well-behaved loadgen users next to abusive clients flooding their rooms (from another
+    # process, starting once the users are attached), with and without rate limits: the
+    # limits should keep the good users' tail latency close to what it is without abuse
+    raise_fd_limit()
+    rooms = [1000 + i for i in range(max(1, users // room_size))]
+    print(f"{users} users in rooms of {room_size} (chat every ~0.5s), {abusers} abusers x {connections} "
+          f"connections flooding, {duration:.0f}s per run")
+    runs = (('no abuse', 0, ('--rate-limit', 'off')), ('abuse, no limits', abusers, ('--rate-limit', 'off')),
+            ('abuse, limits', abusers, ()))
+    for label, flooders, limits in runs:
+        with tempfile.TemporaryDirectory() as tmp:
+            proc, port = spawn_server('--async-server', tmp, extra=('--kdf-iterations', '1000', *limits))
+            ready, go, stop = multiprocessing.Event(), multiprocessing.Event(), multiprocessing.Event()
+            results = multiprocessing.Queue()
+            flood = multiprocessing.Process(target=abuse_process,
+                                            args=(port, flooders, connections, rooms, ready, go, stop, results))
+            try:
+                flood.start()
+                ready.wait(60)
+                stats = asyncio.run(run_loadgen('localhost', port, users, duration, 'chat=90,history=10', room_size,
+                                                accounts=users, think=0.5, server_pid=proc.pid, codecs=(),
+                                                on_ready=go.set))
+                stop.set()
+                abuse = results.get(timeout=60)
+            finally:
+                stop.set()
+                flood.join(10)
+                proc.terminate()
+                proc.wait()
+        history = stats['ops'].get('history', [])
+        errors = sum(stats['errors'].values())
+        print(f"{label:17} | delivery p50 {percentile(stats['delivery'], 50) * 1000:7.1f}ms "
+              f"p99 {percentile(stats['delivery'], 99) * 1000:7.1f}ms | history p99 "
+              f"{percentile(history, 99) * 1000:7.1f}ms | good users: {errors} errors, {stats['throttled']} throttled | "
+              f"abusers: {abuse['sent'] / stats['elapsed']:,.0f} req/s sent, {abuse['throttled']} throttled seen | "
+              f"server CPU {stats['server'].get('cpu_pct', 0):.0f}%")
+
 def main():
-    import sys
+    import argparse
+    parser = argparse.ArgumentParser(description="Advanced Chat Application")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--server', action='store_true', help="run the thread-per-connection server")
+    mode.add_argument('--async-server', action='store_true', help="run the asyncio event-loop server")
+    mode.add_argument('--sharded', action='store_true', help="run --workers asyncio server processes")
+    mode.add_argument('--bench', action='store_true', help="benchmark threaded vs asyncio server")
+    mode.add_argument('--bench-fanout', action='store_true', help="benchmark broadcast fan-out latency")
+    mode.add_argument('--bench-history', action='store_true', help="benchmark paginated history queries")
+    mode.add_argument('--bench-sharded', action='store_true', help="benchmark sharded server scaling")
+    mode.add_argument('--stress-db', action='store_true',
+                      help="check the database layer under concurrent reads and writes and measure reads/s")
+    mode.add_argument('--bench-search', action='store_true', help="benchmark full-text search queries")
+    mode.add_argument('--bench-compression', action='store_true', help="benchmark compression cost and savings")
+    mode.add_argument('--bench-retention', action='store_true', help="benchmark a retention pass under load")
+    mode.add_argument('--compact', action='store_true',
+                      help="archive per the retention limits and VACUUM --db, with the server stopped")
+    mode.add_argument('--bench-activity', action='store_true', help="benchmark presence/typing/read overhead")
+    mode.add_argument('--bench-rooms', action='store_true',
+                      help="benchmark keeping --connections clients' room lists current")
+    mode.add_argument('--bench-abuse', action='store_true', help="benchmark rate limiting under abusive clients")
+    mode.add_argument('--loadgen', action='store_true', help="run the headless load generator")
+    mode.add_argument('--replay', nargs='+', metavar='TRACE',
+                      help="replay captured --trace files against a fresh server per --builds")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--backlog', type=int, default=128, help="listen() accept backlog")
+    parser.add_argument('--db', default='chat.db', help="SQLite database path")
+    parser.add_argument('--durability', choices=sorted(DURABILITY_LEVELS), default='normal',
+                        help="message write durability")
+    parser.add_argument('--db-readers', type=int, default=DB_READERS,
+                        help="read-only database connections queries are spread over")
+    parser.add_argument('--blobs', default='attachments', help="attachment storage directory")
+    parser.add_argument('--kdf-iterations', type=int, default=KDF_ITERATIONS,
+                        help="PBKDF2 iterations for password hashes")
+    parser.add_argument('--rate-limit', action='append', metavar='TYPE=RATE/BURST',
+                        help="override a per-user request limit (room:TYPE=... for a per-room one, "
+                             "peer:TYPE=... for a per-address one, TYPE=off to remove one, 'off' for none); "
+                             "repeatable")
+    parser.add_argument('--activity-interval', type=float, default=ACTIVITY_INTERVAL,
+                        help="seconds between coalesced presence/typing/read deltas (0: one per event)")
+    parser.add_argument('--archive-dir', default='archive', help="where retention archives old messages")
+    parser.add_argument('--trace', metavar='PATH',
+                        help="record inbound traffic to this file for --replay (sharded workers add .SHARD)")
+    parser.add_argument('--retain-days', type=float, help="archive messages older than this (default: never)")
+    parser.add_argument('--retain-messages', type=int, help="keep at most this many messages per room live")
+    parser.add_argument('--room-retention', action='append', metavar='ROOM=DAYS/COUNT',
+                        help="a room's own limits instead of the defaults (either may be empty); repeatable")
+    parser.add_argument('--retention-interval', type=float, default=RETENTION_INTERVAL,
+                        help="seconds between retention passes")
+    parser.add_argument('--metrics-port', type=int,
+                        help="serve /metrics and /profile on this local port (sharded workers use port + shard)")
+    parser.add_argument('--workers', type=int, nargs='+', default=None,
+                        help="worker processes for --sharded (default: one per core); counts to compare "
+                             "for --bench-sharded")
+    parser.add_argument('--bus', help=argparse.SUPPRESS)  # set by --sharded for its workers
+    parser.add_argument('--shard', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--connections', type=int, default=1000, help="benchmark connections")
+    parser.add_argument('--duration', type=float, default=5.0, help="benchmark seconds per server")
+    parser.add_argument('--messages', type=int, nargs='+', default=[1_000_000, 10_000_000],
+                        help="stored message counts for --bench-history and --bench-search")
+    loadgen_opts = parser.add_argument_group('load generator')
+    loadgen_opts.add_argument('--target', help="HOST:PORT of a running server (default: spawn one)")
+    loadgen_opts.add_argument('--spawn', choices=['server', 'async-server', 'sharded'], default='async-server',
+                              help="server to spawn when no --target is given")
+    loadgen_opts.add_argument('--server-pid', type=int, help="pid of the --target server, for CPU/RSS")
+    loadgen_opts.add_argument('--users', type=int, default=1000, help="simulated users")
+    loadgen_opts.add_argument('--accounts', type=int, default=10, help="accounts the users log in as")
+    loadgen_opts.add_argument('--room-size', type=int, default=10, help="users per room")
+    loadgen_opts.add_argument('--mix', default=LOADGEN_MIX, help="operation weights, op=weight,...")
+    loadgen_opts.add_argument('--think', type=float, default=1.0, help="mean seconds between a user's operations")
+    loadgen_opts.add_argument('--payload', type=int, default=64, help="chat message padding in bytes")
+    loadgen_opts.add_argument('--attachment-size', type=int, default=64 * 1024, help="image/file upload bytes")
+    loadgen_opts.add_argument('--codecs', nargs='*', default=list(COMPRESSION_CODECS),
+                              help="compression codecs to offer (none given: no compression)")
+    loadgen_opts.add_argument('--json', help="also write the raw results to this file")
+    loadgen_opts.add_argument('--max-p99', type=float, help="exit 1 if delivery p99 exceeds this many ms")
+    replay_opts = parser.add_argument_group('replay (--spawn picks the server mode)')
+    replay_opts.add_argument('--speed', type=float, default=1.0, help="replay this many times faster than captured")
+    replay_opts.add_argument('--builds', nargs='+', metavar='SCRIPT',
+                             help="chat application files to compare (default: this one)")
+    replay_opts.add_argument('--replay-seed', metavar='DB', help="start each replay server from a copy of this database")
+    args = parser.parse_args()
+    retention = (args.retain_days, args.retain_messages)
     
     # Server mode
-    if len(sys.argv) > 1 and sys.argv[1] == '--server':
-        server = ChatServer()
-        server.start()
+    if args.sharded:
+        serve_sharded(args.workers[0] if args.workers else os.cpu_count() or 1,
+                      ['--host', args.host, '--port', str(args.port), '--backlog', str(args.backlog),
+                       '--db', args.db, '--durability', args.durability, '--blobs', args.blobs,
+                       '--kdf-iterations', str(args.kdf_iterations), '--archive-dir', args.archive_dir,
+                       '--retention-interval', str(args.retention_interval),
+                       '--activity-interval', str(args.activity_interval), '--db-readers', str(args.db_readers),
+                       *(['--trace', args.trace] if args.trace else []),
+                       *(['--retain-days', str(args.retain_days)] if args.retain_days is not None else []),
+                       *(['--retain-messages', str(args.retain_messages)] if args.retain_messages is not None else []),
+                       *[x for spec in args.room_retention or () for x in ('--room-retention', spec)],
+                       *(['--metrics-port', str(args.metrics_port)] if args.metrics_port else []),
+                       *[x for spec in args.rate_limit or () for x in ('--rate-limit', spec)]], args.db)
+        return
+    
+    if args.server or args.async_server:
+        raise_fd_limit()
+        limits, room_limits, peer_limits = parse_rate_limits(args.rate_limit)
+        options = {'rate_limits': limits, 'room_rate_limits': room_limits, 'peer_rate_limits': peer_limits,
+                   'archive_dir': args.archive_dir,
+                   'retention': retention, 'retention_interval': args.retention_interval,
+                   'activity_interval': args.activity_interval, 'db_readers': args.db_readers,
+                   'trace_path': args.trace and (f'{args.trace}.{args.shard}' if args.bus else args.trace)}
+        if args.bus:
+            server = ShardedChatServer(args.host, args.port, args.backlog, args.db, args.durability, args.blobs,
+                                       args.kdf_iterations, bus_path=args.bus, shard=args.shard,
+                                       shards=args.workers[0],
+                                       metrics_port=args.metrics_port and args.metrics_port + args.shard, **options)
+        else:
+            server_cls = AsyncChatServer if args.async_server else ChatServer
+            server = server_cls(args.host, args.port, args.backlog, args.db, args.durability, args.blobs,
+                                args.kdf_iterations, metrics_port=args.metrics_port, **options)
+        for spec in args.room_retention or ():
+            server.db.set_retention(*parse_retention(spec))
+        # Turn SIGTERM into a normal exit so queued messages are flushed
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            server.start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.running = False
+            server.save_read_cursors()
+            if server.retention:
+                server.retention.stop()
+            if server.trace:
+                server.trace.close()
+            server.db.close()
+        return
+    
+    if args.compact:
+        db = ChatDatabase(args.db, archive_dir=args.archive_dir)  # brings the schema up to date
+        for spec in args.room_retention or ():
+            db.set_retention(*parse_retention(spec))
+        db.close()
+        compact(args.db, args.archive_dir, retention)
+        return
+    
+    if args.bench_retention:
+        benchmark_retention(args.messages[0], duration=args.duration)
+        return
+    
+    if args.bench:
+        benchmark_servers(args.connections, args.duration, backlog=args.backlog)
+        return
+    
+    if args.bench_fanout:
+        benchmark_fanout()
+        return
+    
+    if args.bench_history:
+        benchmark_history(args.messages)
+        return
+    
+    if args.stress_db:
+        if stress_db(sorted({1, args.db_readers}), duration=args.duration):
+            sys.exit(1)
+        return
+    
+    if args.bench_compression:
+        benchmark_compression()
+        return
+    
+    if args.bench_search:
+        benchmark_search(args.messages)
+        return
+    
+    if args.bench_sharded:
+        benchmark_sharded(args.workers, args.connections, args.duration)
+        return
+    
+    if args.bench_activity:
+        benchmark_activity(args.connections, duration=args.duration * 2)
+        return
+    
+    if args.bench_rooms:
+        benchmark_rooms(clients=args.connections)
+        return
+    
+    if args.bench_abuse:
+        benchmark_abuse(duration=args.duration * 2)
+        return
+    
+    if args.loadgen:
+        loadgen(args)
+        return
+    
+    if args.replay:
+        replay(args)
         return
     
     # Auto-start server and client
     print("Starting server...")
     start_server()
     
-    def on_login_success(username, user_id, socket):
-        app = ChatClient(username, user_id, socket)
+    def on_login_success(username, user_id, socket, token):
+        app = ChatClient(username, user_id, socket, token)
         app.run()
     
     login = LoginWindow(on_login_success)
@@ -1,11 +1,302 @@
 import tkinter as tk
 from tkinter import ttk, messagebox, scrolledtext
-import random
+import argparse
+import math
+import os
+import queue
 import string
 import secrets
-import pyperclip
+import sys
+import threading
+import time
 import re
-from typing import List, Dict
+from bisect import bisect_right
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import lru_cache
+from itertools import accumulate, chain, compress, islice, product, repeat
+from typing import List, Dict, BinaryIO
+
+try:
+    import pyperclip
+except ImportError:
+    pyperclip = None
+
+# Character sets
+CHAR_SETS = {
+    'lowercase': string.ascii_lowercase,
+    'uppercase': string.ascii_uppercase,
+    'numbers': string.digits,
+    'symbols': "!@#$%^&*()_+-=[]{}|;:,.<>?",
+    'similar': "il1Lo0O",
+    'ambiguous': "{}[]()/\\'\"`~,;.<>"
+}
+
+# Minimum-count settings and the character set each one counts
+REQUIREMENT_CLASSES = {
+    'min_uppercase': 'uppercase',
+    'min_lowercase': 'lowercase',
+    'min_numbers': 'numbers',
+    'min_symbols': 'symbols'
+}
+
+ENGINE_BATCH = 65536  # passwords generated from each block of random bytes
+BLOCK_BYTES = 1 << 22  # most random bytes screened at once by the bulk path
+DIRECT_BELOW = 0.05  # share of random candidates that must be valid for the bulk path to pay off
+MAX_ATTEMPTS = 1000  # the window's old retry limit, kept for the benchmark's comparison
+MAX_FILE_PASSWORDS = 100000000  # most passwords the window generates into one file
+
+def build_charset(types: List[str], exclude_similar: bool = True, exclude_ambiguous: bool = False,
+                  exclude: str = "") -> str:
+    """Join the chosen character sets minus excluded characters, without duplicates"""
+    if exclude_similar:
+        exclude += CHAR_SETS['similar']
+    if exclude_ambiguous:
+        exclude += CHAR_SETS['ambiguous']
+    charset = ''.join(CHAR_SETS[char_type] for char_type in types)
+    return ''.join(dict.fromkeys(c for c in charset if c not in exclude))
+
+class PasswordEngine:
+    """Headless bulk generator mapping blocks of CSPRNG bytes onto a character set"""
+    
+    def __init__(self, length: int, charset: str, minimums: Dict[str, int] = None,
+                 no_repeating: bool = False):
+        """Check the settings can be met and precompute the byte tables"""
+        charset = ''.join(dict.fromkeys(charset))
+        if not charset or not charset.isascii():
+            raise ValueError("Character set must be non-empty ASCII")
+        if not 1 <= length <= 255:
+            raise ValueError("Password length must be between 1 and 255 characters")
+        minimums = {key: value for key, value in (minimums or {}).items() if value}
+        if any(value < 0 for value in minimums.values()):
+            raise ValueError("Minimum values cannot be negative")
+        if sum(minimums.values()) > length:
+            raise ValueError("Sum of minimum requirements exceeds password length")
+        if no_repeating and length > len(charset):
+            raise ValueError("Password length exceeds the character set, so characters must repeat")
+        
+        self.length = length
+        self.charset = charset
+        self.minimums = minimums
+        self.no_repeating = no_repeating
+        
+        # Bytes from the largest multiple of the charset size up are dropped, so every
+        # character is drawn with exactly the same probability
+        encoded = charset.encode('ascii')
+        self.limit = 256 - 256 % len(encoded)
+        self.table = bytes(encoded[b % len(encoded)] for b in range(256))
+        self.rejected = bytes(range(self.limit, 256))
+        
+        # Each requirement marks the bytes in its class with 1, and the counts that satisfy it with 1
+        self.checks = []
+        for key, minimum in minimums.items():
+            if key not in REQUIREMENT_CLASSES:
+                raise ValueError(f"Unknown requirement {key}")
+            members = set(CHAR_SETS[REQUIREMENT_CLASSES[key]].encode('ascii')) & set(encoded)
+            if not members or no_repeating and len(members) < minimum:
+                raise ValueError(f"Character set cannot satisfy {key}")
+            self.checks.append((bytes(b in members for b in range(256)), bytes(n >= minimum for n in range(256))))
+        self.ones = int.from_bytes(b'\x01' * length, 'little')
+        tests = len(self.checks) + no_repeating
+        self.passed = bytes(n == tests for n in range(256))
+        
+        # The charset split into the requirement classes, each with its minimum; characters
+        # outside all of them form a last class with none
+        self.classes = []
+        others = encoded
+        for key, char_type in REQUIREMENT_CLASSES.items():
+            members = bytes(b for b in encoded if chr(b) in CHAR_SETS[char_type])
+            others = bytes(b for b in others if b not in members)
+            if members:
+                self.classes.append((members, minimums.get(key, 0)))
+        if others:
+            self.classes.append((others, 0))
+        
+        # ways[j][r] counts the valid passwords of length r made from classes j onwards:
+        # k characters of class j take comb(r, k) sets of positions, filled fill(size, k)
+        # ways, and the other r - k positions are ways[j + 1][r - k]
+        self.ways = [[1] + [0] * length]
+        for members, minimum in reversed(self.classes):
+            after = self.ways[0]
+            self.ways.insert(0, [sum(math.comb(r, k) * self.fill(len(members), k) * after[r - k]
+                                     for k in range(minimum, r + 1)) for r in range(length + 1)])
+        self.valid_count = self.ways[0][length]
+        if not self.valid_count:
+            raise ValueError("No password can meet these requirements")
+        self.cumulative = {}
+        # CSPRNG bytes for the direct path's small draws, and per class a table for drawing
+        # its characters in bulk the way random_chars does for the whole charset
+        self.stream = chain.from_iterable(map(os.urandom, repeat(4096)))
+        self.class_tables = [(bytes(members[b % len(members)] for b in range(256)),
+                              bytes(range(256 - 256 % len(members), 256))) for members, _ in self.classes]
+        
+        # Screening uniform candidates is fastest while enough of them are valid; below that
+        # each password is drawn directly
+        self.acceptance = self.valid_count / len(encoded) ** length
+        self.direct = self.acceptance < DIRECT_BELOW
+    
+    def fill(self, size: int, k: int) -> int:
+        """Ways to fill k positions from a class of size characters"""
+        return math.perm(size, k) if self.no_repeating else size ** k
+    
+    def below(self, n: int) -> int:
+        """Draw a uniform integer in [0, n) from the buffered CSPRNG bytes"""
+        if n <= 256:
+            limit = 256 - 256 % n
+            b = next(self.stream)
+            while b >= limit:
+                b = next(self.stream)
+            return b % n
+        # Just enough random bits for n, redrawn until they fall below it
+        bits = n.bit_length()
+        while True:
+            value = int.from_bytes(bytes(islice(self.stream, (bits + 7) // 8)), 'little') >> (-bits % 8)
+            if value < n:
+                return value
+    
+    def class_count(self, j: int, remaining: int) -> int:
+        """Draw how many of the remaining positions class j takes, weighted by the passwords each count allows"""
+        key = (j, remaining)
+        if key not in self.cumulative:
+            members, minimum = self.classes[j]
+            after = self.ways[j + 1]
+            self.cumulative[key] = list(accumulate(
+                math.comb(remaining, k) * self.fill(len(members), k) * after[remaining - k]
+                for k in range(minimum, remaining + 1)))
+        cumulative = self.cumulative[key]
+        return self.classes[j][1] + bisect_right(cumulative, self.below(cumulative[-1]))
+    
+    def sample(self) -> bytes:
+        """Draw one valid password directly, every valid password equally likely"""
+        # The class counts are drawn in proportion to the valid passwords having them. Given
+        # the counts, the draws within each class and the shuffle make each of those passwords
+        # equally likely, so every valid password has probability 1 / valid_count.
+        chars = bytearray()
+        remaining = self.length
+        last = len(self.classes) - 1
+        for j, (members, _) in enumerate(self.classes):
+            k = self.class_count(j, remaining) if j < last else remaining
+            if self.no_repeating:
+                # Partial Fisher-Yates: each draw swaps a fresh character into place in O(1)
+                pool = bytearray(members)
+                for i in range(k):
+                    swap = i + self.below(len(pool) - i)
+                    pool[i], pool[swap] = pool[swap], pool[i]
+                chars += pool[:k]
+            else:
+                table, rejected = self.class_tables[j]
+                drawn = bytes(islice(self.stream, 2 * k + 8)).translate(table, rejected)
+                while len(drawn) < k:
+                    drawn += bytes(islice(self.stream, 2 * k + 8)).translate(table, rejected)
+                chars += drawn[:k]
+            remaining -= k
+        self.shuffle(chars)
+        return bytes(chars)
+    
+    def shuffle(self, chars: bytearray):
+        """Fisher-Yates shuffle on the OS CSPRNG"""
+        for i in range(len(chars) - 1, 0, -1):
+            swap = self.below(i + 1)
+            chars[i], chars[swap] = chars[swap], chars[i]
+    
+    def random_chars(self, count: int) -> bytes:
+        """Return count independent, uniformly chosen characters as ASCII bytes"""
+        chunks, have = [], 0
+        while have < count:
+            # Enough bytes to survive rejection on average, plus a little slack
+            chunk = os.urandom((count - have) * 256 // self.limit + 64).translate(self.table, self.rejected)
+            chunks.append(chunk)
+            have += len(chunk)
+        return b''.join(chunks)[:count]
+    
+    def valid(self, block: bytes) -> List[bytes]:
+        """Split a block into passwords, keeping those that meet the requirements"""
+        length = self.length
+        starts = range(0, len(block), length)
+        # The block is treated as one big integer of per-password byte lanes. A class's 0/1
+        # marks times 0x0101..01 (length bytes) puts each password's count in its last
+        # byte; it never exceeds the length, so nothing carries between passwords. The
+        # same goes for adding up the per-password pass flags of every test.
+        passes = 0
+        for marks, satisfied in self.checks:
+            counts = (int.from_bytes(block.translate(marks), 'little') * self.ones).to_bytes(
+                len(block) + length, 'little')[length - 1::length]
+            passes += int.from_bytes(counts.translate(satisfied), 'little')
+        if self.no_repeating:
+            passes += int.from_bytes(bytes(len(set(block[i:i + length])) == length for i in starts), 'little')
+        flags = passes.to_bytes(len(starts), 'little').translate(self.passed)
+        return [block[i:i + length] for i in compress(starts, flags)]
+    
+    def batch(self, count: int) -> List[bytes]:
+        """Generate count passwords as ASCII bytes"""
+        if self.direct:
+            return [self.sample() for _ in range(count)]
+        length = self.length
+        passwords = []
+        while len(passwords) < count:
+            # As many candidates as the acceptance rate says it takes, with a little to spare
+            draws = min(int((count - len(passwords)) / self.acceptance * 1.05) + 16, BLOCK_BYTES // length)
+            block = self.random_chars(draws * length)
+            if self.checks or self.no_repeating:
+                # Whole candidates are rejected, so each valid password stays equally likely
+                candidates = self.valid(block)
+            else:
+                candidates = [block[i:i + length] for i in range(0, len(block), length)]
+            passwords.extend(candidates[:count - len(passwords)])
+        return passwords
+    
+    def generate(self, count: int) -> List[str]:
+        """Generate count passwords"""
+        return [password.decode('ascii') for password in self.batch(count)]
+    
+    def write(self, count: int, out: BinaryIO, batch_size: int = ENGINE_BATCH) -> int:
+        """Stream count passwords to a binary file, one per line, a batch at a time"""
+        written = 0
+        while written < count:
+            passwords = self.batch(min(batch_size, count - written))
+            out.write(b'\n'.join(passwords) + b'\n')
+            written += len(passwords)
+        return written
+
+@lru_cache(maxsize=8)
+def shard_engine(pid: int, length: int, charset: str, minimums: tuple, no_repeating: bool) -> PasswordEngine:
+    """One engine per worker process and settings, reused across its shards"""
+    # Keyed by pid, so a forked worker never reuses random bytes its parent had buffered
+    return PasswordEngine(length, charset, dict(minimums), no_repeating)
+
+def generate_shard(settings: tuple, count: int) -> bytes:
+    """Pool worker: count passwords, one per line, from this process's own CSPRNG stream"""
+    return b'\n'.join(shard_engine(os.getpid(), *settings).batch(count)) + b'\n'
+
+def parallel_write(engine: PasswordEngine, count: int, out: BinaryIO, workers: int = None,
+                   progress=None, cancel=None, shard_size: int = ENGINE_BATCH) -> int:
+    """Generate count passwords across a process pool, writing each shard as it finishes"""
+    workers = workers or os.cpu_count() or 1
+    settings = (engine.length, engine.charset, tuple(sorted(engine.minimums.items())), engine.no_repeating)
+    shards = iter([min(shard_size, count - start) for start in range(0, count, shard_size)])
+    written = 0
+    with ProcessPoolExecutor(workers) as pool:
+        pending = {}  # future -> passwords in its shard
+        while True:
+            # A couple of shards per worker in flight keeps every core busy without
+            # holding more than a few shards in memory
+            for size in islice(shards, 2 * workers - len(pending)):
+                pending[pool.submit(generate_shard, settings, size)] = size
+            if not pending or cancel is not None and cancel.is_set():
+                break
+            done, _ = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+            for future in done:
+                out.write(future.result())
+                written += pending.pop(future)
+                if progress:
+                    progress(written, count)
+        for future in pending:
+            future.cancel()
+    return written
+
+def open_private(path: str) -> BinaryIO:
+    """Open a file for writing that only its owner can read"""
+    return open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb')
 
 class PasswordGenerator:
     def __init__(self):
@@ -22,14 +313,7 @@ class PasswordGenerator:
         self.password_history = []
         
         # Character sets
-        self.char_sets = {
-            'lowercase': string.ascii_lowercase,
-            'uppercase': string.ascii_uppercase,
-            'numbers': string.digits,
-            'symbols': "!@#$%^&*()_+-=[]{}|;:,.<>?",
-            'similar': "il1Lo0O",
-            'ambiguous': "{}[]()/\\'\"`~,;.<>"
-        }
+        self.char_sets = CHAR_SETS
         
         self.setup_ui()
         
@@ -132,6 +416,11 @@ class PasswordGenerator:
                                       style='Accent.TButton')
         self.generate_btn.pack(side=tk.LEFT)
         
+        # Large batches go straight to a file, generated in the background
+        self.generate_file_btn = ttk.Button(gen_frame, text="Generate to File...",
+                                           command=self.generate_to_file)
+        self.generate_file_btn.pack(side=tk.LEFT, padx=(10, 0))
+        
         # Password display
         display_frame = ttk.LabelFrame(main_frame, text="Generated Passwords", padding="10")
         display_frame.grid(row=6, column=0, columnspan=2, sticky=(tk.W, tk.E, tk.N, tk.S), pady=10)
@@ -167,6 +456,18 @@ class PasswordGenerator:
         self.strength_progress = ttk.Progressbar(strength_frame, length=200, mode='determinate')
         self.strength_progress.grid(row=1, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=(5, 0))
         
+        # Progress of a background generation
+        job_frame = ttk.Frame(main_frame)
+        job_frame.grid(row=8, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=(0, 10))
+        job_frame.columnconfigure(0, weight=1)
+        
+        self.job_progress = ttk.Progressbar(job_frame, length=200, mode='determinate')
+        self.job_progress.grid(row=0, column=0, sticky=(tk.W, tk.E))
+        self.cancel_btn = ttk.Button(job_frame, text="Cancel", command=self.cancel_job, state=tk.DISABLED)
+        self.cancel_btn.grid(row=0, column=1, padx=(10, 0))
+        self.job_status = tk.StringVar()
+        ttk.Label(job_frame, textvariable=self.job_status).grid(row=1, column=0, columnspan=2, sticky=tk.W)
+        
         # Bind events
         self.length_entry.bind('<KeyRelease>', self.update_length_scale)
         
@@ -186,7 +487,7 @@ class PasswordGenerator:
         except ValueError:
             pass
     
-    def validate_inputs(self) -> tuple[bool, str]:
+    def validate_inputs(self, max_count: int = 100) -> tuple[bool, str]:
         """Validate user inputs"""
         try:
             length = int(self.length_var.get())
@@ -215,8 +516,8 @@ class PasswordGenerator:
         
         try:
             count = int(self.count_var.get())
-            if count < 1 or count > 100:
-                return False, "Number of passwords must be between 1 and 100"
+            if count < 1 or count > max_count:
+                return False, f"Number of passwords must be between 1 and {max_count:,}"
         except ValueError:
             return False, "Invalid number of passwords"
         
@@ -224,118 +525,20 @@ class PasswordGenerator:
     
     def build_character_set(self) -> str:
         """Build the character set based on user selections"""
-        charset = ""
-        
-        # Add selected character types
-        for char_type, include in self.char_vars.items():
-            if include.get():
-                charset += self.char_sets[char_type]
-        
-        # Remove excluded characters
-        if self.security_vars.get('exclude_similar', tk.BooleanVar()).get():
-            charset = ''.join(c for c in charset if c not in self.char_sets['similar'])
-        
-        if self.security_vars.get('exclude_ambiguous', tk.BooleanVar()).get():
-            charset = ''.join(c for c in charset if c not in self.char_sets['ambiguous'])
-        
-        # Remove custom exclusions
-        custom_exclude = self.exclude_var.get()
-        if custom_exclude:
-            charset = ''.join(c for c in charset if c not in custom_exclude)
-        
-        # Remove duplicates while preserving order
-        seen = set()
-        charset = ''.join(c for c in charset if not (c in seen or seen.add(c)))
-        
-        return charset
+        types = [char_type for char_type, include in self.char_vars.items() if include.get()]
+        return build_charset(types, self.security_vars['exclude_similar'].get(),
+                             self.security_vars['exclude_ambiguous'].get(), self.exclude_var.get())
+    
+    def create_engine(self, length: int, charset: str) -> PasswordEngine:
+        """Build a generator for the current security rules"""
+        # Minimums only apply to the character types that are selected
+        minimums = {key: int(self.security_vars[key].get()) for key, char_type in REQUIREMENT_CLASSES.items()
+                    if self.char_vars[char_type].get()}
+        return PasswordEngine(length, charset, minimums, self.security_vars['no_repeating'].get())
     
     def generate_single_password(self, length: int, charset: str) -> str:
         """Generate a single password meeting all requirements"""
-        max_attempts = 1000
-        
-        for _ in range(max_attempts):
-            password = ''.join(secrets.choice(charset) for _ in range(length))
-            
-            if self.meets_requirements(password):
-                return password
-        
-        # If we can't meet requirements with random generation, 
-        # build password strategically
-        return self.build_compliant_password(length, charset)
-    
-    def meets_requirements(self, password: str) -> bool:
-        """Check if password meets all security requirements"""
-        # Check minimum character type requirements
-        requirements = {
-            'min_uppercase': sum(1 for c in password if c.isupper()),
-            'min_lowercase': sum(1 for c in password if c.islower()),
-            'min_numbers': sum(1 for c in password if c.isdigit()),
-            'min_symbols': sum(1 for c in password if c in self.char_sets['symbols'])
-        }
-        
-        for req_type, actual_count in requirements.items():
-            try:
-                required_count = int(self.security_vars[req_type].get())
-                if actual_count < required_count:
-                    return False
-            except (ValueError, KeyError):
-                pass
-        
-        # Check no repeating characters
-        if self.security_vars.get('no_repeating', tk.BooleanVar()).get():
-            if len(set(password)) != len(password):
-                return False
-        
-        return True
-    
-    def build_compliant_password(self, length: int, charset: str) -> str:
-        """Build a password that meets all requirements"""
-        password = []
-        remaining_length = length
-        
-        # Add minimum required characters
-        char_pools = {
-            'min_uppercase': [c for c in charset if c.isupper()],
-            'min_lowercase': [c for c in charset if c.islower()],
-            'min_numbers': [c for c in charset if c.isdigit()],
-            'min_symbols': [c for c in charset if c in self.char_sets['symbols']]
-        }
-        
-        for req_type, pool in char_pools.items():
-            if not pool:
-                continue
-            try:
-                required_count = int(self.security_vars[req_type].get())
-                for _ in range(min(required_count, remaining_length)):
-                    if self.security_vars.get('no_repeating', tk.BooleanVar()).get():
-                        available = [c for c in pool if c not in password]
-                        if available:
-                            password.append(secrets.choice(available))
-                            remaining_length -= 1
-                    else:
-                        password.append(secrets.choice(pool))
-                        remaining_length -= 1
-            except (ValueError, KeyError):
-                pass
-        
-        # Fill remaining positions
-        available_chars = list(charset)
-        if self.security_vars.get('no_repeating', tk.BooleanVar()).get():
-            available_chars = [c for c in available_chars if c not in password]
-        
-        while remaining_length > 0 and available_chars:
-            char = secrets.choice(available_chars)
-            password.append(char)
-            remaining_length -= 1
-            
-            if self.security_vars.get('no_repeating', tk.BooleanVar()).get():
-                available_chars.remove(char)
-        
-        # Shuffle the password
-        password_list = list(password)
-        random.shuffle(password_list)
-        
-        return ''.join(password_list)
+        return self.create_engine(length, charset).generate(1)[0]
     
     def calculate_strength(self, password: str) -> tuple[int, str]:
         """Calculate password strength score and description"""
@@ -377,7 +580,6 @@ class PasswordGenerator:
             charset_size += len(self.char_sets['symbols'])
         
         if charset_size > 0:
-            import math
             entropy = length * math.log2(charset_size)
             if entropy >= 60:
                 score += 20
@@ -424,10 +626,11 @@ class PasswordGenerator:
                 return
             
             # Generate passwords
-            passwords = []
-            for _ in range(count):
-                password = self.generate_single_password(length, charset)
-                passwords.append(password)
+            try:
+                passwords = self.create_engine(length, charset).generate(count)
+            except ValueError as e:
+                messagebox.showerror("Invalid Input", str(e))
+                return
             
             # Display passwords
             self.password_text.delete(1.0, tk.END)
@@ -462,6 +665,81 @@ class PasswordGenerator:
         except Exception as e:
             messagebox.showerror("Error", f"An error occurred: {str(e)}")
     
+    def generate_to_file(self):
+        """Generate the requested passwords into a file on all cores, without blocking the window"""
+        valid, error_msg = self.validate_inputs(MAX_FILE_PASSWORDS)
+        if not valid:
+            messagebox.showerror("Invalid Input", error_msg)
+            return
+        
+        length = int(self.length_var.get())
+        count = int(self.count_var.get())
+        try:
+            engine = self.create_engine(length, self.build_character_set())
+        except ValueError as e:
+            messagebox.showerror("Invalid Input", str(e))
+            return
+        
+        from tkinter import filedialog
+        filename = filedialog.asksaveasfilename(
+            defaultextension=".txt",
+            filetypes=[("Text files", "*.txt"), ("All files", "*.*")]
+        )
+        if not filename:
+            return
+        
+        self.job_count = count
+        self.job_cancel = threading.Event()
+        self.job_events = queue.Queue()
+        self.generate_btn.configure(state=tk.DISABLED)
+        self.generate_file_btn.configure(state=tk.DISABLED)
+        self.cancel_btn.configure(state=tk.NORMAL)
+        self.job_progress['value'] = 0
+        self.job_status.set(f"Generating {count:,} passwords...")
+        threading.Thread(target=self.run_job, args=(engine, count, filename), daemon=True).start()
+        self.root.after(100, self.poll_job)
+    
+    def run_job(self, engine: PasswordEngine, count: int, filename: str):
+        """Background thread: write the passwords and report back through the event queue"""
+        try:
+            with open_private(filename) as out:
+                written = parallel_write(engine, count, out,
+                                         progress=lambda done, total: self.job_events.put(('progress', done)),
+                                         cancel=self.job_cancel)
+            self.job_events.put(('done', written, filename))
+        except Exception as e:
+            self.job_events.put(('error', str(e)))
+    
+    def poll_job(self):
+        """Apply the background job's progress to the window until it finishes"""
+        while not self.job_events.empty():
+            event = self.job_events.get()
+            if event[0] == 'progress':
+                self.job_progress['value'] = 100 * event[1] / self.job_count
+                self.job_status.set(f"{event[1]:,} of {self.job_count:,} passwords")
+                continue
+            
+            self.generate_btn.configure(state=tk.NORMAL)
+            self.generate_file_btn.configure(state=tk.NORMAL)
+            self.cancel_btn.configure(state=tk.DISABLED)
+            if event[0] == 'error':
+                self.job_status.set("Failed")
+                messagebox.showerror("Error", f"Failed to generate passwords: {event[1]}")
+            elif event[1] < self.job_count:
+                self.job_status.set(f"Cancelled after {event[1]:,} passwords")
+                messagebox.showinfo("Cancelled", f"Stopped after {event[1]:,} passwords, saved to {event[2]}")
+            else:
+                self.job_status.set(f"{event[1]:,} passwords saved")
+                messagebox.showinfo("Success", f"{event[1]:,} passwords saved to {event[2]}")
+            return
+        self.root.after(100, self.poll_job)
+    
+    def cancel_job(self):
+        """Stop a background generation after the shards already running"""
+        self.job_cancel.set()
+        self.cancel_btn.configure(state=tk.DISABLED)
+        self.job_status.set("Cancelling...")
+    
     def copy_to_clipboard(self):
         """Copy generated passwords to clipboard"""
         password_content = self.password_text.get(1.0, tk.END).strip()
@@ -505,10 +783,216 @@ class PasswordGenerator:
         """Start the application"""
         self.root.mainloop()
 
-if __name__ == "__main__":
+def legacy_password(length: int, charset: str, minimums: Dict[str, int], no_repeating: bool) -> str:
+    """The window's original approach: one secrets.choice per character, retried until valid"""
+    for _ in range(MAX_ATTEMPTS):
+        password = ''.join(secrets.choice(charset) for _ in range(length))
+        counts = {
+            'min_uppercase': sum(1 for c in password if c.isupper()),
+            'min_lowercase': sum(1 for c in password if c.islower()),
+            'min_numbers': sum(1 for c in password if c.isdigit()),
+            'min_symbols': sum(1 for c in password if c in CHAR_SETS['symbols'])
+        }
+        if all(counts[key] >= minimum for key, minimum in minimums.items()) and not (
+                no_repeating and len(set(password)) != len(password)):
+            return password
+    return password
+
+def benchmark(args, engine: PasswordEngine):
+    """Compare passwords/sec of the engine's two paths with the window's old retry loop"""
+    def rate(generate, count):
+        start = time.perf_counter()
+        generate(count)
+        return count / (time.perf_counter() - start)
+    
+    print(f"Length {engine.length}, {len(engine.charset)} characters, requirements {engine.minimums or 'none'}"
+          f"{', no repeats' if engine.no_repeating else ''}: {math.log2(engine.valid_count):.1f} bits, "
+          f"{engine.acceptance * 100:.3g}% of random strings qualify")
+    # The retry loop can take a thousand attempts a password, so it gets two seconds at most
+    start, done = time.perf_counter(), 0
+    while done < min(args.count, 20000) and time.perf_counter() - start < 2:
+        legacy_password(engine.length, engine.charset, engine.minimums, engine.no_repeating)
+        done += 1
+    legacy = done / (time.perf_counter() - start)
+    print(f"  retry loop:     {legacy:12,.0f} passwords/sec")
+    chosen = engine.direct
+    # Screening gets as slow as its acceptance rate is low, so hopeless cases are skipped
+    paths = [('direct sampler', True, min(args.count, 200000))]
+    if engine.acceptance >= 0.001:
+        paths.append(('bulk screening', False, args.count))
+    with open(os.devnull, 'wb') as sink:
+        for label, direct, count in paths:
+            engine.direct = direct
+            speed = rate(lambda n: engine.write(n, sink), count)
+            print(f"  {label}: {speed:12,.0f} passwords/sec {speed / legacy:6.0f}x"
+                  f"{'  (chosen)' if direct == chosen else ''}")
+    engine.direct = chosen
+
+def benchmark_workers(args, engine: PasswordEngine):
+    """Show how passwords/sec scales with the number of worker processes"""
+    cores = os.cpu_count() or 1
+    counts = sorted({1, cores} | {2 ** i for i in range(cores.bit_length()) if 2 ** i < cores})
+    print(f"{args.count:,} passwords of length {engine.length} ({'direct sampler' if engine.direct else 'bulk screening'}), "
+          f"{cores} cores")
+    with open(os.devnull, 'wb') as sink:
+        start = time.perf_counter()
+        engine.write(args.count, sink)
+        single = args.count / (time.perf_counter() - start)
+        print(f"  in-process: {single:12,.0f} passwords/sec")
+        for workers in counts:
+            start = time.perf_counter()
+            parallel_write(engine, args.count, sink, workers)
+            speed = args.count / (time.perf_counter() - start)
+            print(f"  {workers:3} workers: {speed:11,.0f} passwords/sec  {speed / single:5.2f}x, "
+                  f"{speed / single / workers:4.0%} per worker")
+
+# Small settings whose valid passwords can all be listed, for --stat-test:
+# (description, length, charset, minimums, no_repeating)
+STAT_CASES = [
+    ("4 of abAB1!, an uppercase and a number", 4, "abAB1!", {'min_uppercase': 1, 'min_numbers': 1}, False),
+    ("4 of abcAB12!?, no repeats, 2 symbols", 4, "abcAB12!?", {'min_symbols': 2}, True),
+    ("5 of abAB1!, 2 uppercase and a symbol", 5, "abAB1!", {'min_uppercase': 2, 'min_symbols': 1}, False)
+]
+STAT_SAMPLES = 100  # draws per valid password
+STAT_ALPHA = 0.001  # p-values below this fail
+
+def follows_rules(password: str, minimums: Dict[str, int], no_repeating: bool) -> bool:
+    """Check a password against the rules directly, independently of the engine"""
+    for key, minimum in minimums.items():
+        if sum(c in CHAR_SETS[REQUIREMENT_CLASSES[key]] for c in password) < minimum:
+            return False
+    return not no_repeating or len(set(password)) == len(password)
+
+def chi_square_p(observed: List[int], expected: float) -> float:
+    """Upper-tail p-value of the chi-square statistic for counts that should all be expected"""
+    dof = len(observed) - 1
+    statistic = sum((n - expected) ** 2 for n in observed) / expected
+    # Wilson-Hilferty: the cube root of statistic / dof is close to normal
+    z = ((statistic / dof) ** (1 / 3) - 1 + 2 / (9 * dof)) / math.sqrt(2 / (9 * dof))
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+def minimums_first_password(engine: PasswordEngine) -> bytes:
+    """The usual shortcut, as in the window's old fallback: required characters, any others, shuffled"""
+    encoded = engine.charset.encode('ascii')
+    chars = bytearray()
+    for members, minimum in engine.classes:
+        chars += bytes(members[engine.below(len(members))] for _ in range(minimum))
+    chars += bytes(encoded[engine.below(len(encoded))] for _ in range(engine.length - len(chars)))
+    engine.shuffle(chars)
+    return bytes(chars)
+
+def stat_test() -> bool:
+    """Check both generation paths are uniform over every valid password of small settings"""
+    ok = True
+    for description, length, charset, minimums, no_repeating in STAT_CASES:
+        engine = PasswordEngine(length, charset, minimums, no_repeating)
+        valid = [''.join(p) for p in product(charset, repeat=length) if follows_rules(''.join(p), minimums, no_repeating)]
+        counted = engine.valid_count == len(valid)
+        ok = ok and counted
+        print(f"{description}: {len(valid):,} valid passwords, engine counts {engine.valid_count:,}"
+              f"{'' if counted else '  FAIL'}")
+        draws = STAT_SAMPLES * len(valid)
+        samplers = [('direct sampler', True), ('bulk screening', False)]
+        if not no_repeating:
+            # A sampler known to be biased shows the test can tell
+            samplers.append(('minimums first', None))
+        for label, direct in samplers:
+            if direct is None:
+                drawn = [minimums_first_password(engine).decode('ascii') for _ in range(draws)]
+            else:
+                engine.direct = direct
+                drawn = engine.generate(draws)
+            counts = Counter(drawn)
+            invalid = sum(n for password, n in counts.items() if not follows_rules(password, minimums, no_repeating))
+            p = chi_square_p([counts[password] for password in valid], STAT_SAMPLES)
+            if direct is None:
+                verdict = "biased, as expected" if p < STAT_ALPHA else "bias not detected"
+            else:
+                passed = not invalid and p >= STAT_ALPHA
+                ok = ok and passed
+                verdict = "ok" if passed else "FAIL"
+            print(f"  {label}: {draws:,} draws, {invalid} invalid, chi-square p = {p:.4f}  {verdict}")
+    return ok
+
+def parse_args(argv=None):
+    """Command-line options; without any the window opens instead"""
+    parser = argparse.ArgumentParser(
+        description="Advanced Password Generator. Opens the window when run without arguments, "
+                    "otherwise writes passwords to stdout or a file.")
+    parser.add_argument('-n', '--count', type=int, help="number of passwords (default 1, 1,000,000 with --bench)")
+    parser.add_argument('-l', '--length', type=int, default=12, help="password length (default 12)")
+    for char_type in ('lowercase', 'uppercase', 'numbers', 'symbols'):
+        parser.add_argument(f'--{char_type}', action=argparse.BooleanOptionalAction, default=True,
+                            help=f"include {char_type}")
+    for key in REQUIREMENT_CLASSES:
+        parser.add_argument('--' + key.replace('_', '-'), dest=key, type=int, default=1, metavar='N',
+                            help="minimum count (default 1, ignored when the type is left out)")
+    parser.add_argument('--exclude-similar', action=argparse.BooleanOptionalAction, default=True,
+                        help="leave out il1Lo0O")
+    parser.add_argument('--exclude-ambiguous', action=argparse.BooleanOptionalAction, default=False,
+                        help="leave out {}[]()/\\'\"`~,;.<>")
+    parser.add_argument('--no-repeating', action='store_true', help="no character appears twice")
+    parser.add_argument('--exclude', default="", metavar='CHARS', help="further characters to leave out")
+    parser.add_argument('-o', '--output', help="write to this file (created private) instead of stdout")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="generate on this many processes, 0 for one per core (default 1)")
+    parser.add_argument('--bench', action='store_true', help="measure passwords/sec instead of printing them")
+    parser.add_argument('--bench-workers', action='store_true',
+                        help="measure passwords/sec with 1, 2, 4, ... processes up to the core count")
+    parser.add_argument('--stat-test', action='store_true',
+                        help="check generated passwords are uniform over all valid ones, then exit")
+    args = parser.parse_args(argv)
+    if args.count is None:
+        args.count = 1000000 if args.bench or args.bench_workers else 1
+    if args.workers < 0:
+        parser.error("Number of workers cannot be negative")
+    if args.count < 1:
+        parser.error("Number of passwords must be at least 1")
+    return parser, args
+
+def main(argv=None):
+    """Generate passwords headlessly"""
+    parser, args = parse_args(argv)
+    if args.stat_test:
+        sys.exit(0 if stat_test() else 1)
+    types = [char_type for char_type in ('lowercase', 'uppercase', 'numbers', 'symbols') if getattr(args, char_type)]
+    # As in the window, a minimum only applies to character types that are included
+    minimums = {key: getattr(args, key) for key, char_type in REQUIREMENT_CLASSES.items() if char_type in types}
     try:
-        import pyperclip
-    except ImportError:
+        engine = PasswordEngine(args.length, build_charset(types, args.exclude_similar, args.exclude_ambiguous,
+                                                           args.exclude), minimums, args.no_repeating)
+    except ValueError as e:
+        parser.error(str(e))
+    
+    if args.bench:
+        benchmark(args, engine)
+        return
+    if args.bench_workers:
+        benchmark_workers(args, engine)
+        return
+    if args.workers == 1:
+        write = engine.write
+    else:
+        write = lambda count, out: parallel_write(engine, count, out, args.workers)
+    try:
+        if args.output:
+            with open_private(args.output) as out:
+                write(args.count, out)
+        else:
+            write(args.count, sys.stdout.buffer)
+            sys.stdout.flush()
+    except ValueError as e:
+        parser.error(str(e))
+    except BrokenPipeError:
+        # The reader (e.g. head) has what it wanted
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main()
+        sys.exit()
+    
+    if pyperclip is None:
         print("Warning: pyperclip not installed. Clipboard functionality will be limited.")
         print("Install with: pip install pyperclip")
         